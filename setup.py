@@ -16,8 +16,11 @@ setup(
     motorsport live timing data feeds from a variety of sources.
     ''',
     install_requires=[
-        "autobahn[serialization,twisted]>=17.6.2",
+        # standalone.Broadcast sends frames it has compressed itself; check
+        # test_standalone passes before raising this upper bound.
+        "autobahn[serialization,twisted]>=17.6.2,<27",
         "dictdiffer",
+        "importlib_metadata; python_version < '3.8'",
         "lzstring==1.0.3",
         "pluginbase",
         "pyopenssl",
@@ -42,10 +45,12 @@ setup(
     entry_points={
         'console_scripts': [
             'livetiming-analysis = livetiming.generate_analysis:main',
+            'livetiming-benchmark = livetiming.benchmark:main',
             'livetiming-plugins = livetiming.service.list_plugins:main',
             'livetiming-recordings = livetiming.recording:main',
             'livetiming-recordings-index = livetiming.recording:update_recordings_index',
             'livetiming-service = livetiming.service:main',
+            'livetiming-service-host = livetiming.service.host:main',
         ],
     }
 )
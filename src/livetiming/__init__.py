@@ -1,21 +1,17 @@
-from autobahn.twisted.component import Component
-from autobahn.rawsocket.util import parse_url as parse_rs_url
-from autobahn.websocket.util import parse_url as parse_ws_url
-from dotenv import load_dotenv, find_dotenv
-from livetiming.network import Realm
 from livetiming.version import VERSION, USER_AGENT
-from twisted.internet.ssl import CertificateOptions
-from twisted.python import log
 
 import os
-import sentry_sdk
-import ssl
 
 
+# Dependencies only needed by services and network components (autobahn,
+# sentry_sdk, dotenv) are imported where they're used, so that importing
+# livetiming - e.g. from short-lived command-line tools - stays cheap.
+
 ENVIRONMENT = os.getenv("LIVETIMING_ENVIRONMENT", "development")
 
 
 def load_env():
+    from dotenv import load_dotenv, find_dotenv
     try:
         maybe_dotenv = find_dotenv("livetiming.env", raise_error_if_not_found=True, usecwd=True)
         load_dotenv(maybe_dotenv)
@@ -29,6 +25,7 @@ _sentry_configured = False
 def sentry():
     global _sentry_configured
     if not _sentry_configured:
+        import sentry_sdk
         sentry_sdk.init(
             environment=ENVIRONMENT,
             release=VERSION,
@@ -40,9 +37,16 @@ def _log_to_sentry(event):
     if not event.get('isError') or 'failure' not in event:
         return
 
+    import sentry_sdk
     f = event['failure']
     with sentry_sdk.push_scope() as scope:
         scope.set_extra('debug', False)
+        # Tag failures logged by a service (e.g. one of several in a
+        # ServiceHost) with that service
+        tags = getattr(event.get('log_source'), 'sentry_tags', None)
+        if isinstance(tags, dict):
+            for tag, value in tags.items():
+                scope.set_tag(tag, value)
         sentry_sdk.capture_exception((f.type, f.value, f.getTracebackObject()))
 
 
@@ -52,11 +56,18 @@ _sentry_twisted_configured = False
 def configure_sentry_twisted():
     global _sentry_twisted_configured
     if not _sentry_twisted_configured:
+        from twisted.python import log
         log.addObserver(_log_to_sentry)
         _sentry_twisted_configured = True
 
 
 def make_component(session_class):
+    from autobahn.twisted.component import Component
+    from autobahn.rawsocket.util import parse_url as parse_rs_url
+    from autobahn.websocket.util import parse_url as parse_ws_url
+    from livetiming.network import Realm
+    from twisted.internet.ssl import CertificateOptions
+
     router = str(os.environ["LIVETIMING_ROUTER"])
 
     if router[0:2] == 'ws':
@@ -0,0 +1,89 @@
+import livetiming
+import os
+import pytest
+import re
+import simplejson
+import subprocess
+import sys
+import time
+
+
+# For each module providing a console script: the most it may take to
+# start Python and import it, as a multiple of the time taken to start
+# Python alone (so that it scales with the speed of the machine; about
+# twice what they take now); and modules it must not import until
+# they're actually used.
+BUDGETS = {
+    'livetiming.benchmark': (20, ['pkg_resources', 'setuptools']),
+    'livetiming.generate_analysis': (8, ['autobahn', 'dotenv', 'lzstring', 'pkg_resources', 'pluginbase', 'sentry_sdk', 'treq']),
+    'livetiming.recording': (8, ['autobahn.twisted', 'dotenv', 'lzstring', 'pkg_resources', 'pluginbase', 'sentry_sdk', 'treq']),
+    'livetiming.service': (6, ['autobahn', 'lzstring', 'pkg_resources', 'pluginbase', 'sentry_sdk', 'setuptools', 'treq']),
+    'livetiming.service.host': (16, ['pkg_resources', 'setuptools']),
+    'livetiming.service.list_plugins': (6, ['autobahn', 'lzstring', 'pkg_resources', 'sentry_sdk', 'setuptools', 'treq']),
+}
+
+# Each timing is the best of this many runs, to discount noise
+RUNS = 3
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(livetiming.__file__)))
+SETUP_PY = os.path.join(os.path.dirname(SRC_DIR), 'setup.py')
+
+LIST_MODULES = '''
+import simplejson, sys
+import {module}
+print(simplejson.dumps(sorted(sys.modules.keys())))
+'''
+
+
+def console_script_modules():
+    with open(SETUP_PY) as setup_py:
+        return set(re.findall(r"'livetiming-[\w-]+ = ([\w.]+):\w+'", setup_py.read()))
+
+
+def run_python(script):
+    '''
+    Returns the best wall-clock time, over RUNS runs, to start Python and
+    run `script`.
+    '''
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    times = []
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', script], env=env)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def imported_modules(module):
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    output = subprocess.check_output([sys.executable, '-c', LIST_MODULES.format(module=module)], env=env)
+    return set(simplejson.loads(output))
+
+
+def test_every_entry_point_has_a_budget():
+    if not os.path.exists(SETUP_PY):
+        pytest.skip('setup.py is not available (not running from a source checkout)')
+    assert console_script_modules() == set(BUDGETS.keys())
+
+
+def test_entry_points_defer_heavy_imports():
+    for module, (_, forbidden) in BUDGETS.items():
+        loaded = imported_modules(module)
+        for heavy in forbidden:
+            assert heavy not in loaded, '{} should not import {}'.format(module, heavy)
+
+
+def test_entry_point_import_budgets():
+    startup = run_python('pass')
+    for module, (budget, _) in BUDGETS.items():
+        elapsed = run_python('import {}'.format(module))
+        assert elapsed < budget * startup, '{} took {:.3f}s to start and import (budget {} x {:.3f}s to start Python)'.format(
+            module, elapsed, budget, startup
+        )
+
+
+def test_recordings_directory_is_importable():
+    script = 'from livetiming.recording import RecordingsDirectory; print(RecordingsDirectory.__name__)'
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    assert output.strip() == b'RecordingsDirectory'
@@ -1,5 +1,5 @@
-from livetiming.messages import SlowZoneMessage
-from livetiming.racing import FlagStatus
+from livetiming.messages import CarPairs, CarPitMessage, DriverChangeMessage, SlowZoneMessage
+from livetiming.racing import FlagStatus, Stat
 
 
 def state_with_flag(flag):
@@ -23,3 +23,43 @@ def test_slow_zone_message():
 
     msgs = generator().process(next_state, prev_state)
     assert len(msgs) == 0
+
+
+def test_per_car_generators_share_pairing():
+    colspec = [Stat.NUM, Stat.STATE, Stat.DRIVER]
+    old_state = {'cars': [['1', 'RUN', 'Alice'], ['2', 'RUN', 'Bob'], ['3', 'RUN', 'Carol']]}
+    new_state = {'cars': [['2', 'PIT', 'Bob'], ['1', 'RUN', 'Dave'], ['4', 'RUN', 'Eve']]}
+
+    pairing = CarPairs(old_state, new_state, colspec)
+    pit_messages = CarPitMessage(colspec).process(old_state, new_state, pairing=pairing)
+    driver_messages = DriverChangeMessage(colspec).process(old_state, new_state, pairing=pairing)
+
+    assert [m[2] for m in pit_messages] == ['#2 (Bob) has entered the pits']
+    assert [m[2] for m in driver_messages] == ['#1 Driver change (Alice to Dave)']
+
+    # Without a pairing, each generator pairs the cars itself
+    assert CarPitMessage(colspec).process(old_state, new_state) == pit_messages
+    assert DriverChangeMessage(colspec).process(old_state, new_state) == driver_messages
+
+
+def test_per_car_messages_follow_mutated_states():
+    colspec = [Stat.NUM, Stat.STATE, Stat.DRIVER]
+    old_state = {'cars': [['1', 'RUN', 'Alice']]}
+    new_state = {'cars': [['1', 'RUN', 'Alice']]}
+    generator = CarPitMessage(colspec)
+
+    assert generator.process(old_state, new_state) == []
+
+    # The same dicts, updated in place, must be paired afresh
+    old_state['cars'] = [['2', 'RUN', 'Bob']]
+    new_state['cars'] = [['2', 'PIT', 'Bob']]
+    assert [m[2] for m in generator.process(old_state, new_state)] == ['#2 (Bob) has entered the pits']
+
+
+def test_pairing_for_another_column_spec_is_not_used():
+    old_state = {'cars': [['1', 'RUN', 'Alice']]}
+    new_state = {'cars': [['1', 'PIT', 'Alice']]}
+    pairing = CarPairs(old_state, new_state, [Stat.NUM, Stat.DRIVER, Stat.STATE])
+
+    messages = CarPitMessage([Stat.NUM, Stat.STATE, Stat.DRIVER]).process(old_state, new_state, pairing=pairing)
+    assert [m[2] for m in messages] == ['#1 (Alice) has entered the pits']
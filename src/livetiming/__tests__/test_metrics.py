@@ -0,0 +1,67 @@
+from livetiming.metrics import Histogram, LatencyTracker, Metrics
+
+
+def test_histogram_percentiles():
+    hist = Histogram(buckets=(1, 2, 5, 10))
+    for value in [0.5] * 50 + [3] * 45 + [7] * 5:
+        hist.observe(value)
+
+    assert hist.count == 100
+    assert hist.percentile(50) == 1
+    assert hist.percentile(95) == 5
+    assert hist.percentile(99) == 7  # Bounded by the largest observation
+    assert hist.for_json()['buckets'] == [[1, 50], [2, 0], [5, 45], [10, 5], [None, 0]]
+
+
+def test_snapshot_while_histograms_are_added():
+    metrics = Metrics(enabled=True)
+
+    class Intruder(Histogram):
+        def for_json(self):
+            # As if another thread started timing a new stage meanwhile
+            metrics.observe('new_stage', 1)
+            metrics.increment('new_counter')
+            return super().for_json()
+
+    metrics.histograms['stage'] = Intruder()
+    snapshot = metrics.snapshot()
+    assert sorted(snapshot['timings'].keys()) == ['stage']
+    assert 'new_stage' in metrics.snapshot()['timings']
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics(enabled=False)
+    with metrics.time('stage'):
+        pass
+    metrics.increment('counter')
+    metrics.observe('value', 1)
+
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {}
+    assert snapshot['timings'] == {}
+
+
+def test_enabled_metrics():
+    metrics = Metrics(enabled=True)
+    metrics.add_source('extra', lambda: {'foo': 'bar'})
+    with metrics.time('stage'):
+        pass
+    metrics.increment('counter', 3)
+
+    snapshot = metrics.snapshot()
+    assert snapshot['counters'] == {'counter': 3}
+    assert snapshot['timings']['stage']['count'] == 1
+    assert snapshot['extra'] == {'foo': 'bar'}
+
+
+def test_latency_tracker_uses_recent_window():
+    tracker = LatencyTracker(window=10, min_samples=5)
+    for _ in range(4):
+        tracker.observe('url', 1)
+    assert tracker.percentile('url', 95) is None
+
+    for value in range(1, 11):
+        tracker.observe('url', value)
+    assert tracker.percentile('url', 50) == 5
+    assert tracker.percentile('url', 95) == 10
+    assert tracker.percentile('other', 50) is None
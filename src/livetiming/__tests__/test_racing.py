@@ -0,0 +1,27 @@
+from livetiming.racing import ColumnSpec, Stat
+
+
+def test_column_spec_is_compiled_once():
+    spec = ColumnSpec.of([Stat.NUM, Stat.DRIVER, Stat.LAPS])
+    assert ColumnSpec.of([Stat.NUM, Stat.DRIVER, Stat.LAPS]) is spec
+    assert ColumnSpec.of(spec) is spec
+
+    car = ['7', 'Alice', 12]
+    assert spec.get(car, Stat.DRIVER) == 'Alice'
+    assert spec.get(car, Stat.CLASS, 'none') == 'none'
+    assert spec.get(['7'], Stat.LAPS) is None
+    assert spec.get(None, Stat.NUM) is None
+
+    spec.set(car, Stat.LAPS, 13)
+    spec.set(car, Stat.CLASS, 'LMP1')
+    assert car == ['7', 'Alice', 13]
+
+    assert Stat.DRIVER in spec and Stat.CLASS not in spec
+    assert spec.index(Stat.LAPS) == 2
+
+
+def test_stat_from_title():
+    assert Stat.from_title('Driver') == Stat.DRIVER
+    assert Stat.from_title('Lap') == Stat.LAPS
+    assert Stat.from_title('Nonsense') is None
+    assert Stat.parse_colspec([s.value for s in Stat]) == list(Stat)
@@ -1,30 +1,55 @@
-from autobahn.wamp.types import PublishOptions
 from collections import OrderedDict
 from livetiming.analysis.data import DataCentre
+from livetiming.metrics import Metrics, RATIO_BUCKETS
 from livetiming.network import Message, MessageClass, RPC
-from livetiming.racing import FlagStatus, Stat
-from twisted.internet.defer import DeferredLock, inlineCallbacks
+from livetiming.racing import ColumnSpec, FlagStatus, Stat
+from twisted.internet.defer import inlineCallbacks
 from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
+from twisted.python.threadable import isInIOThread
 
 import copy
+import inspect
 import pickle
 import importlib
 import simplejson
+import threading
 import time
 import os
 
 
 ANALYSIS_PUBLISH_INTERVAL = 60
 MIN_PUBLISH_INTERVAL = 10
+SNAPSHOT_INTERVAL = 1
 
 
-def _make_data_message(data, retain=True):
-    return Message(
-        MessageClass.ANALYSIS_DATA,
-        data,
-        retain
-    ).serialise()
+DEFAULT_COMPRESSION_THRESHOLD = 4096
+
+
+def _make_data_message(data, retain=True, compress_above=None, metrics=None):
+    '''
+    Returns a serialised analysis data message. If `compress_above` is
+    given and the data is larger than that many bytes when serialised,
+    it is sent LZString-compressed, as ANALYSIS_DATA_COMPRESSED.
+    '''
+    if compress_above is not None:
+        serialised = simplejson.dumps(data)
+        if len(serialised) > compress_above:
+            from lzstring import LZString
+            metrics = metrics or Metrics()
+
+            with metrics.time('analysis_compress'):
+                compressed = LZString().compressToUTF16(serialised)
+
+            if metrics.enabled:
+                compressed_bytes = 2 * len(compressed)  # UTF-16
+                metrics.increment('analysis_bytes_serialised', len(serialised))
+                metrics.increment('analysis_bytes_published', compressed_bytes)
+                metrics.observe('analysis_compression_ratio', compressed_bytes / len(serialised), RATIO_BUCKETS)
+
+            return Message(MessageClass.ANALYSIS_DATA_COMPRESSED, compressed, retain=retain).serialise()
+
+    return Message(MessageClass.ANALYSIS_DATA, data, retain=retain).serialise()
 
 
 PROCESSING_MODULES = [  # Order is important!
@@ -45,65 +70,217 @@ EMPTY_STATE = {
 
 def with_dc_lock(func):
     def inner(elf, *args, **kwargs):
-        elf._dc_lock.run(func, elf, *args, **kwargs)
+        with elf._dc_lock:
+            return func(elf, *args, **kwargs)
     return inner
 
 
+class AnalysisSnapshot(object):
+    '''
+    All analysis data as of one analysed update, and the (channel,
+    message) pairs that bring a newly-connected client up to date with
+    it. The data is copied out of the data centre, and the analyser
+    replaces its snapshot whole rather than changing it, so the reactor
+    can read it without locking while the worker carries on analysing.
+    '''
+    def __init__(self, data, messages):
+        self.data = data
+        self.messages = messages
+        self.sync_messages = list(messages.values())
+
+
 class Analyser(object):
+    '''
+    Runs the analysis modules over each state update, and publishes the
+    data that changes - each key on its own topic, no more often than
+    every `interval` seconds.
+
+    Data larger than `compression_threshold` bytes (when serialised) is
+    published compressed, as the service's state is; a negative threshold
+    disables this. Compression time and ratio are recorded in `metrics`.
+
+    With `batch` set, the keys due to be published each time are also
+    published together, as one compressed message, on the service's
+    analysis batch topic (RPC.ANALYSIS_BATCH_PUBLISH); clients can
+    subscribe to that instead of one topic per key.
+    '''
     log = Logger()
-    publish_options = PublishOptions(retain=True)
+    publish_options = None
+    snapshot_interval = SNAPSHOT_INTERVAL
+    worker = None  # Set by the AnalysisWorker feeding us, if any
 
-    def __init__(self, uuid, publishFunc, interval=ANALYSIS_PUBLISH_INTERVAL):
+    def __init__(self, uuid, publishFunc, interval=ANALYSIS_PUBLISH_INTERVAL, batch=False,
+                 compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, metrics=None):
         self._current_state = copy.copy(EMPTY_STATE)
         self.uuid = uuid
         self.publish = publishFunc
+        self.batch = batch
+        self.compression_threshold = compression_threshold
+        self.metrics = metrics or Metrics()
+        if publishFunc:
+            # Not needed (nor imported) when generating analysis offline
+            from autobahn.wamp.types import PublishOptions
+            self.publish_options = PublishOptions(retain=True)
         self.interval = max(interval, MIN_PUBLISH_INTERVAL)
         self._load_data_centre()
         self._pending_publishes = {}
+        self._pending_lock = threading.Lock()
         self._last_published = {}
-        self._dc_lock = DeferredLock()
+        self._dc_lock = threading.RLock()
+        self._compress_messages = True
 
         self._modules = {m: importlib.import_module("livetiming.analysis.{}".format(m)) for m in PROCESSING_MODULES}
+        self._accepts_pairing = {m for m, module in self._modules.items() if _accepts_pairing(module.receive_state_update)}
+        self._snapshot = None
+        self._stale_keys = set()
+        self._update_snapshot()
+
+    @property
+    def compress_messages(self):
+        return self._compress_messages
+
+    @compress_messages.setter
+    def compress_messages(self, value):
+        if value != self._compress_messages:
+            self._compress_messages = value
+            self._run_exclusive(self._update_snapshot)
+
+    @property
+    def snapshot(self):
+        '''
+        The AnalysisSnapshot as of the most recently analysed update.
+        '''
+        return self._snapshot
 
     @with_dc_lock
     def receiveStateUpdate(self, newState, colSpec, timestamp=None, new_messages=[]):
         if not timestamp:
             timestamp = time.time()
-        self.data_centre.current_state = copy.deepcopy(newState)
+        self.data_centre.current_state = newState  # Shared, read-only snapshot - see AbstractService.getRaceState
+        pairing = CarPairing(self._current_state, newState, colSpec)
+        changed = set()
         for key in PROCESSING_MODULES:
             module = self._modules[key]
-            updates = module.receive_state_update(self.data_centre, self._current_state, newState, colSpec, timestamp, new_messages)
+            if key in self._accepts_pairing:
+                updates = module.receive_state_update(self.data_centre, self._current_state, newState, colSpec, timestamp, new_messages, pairing=pairing)
+            else:
+                updates = module.receive_state_update(self.data_centre, self._current_state, newState, colSpec, timestamp, new_messages)
             for key, data in updates:
+                changed.add(key.split('/')[0])
                 self._publish_data(key, data)
 
         self._current_state = self.data_centre.current_state
         self.data_centre.latest_timestamp = timestamp
 
+        self._stale_keys |= changed
+        if self._stale_keys and time.time() - self._snapshot_time >= self.snapshot_interval:
+            self._refresh_snapshot()
+
     def publish_all(self):
-        for key, data in self.get_current_state().items():
+        for key, data in self._snapshot.data.items():
             self._publish_data(key, data)
 
+    def initial_sync_messages(self):
+        '''
+        Returns (channel, message) pairs for all current analysis data,
+        for sending to a single newly-connected client. These are built
+        as updates are analysed, so this never waits for analysis.
+        '''
+        return self._snapshot.sync_messages
+
+    def refresh_snapshot(self):
+        '''
+        Brings the snapshot up to date with any data that has changed since
+        it was last built. Updates rebuild it no more than every
+        `snapshot_interval` seconds, so this should be called about as
+        often to catch changes made since.
+        '''
+        if self._stale_keys:
+            self._run_exclusive(self._refresh_snapshot)
+
+    def _refresh_snapshot(self):
+        stale_keys = self._stale_keys
+        self._stale_keys = set()
+        self._update_snapshot(stale_keys)
+
+    def _update_snapshot(self, changed=None):
+        '''
+        Replaces the snapshot with one in which the data (and sync message)
+        for each of the keys in `changed` - or all keys, if not given - is
+        rebuilt. Call with the data centre lock held.
+        '''
+        previous = self._snapshot
+        if changed is None or previous is None:
+            self._stale_keys = set()
+            # get_data() may return lists the worker goes on to change
+            data = copy.deepcopy(self.get_current_state())
+            messages = {}
+            rebuilt = data
+        elif changed:
+            rebuilt = copy.deepcopy(self.get_current_state(changed))
+            data = dict(previous.data, **rebuilt)
+            messages = dict(previous.messages)
+        else:
+            return
+
+        for key in rebuilt:
+            messages[key] = (
+                RPC.ANALYSIS_PUBLISH.format(self.uuid, key),
+                self._make_message(data[key], key not in ['lap', 'stint'])
+            )
+        self._snapshot = AnalysisSnapshot(data, messages)
+        self._snapshot_time = time.time()
+
+    def _make_message(self, data, retain=True, compress_above=None):
+        if not self.compress_messages:
+            compress_above = None
+        elif compress_above is None and self.compression_threshold >= 0:
+            compress_above = self.compression_threshold
+        return _make_data_message(data, retain, compress_above, self.metrics)
+
     def _publish_data(self, key, data):
         self.log.debug("Queueing publish of data '{key}'", key=key, data=data)
-        self._pending_publishes[key] = data
-        self._publish_pending()
+        with self._pending_lock:
+            self._pending_publishes[key] = data
+        # Publishing is not thread-safe; when called from the analysis worker
+        # the worker will call _publish_pending from the reactor instead.
+        if isInIOThread():
+            self._publish_pending()
 
     def _publish_pending(self):
+        if not self.publish:
+            return
+
         now = time.time()
-        for key, data in copy.copy(self._pending_publishes).items():
+        with self._pending_lock:
+            due = {
+                key: self._pending_publishes.pop(key)
+                for key in list(self._pending_publishes.keys())
+                if self._last_published.get(key, 0) + (self.interval or 1) < now
+            }
+
+        if self.batch and due:
             try:
-                if self._last_published.get(key, 0) + (self.interval or 1) < now and self.publish:
-                    self.log.debug("Publishing queued data for livetiming.analysis/{uuid}/{key}", uuid=self.uuid, key=key)
-                    retain = key not in ['lap', 'stint']
-                    self.publish(
-                        RPC.ANALYSIS_PUBLISH.format(self.uuid, key),
-                        _make_data_message(data, retain),
-                        options=self.publish_options if retain else None
-                    )
-                    self._pending_publishes.pop(key)
-                    self._last_published[key] = now
+                self.publish(
+                    RPC.ANALYSIS_BATCH_PUBLISH.format(self.uuid),
+                    self._make_message(due, retain=False, compress_above=0)
+                )
             except Exception:
-                pass
+                self.log.failure("Failed to publish analysis batch: {log_failure}")
+
+        for key, data in due.items():
+            try:
+                self.log.debug("Publishing queued data for livetiming.analysis/{uuid}/{key}", uuid=self.uuid, key=key)
+                retain = key not in ['lap', 'stint']
+                self.publish(
+                    RPC.ANALYSIS_PUBLISH.format(self.uuid, key),
+                    self._make_message(data, retain),
+                    options=self.publish_options if retain else None
+                )
+                self._last_published[key] = now
+            except Exception:
+                with self._pending_lock:  # Try again next time, unless superseded
+                    self._pending_publishes.setdefault(key, data)
 
     def _data_centre_file(self):
         return os.path.join(
@@ -135,52 +312,95 @@ class Analyser(object):
         except IOError:
             self.data_centre = DataCentre()
 
-    @with_dc_lock
+    def _run_exclusive(self, func):
+        '''
+        Calls `func` with sole access to the data centre. On the reactor
+        thread, while a worker is analysing for us, that's done by queueing
+        it on the worker, so that the reactor never waits for the lock.
+        '''
+        if self.worker and isInIOThread() and self.worker.call(func):
+            return
+        with self._dc_lock:
+            func()
+
     def reset(self):
+        self._run_exclusive(self._reset)
+
+    def _reset(self):
         self.data_centre.reset()
-        self._pending_publishes = {}
+        with self._pending_lock:
+            self._pending_publishes = {}
         self._last_published = {}
         self._current_state = copy.copy(EMPTY_STATE)
+        self._update_snapshot()
 
-    def get_current_state(self):
+    def get_current_state(self, keys=None):
+        '''
+        Returns the current analysis data, for all keys or only those given.
+        '''
         data = {}
 
         for key, module in self._modules.items():
-            data[key] = module.get_data(self.data_centre)
-
-        car_stats = data.pop('car')
-        for k, v in car_stats.items():
-            data[k] = v
+            if key == 'car':
+                data.update(module.get_data(self.data_centre, keys))
+            elif keys is None or key in keys:
+                data[key] = module.get_data(self.data_centre)
 
         return data
 
 
-class FieldExtractor(object):
-    def __init__(self, colSpec):
-        self.mapping = {}
-        for idx, col in enumerate(colSpec):
-            self.mapping[col] = idx
+def FieldExtractor(colSpec):
+    '''
+    Returns the compiled ColumnSpec for `colSpec`, for getting fields
+    from cars with f.get(car, stat, default).
+    '''
+    return ColumnSpec.of(colSpec)
 
-    def get(self, car, field, default=None):
-        if car:
-            try:
-                return car[self.mapping[field]]
-            except (KeyError, IndexError):
-                return default
-        return default
+
+class CarPairing(object):
+    '''
+    Pairs each car in a new state with its row in the previous state, by
+    race number. The analyser builds this once per update and passes it
+    to every processing module whose receive_state_update accepts a
+    `pairing` keyword argument, so that each doesn't have to search the
+    old state for every car.
+
+    Iterating gives (race_num, position, old_car, new_car) for each car
+    with a race number; old_car is None for a car not in the old state.
+    '''
+    def __init__(self, old_state, new_state, colspec):
+        self.f = FieldExtractor(colspec)
+        self.flag = FlagStatus.fromString(new_state["session"].get("flagState", "none"))
+
+        self.old_cars = {}
+        for old_car in old_state["cars"]:
+            race_num = self.f.get(old_car, Stat.NUM)
+            if race_num:
+                self.old_cars.setdefault(race_num, old_car)
+
+        self.cars = []
+        for idx, new_car in enumerate(new_state["cars"]):
+            race_num = self.f.get(new_car, Stat.NUM)
+            if race_num:
+                self.cars.append((race_num, idx + 1, self.old_cars.get(race_num), new_car))
+
+    def __iter__(self):
+        return iter(self.cars)
+
+
+def _accepts_pairing(func):
+    params = inspect.signature(func).parameters
+    return 'pairing' in params or any(p.kind == p.VAR_KEYWORD for p in params.values())
 
 
 def per_car(key, data_func):
     def per_car_inner(func):
-        def inner(dc, old_state, new_state, colspec, timestamp, new_messages):
-            flag = FlagStatus.fromString(new_state["session"].get("flagState", "none"))
-            f = FieldExtractor(colspec)
+        def inner(dc, old_state, new_state, colspec, timestamp, new_messages, pairing=None):
+            if pairing is None:
+                pairing = CarPairing(old_state, new_state, colspec)
             changed = False
-            for idx, new_car in enumerate(new_state['cars']):
-                race_num = f.get(new_car, Stat.NUM)
-                if race_num:
-                    old_car = next(iter([c for c in old_state["cars"] if f.get(c, Stat.NUM) == race_num] or []), None)
-                    changed = func(dc, race_num, idx + 1, old_car, new_car, f, flag, timestamp, new_messages) or changed
+            for race_num, position, old_car, new_car in pairing:
+                changed = func(dc, race_num, position, old_car, new_car, pairing.f, pairing.flag, timestamp, new_messages) or changed
             if changed:
                 return [(key, data_func(dc))]
             else:
@@ -0,0 +1,149 @@
+from livetiming.analysis import Analyser
+from livetiming.network import MessageClass, RPC
+from lzstring import LZString
+
+import simplejson
+
+
+def make_analyser(tmp_path, monkeypatch, **kwargs):
+    monkeypatch.setenv('LIVETIMING_ANALYSIS_DIR', str(tmp_path))
+    published = []
+    analyser = Analyser('test', lambda channel, message, **kw: published.append((channel, message)), **kwargs)
+    return analyser, published
+
+
+def test_due_keys_are_also_published_as_one_batch(tmp_path, monkeypatch):
+    analyser, published = make_analyser(tmp_path, monkeypatch, batch=True)
+    analyser._publish_data('session', {'leader': 1})
+    analyser._publish_data('stint/1', [1, 2, 3])
+    analyser._publish_pending()
+
+    channels = [channel for channel, _ in published]
+    assert channels[0] == RPC.ANALYSIS_BATCH_PUBLISH.format('test')
+    assert sorted(channels[1:]) == [
+        RPC.ANALYSIS_PUBLISH.format('test', 'session'),
+        RPC.ANALYSIS_PUBLISH.format('test', 'stint/1')
+    ]
+
+    batch = published[0][1]
+    assert batch['msgClass'] == MessageClass.ANALYSIS_DATA_COMPRESSED.value
+    assert simplejson.loads(LZString().decompressFromUTF16(batch['payload'])) == {
+        'session': {'leader': 1},
+        'stint/1': [1, 2, 3]
+    }
+
+    # Nothing more is due until the interval has passed
+    analyser._publish_data('session', {'leader': 2})
+    analyser._publish_pending()
+    assert len(published) == 3
+
+
+def test_no_batch_unless_requested(tmp_path, monkeypatch):
+    analyser, published = make_analyser(tmp_path, monkeypatch)
+    analyser._publish_data('session', {'leader': 1})
+    analyser._publish_pending()
+
+    assert [channel for channel, _ in published] == [RPC.ANALYSIS_PUBLISH.format('test', 'session')]
+
+
+def test_large_data_is_compressed(tmp_path, monkeypatch):
+    from livetiming.metrics import Metrics
+    metrics = Metrics(enabled=True)
+    analyser, published = make_analyser(tmp_path, monkeypatch, compression_threshold=1000, metrics=metrics)
+    big = [['driver {}'.format(i), i * 1.5] for i in range(200)]
+    analyser._publish_data('driver', big)
+    analyser._publish_data('session', {'leader': 1})
+    analyser._publish_pending()
+
+    messages = dict(published)
+    compressed = messages[RPC.ANALYSIS_PUBLISH.format('test', 'driver')]
+    assert compressed['msgClass'] == MessageClass.ANALYSIS_DATA_COMPRESSED.value
+    assert compressed['retain']
+    assert simplejson.loads(LZString().decompressFromUTF16(compressed['payload'])) == big
+
+    small = messages[RPC.ANALYSIS_PUBLISH.format('test', 'session')]
+    assert small['msgClass'] == MessageClass.ANALYSIS_DATA.value
+    assert small['payload'] == {'leader': 1}
+
+    assert metrics.counters['analysis_bytes_published'] < metrics.counters['analysis_bytes_serialised']
+    assert metrics.histograms['analysis_compress'].count == 1
+
+
+def test_compression_can_be_disabled(tmp_path, monkeypatch):
+    analyser, published = make_analyser(tmp_path, monkeypatch, compression_threshold=-1)
+    analyser._publish_data('driver', [['driver {}'.format(i), i] for i in range(1000)])
+    analyser._publish_pending()
+
+    assert published[0][1]['msgClass'] == MessageClass.ANALYSIS_DATA.value
+
+
+def test_car_pairing():
+    from livetiming.analysis import CarPairing
+    from livetiming.racing import FlagStatus, Stat
+
+    colspec = [Stat.NUM, Stat.STATE]
+    old_state = {'cars': [['1', 'RUN'], ['2', 'PIT'], ['', 'RUN']], 'session': {}}
+    new_state = {'cars': [['2', 'RUN'], ['3', 'RUN'], ['', 'RUN'], ['1', 'RUN']], 'session': {'flagState': 'yellow'}}
+
+    pairing = CarPairing(old_state, new_state, colspec)
+    assert pairing.flag == FlagStatus.YELLOW
+    assert list(pairing) == [
+        ('2', 1, ['2', 'PIT'], ['2', 'RUN']),
+        ('3', 2, None, ['3', 'RUN']),
+        ('1', 4, ['1', 'RUN'], ['1', 'RUN'])
+    ]
+
+
+def test_sync_messages_are_built_after_each_update(tmp_path, monkeypatch):
+    from livetiming.racing import Stat
+    import threading
+
+    colspec = [Stat.NUM, Stat.STATE, Stat.CLASS, Stat.DRIVER]
+    state = {'cars': [['1', 'RUN', 'GT3', 'Alice']], 'session': {'flagState': 'green'}}
+    analyser, _ = make_analyser(tmp_path, monkeypatch)
+    analyser.receiveStateUpdate(state, colspec, 1000)
+    assert analyser.snapshot.data['static'] == {}  # Not rebuilt within snapshot_interval...
+    analyser.refresh_snapshot()  # ...unless asked
+
+    snapshot = analyser.snapshot
+    assert snapshot.data['static'] == {'1': ['GT3', None, None]}
+    sync = dict(analyser.initial_sync_messages())
+    assert sync[RPC.ANALYSIS_PUBLISH.format('test', 'static')]['payload'] == {'1': ['GT3', None, None]}
+
+    # Nothing changed, so nothing is rebuilt
+    analyser.receiveStateUpdate(state, colspec, 1001)
+    assert analyser.snapshot is snapshot
+
+    # The snapshot can be read while analysis holds the lock
+    locked, release = threading.Event(), threading.Event()
+
+    def hold_lock():
+        with analyser._dc_lock:
+            locked.set()
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    locked.wait(5)
+    try:
+        assert analyser.initial_sync_messages() is snapshot.sync_messages
+    finally:
+        release.set()
+        holder.join()
+
+
+def test_snapshot_does_not_share_data_with_the_analysis(tmp_path, monkeypatch):
+    from livetiming.racing import Stat
+
+    colspec = [Stat.NUM, Stat.STATE, Stat.CLASS, Stat.DRIVER]
+    analyser, _ = make_analyser(tmp_path, monkeypatch)
+    analyser.receiveStateUpdate({'cars': [['1', 'RUN', 'GT3', 'Alice']], 'session': {'flagState': 'green'}}, colspec, 1000)
+    analyser.refresh_snapshot()
+    snapshot = analyser.snapshot
+    assert snapshot.data['driver'] == {'1': ['Alice']}
+
+    analyser.receiveStateUpdate({'cars': [['1', 'RUN', 'GT3', 'Bob']], 'session': {'flagState': 'green'}}, colspec, 1001)
+    assert snapshot.data['driver'] == {'1': ['Alice']}
+
+    analyser.refresh_snapshot()
+    assert analyser.snapshot.data['driver'] == {'1': ['Alice', 'Bob']}
@@ -0,0 +1,121 @@
+from livetiming.analysis.data import Car, DataCentre, Lap, Stint
+from livetiming.racing import FlagStatus
+
+import copyreg
+import pickle
+import pytest
+
+
+def drive_stint(car, laptimes, flags=None):
+    for idx, laptime in enumerate(laptimes):
+        car.current_lap += 1
+        if flags:
+            car.see_flag(flags[idx])
+        car.add_lap(laptime, 1, 'Driver', car.current_lap * 100)
+
+
+def test_stint_aggregates():
+    car = Car('1')
+    car.pit_out(0, 'Driver', FlagStatus.GREEN)
+    drive_stint(car, [100, 90, 92, 94], [FlagStatus.GREEN, FlagStatus.YELLOW, FlagStatus.GREEN, FlagStatus.SC])
+    stint = car.current_stint
+
+    assert stint.best_lap_time == 90
+    assert stint.yellow_laps == 2
+    assert stint.average_lap_time == pytest.approx(92)
+
+    car.pit_in(500)
+    assert stint.average_lap_time == pytest.approx(91)
+
+    # Finish line crossed in the pit lane
+    drive_stint(car, [120])
+    assert stint.laps[-1].laptime == 120
+    assert stint.average_lap_time == pytest.approx(92)
+
+
+def test_short_stints_have_no_average():
+    car = Car('1')
+    car.pit_out(0, 'Driver', FlagStatus.GREEN)
+    drive_stint(car, [100])
+    assert car.current_stint.average_lap_time is None
+    drive_stint(car, [95])
+    car.pit_in(200)
+    assert car.stints[-1].average_lap_time is None
+
+
+class Legacy(object):
+    '''
+    Pickles as an instance of `cls` with the given attributes, as these
+    classes were pickled before they used __slots__.
+    '''
+    def __init__(self, cls, **state):
+        self.cls = cls
+        self.state = state
+
+    def __reduce__(self):
+        return (copyreg._reconstructor, (self.cls, object, None), self.state)
+
+
+def legacy_lap(lap_num, laptime, flag=FlagStatus.GREEN):
+    return Legacy(Lap, lap_num=lap_num, position=1, laptime=laptime, driver='Driver', timestamp=lap_num * 100, flag=flag, tyre=None)
+
+
+def test_laps_are_stored_by_column():
+    car = Car('1')
+    car.pit_out(0, 'Driver A', FlagStatus.GREEN)
+    drive_stint(car, [100, 90])
+    car.pit_in(300)
+    car.pit_out(340, 'Driver B', FlagStatus.GREEN)
+    drive_stint(car, [130, 91])
+
+    assert len(car.laps) == 4
+    assert [lap.laptime for lap in car.laps] == [100, 90, 130, 91]
+    assert car.laps[-1].lap_num == 5
+    assert [lap.for_json() for lap in car.stints[1].laps] == [[130, FlagStatus.NONE], [91, FlagStatus.NONE]]
+    assert [lap.driver for lap in car.laps] == ['Driver'] * 4
+    assert [lap.tyre for lap in car.laps] == [None] * 4
+
+    restored = pickle.loads(pickle.dumps(car, pickle.HIGHEST_PROTOCOL))
+    assert restored.stints[1].laps[0].laptime == 130
+    assert restored.stints[1].laps[0]._store is restored.laps
+
+
+def test_unhashable_values_are_shared_between_laps():
+    car = Car('1')
+    car.pit_out(0, 'Driver', FlagStatus.GREEN)
+    for lap_num in range(1, 4):
+        car.current_lap = lap_num
+        car.add_lap(90 + lap_num, 1, 'Driver', lap_num * 100, FlagStatus.GREEN, ['S', 'tyre-soft'])
+    car.current_lap = 4
+    car.add_lap(95, 1, 'Driver', 400, FlagStatus.GREEN, ['M', 'tyre-medium'])
+
+    assert [lap.tyre for lap in car.laps] == [['S', 'tyre-soft']] * 3 + [['M', 'tyre-medium']]
+    assert car.laps[0].tyre is car.laps[2].tyre
+
+
+def test_old_pickles_are_moved_into_a_lap_store():
+    laps = [legacy_lap(2, 100), legacy_lap(3, 90, FlagStatus.FCY), legacy_lap(4, 92)]
+    stint = Legacy(Stint, start_lap=2, start_time=0, driver='Driver', end_lap=None, end_time=None, in_progress=True, laps=laps, tyre=None)
+    car = Legacy(
+        Car,
+        race_num='1', laps=laps, stints=[stint], inPit=False, current_lap=4, _current_lap_flags=[FlagStatus.GREEN],
+        initial_driver=None, fuel_times=[], last_pass=400, drivers=['Driver'], messages=[],
+        race_class=None, team=None, vehicle=None
+    )
+    dc = DataCentre()
+    dc._cars['1'] = car
+    dc.lap_chart.__dict__['laps'] = {3: [('1', laps[1])]}
+    dc.lap_chart._seen_on_lap[3].append('1')
+
+    restored = pickle.loads(pickle.dumps(dc))
+    car = restored.car('1')
+    stint = car.current_stint
+    assert [lap.laptime for lap in stint.laps] == [100, 90, 92]
+    assert stint.best_lap_time == 90
+    assert stint.yellow_laps == 1
+    assert stint.average_lap_time == pytest.approx(91)
+    assert restored.lap_chart.laps[3][0][1].laptime == 90
+    assert restored.lap_chart._stores['1'] is car.laps
+
+    drive_stint(car, [95])
+    assert stint.average_lap_time == pytest.approx(92.333, abs=0.001)
@@ -0,0 +1,114 @@
+from livetiming import analysis
+from livetiming.analysis import Analyser, worker
+from livetiming.analysis.worker import AnalysisBacklogFull, AnalysisWorker, OverloadPolicy
+
+import pytest
+
+
+class FakeReactor(object):
+    def __init__(self):
+        self.in_thread = []
+
+    def callInThread(self, func, *args, **kwargs):
+        self.in_thread.append(func)
+
+    def callFromThread(self, func, *args, **kwargs):
+        pass
+
+    def run_threads(self):
+        while self.in_thread:
+            self.in_thread.pop(0)()
+
+
+class RecordingAnalyser(object):
+    def __init__(self):
+        self.received = []
+
+    def receiveStateUpdate(self, newState, colSpec, timestamp=None, new_messages=[]):
+        self.received.append((newState, new_messages))
+
+    def _publish_pending(self):
+        pass
+
+
+@pytest.fixture
+def fake_reactor(monkeypatch):
+    r = FakeReactor()
+    monkeypatch.setattr(worker, 'reactor', r)
+    return r
+
+
+def test_updates_processed_in_order(fake_reactor):
+    analyser = RecordingAnalyser()
+    w = AnalysisWorker(analyser, max_backlog=5)
+
+    for i in range(3):
+        w.submit(i, [], new_messages=[[i]])
+
+    assert len(fake_reactor.in_thread) == 1  # Only one drain at a time
+    assert w.backlog == 3
+
+    fake_reactor.run_threads()
+    assert [s for s, _ in analyser.received] == [0, 1, 2]
+    assert w.backlog == 0
+    assert w.stats()['processed'] == 3
+
+
+def test_merge_when_backlog_full(fake_reactor):
+    analyser = RecordingAnalyser()
+    w = AnalysisWorker(analyser, max_backlog=2, overload_policy=OverloadPolicy.MERGE)
+
+    for i in range(4):
+        w.submit(i, [], new_messages=[[i]])
+
+    assert w.backlog == 2
+    assert w.merged == 2
+
+    fake_reactor.run_threads()
+    assert analyser.received == [
+        (0, [[0]]),
+        (3, [[3], [2], [1]])
+    ]
+
+
+def test_fail_when_backlog_full(fake_reactor):
+    w = AnalysisWorker(RecordingAnalyser(), max_backlog=1, overload_policy=OverloadPolicy.FAIL)
+    w.submit(0, [])
+
+    with pytest.raises(AnalysisBacklogFull):
+        w.submit(1, [])
+    assert w.rejected == 1
+
+
+def test_calls_are_queued_in_order_with_updates(fake_reactor):
+    analyser = RecordingAnalyser()
+    w = AnalysisWorker(analyser)
+
+    w.submit(0, [])
+    w.call(lambda: analyser.received.append('call'))
+    w.submit(1, [])
+    assert w.backlog == 2
+
+    fake_reactor.run_threads()
+    assert [s for s, _ in analyser.received[0:1]] == [0]
+    assert analyser.received[1] == 'call'
+    assert analyser.received[2][0] == 1
+
+
+def test_reset_on_reactor_is_done_by_worker(fake_reactor, tmp_path, monkeypatch):
+    monkeypatch.setenv('LIVETIMING_ANALYSIS_DIR', str(tmp_path))
+    monkeypatch.setattr(analysis, 'isInIOThread', lambda: True)
+    analyser = Analyser('test', None)
+    w = AnalysisWorker(analyser)
+    analyser.data_centre.car('1')
+
+    analyser.reset()
+    assert '1' in analyser.data_centre._cars
+
+    fake_reactor.run_threads()
+    assert '1' not in analyser.data_centre._cars
+
+    w.stop()
+    analyser.data_centre.car('2')
+    analyser.reset()
+    assert '2' not in analyser.data_centre._cars
@@ -1,3 +1,4 @@
+from array import array
 from collections import defaultdict, OrderedDict
 from livetiming.racing import Stat, FlagStatus
 import pickle
@@ -10,44 +11,209 @@ import math
 
 class LaptimeChart(object):
     def __init__(self):
-        self.laps = defaultdict(list)
         self._seen_on_lap = defaultdict(list)
+        # Index in each car's LapStore of the laps in _seen_on_lap
+        self._lap_indexes = {}
+        self._stores = {}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'laps' in state:
+            # Pickled before laps were stored by column
+            legacy_laps = self.__dict__.pop('laps')
+            self._lap_indexes = {}
+            self._stores = {}
+            for lap_num, entries in legacy_laps.items():
+                for race_num, lap in entries:
+                    self._lap_indexes.setdefault(lap_num, array('i')).append(lap._index)
+                    self._stores[race_num] = lap._store
 
     def tally(self, race_num, lap):
-        if race_num not in self._seen_on_lap[lap.lap_num]:
-            self.laps[lap.lap_num].append((race_num, lap))
-            self._seen_on_lap[lap.lap_num].append(race_num)
+        seen = self._seen_on_lap[lap.lap_num]
+        if race_num not in seen:
+            seen.append(race_num)
+            self._lap_indexes.setdefault(lap.lap_num, array('i')).append(lap._index)
+            self._stores[race_num] = lap._store
+
+    @property
+    def laps(self):
+        return {
+            lap_num: [
+                (race_num, Lap(self._stores[race_num], idx))
+                for race_num, idx in zip(race_nums, self._lap_indexes.get(lap_num, []))
+            ]
+            for lap_num, race_nums in self._seen_on_lap.items()
+        }
 
     def iteritems(self):
         return iter(self.laps.items())
 
 
+def _value_key(value):
+    '''
+    A hashable key for a driver or tyre value: lists and dicts (as found
+    in timing data) become tuples tagged with their type.
+    '''
+    if isinstance(value, list):
+        return (list, tuple(_value_key(v) for v in value))
+    if isinstance(value, dict):
+        return (dict, frozenset((k, _value_key(v)) for k, v in value.items()))
+    return value
+
+
+def _restore_slots(obj, state):
+    '''
+    Sets attributes from pickled state: either a dict, as pickled before
+    these classes used __slots__, or the (dict, slots) pair pickled since.
+    '''
+    if isinstance(state, tuple):
+        state = dict(state[0] or {}, **(state[1] or {}))
+    for key, value in state.items():
+        setattr(obj, key, value)
+
+
+class LapStore(object):
+    '''
+    A car's laps, stored by column: numeric fields in typed arrays, and
+    drivers and tyres as indexes into a table of the distinct values
+    seen. Indexing returns Lap views onto the store.
+    '''
+    __slots__ = ['lap_nums', 'positions', 'laptimes', 'timestamps', 'flags', 'drivers', 'tyres', '_values', '_value_ids']
+
+    def __init__(self):
+        self.lap_nums = array('i')
+        self.positions = array('i')
+        self.laptimes = array('d')
+        self.timestamps = array('d')
+        self.flags = array('b')
+        self.drivers = array('H')
+        self.tyres = array('H')
+        self._values = []
+        self._value_ids = {}
+
+    def __setstate__(self, state):
+        _restore_slots(self, state)
+
+    def _intern(self, value):
+        key = _value_key(value)
+        value_id = self._value_ids.get(key)
+        if value_id is None:
+            value_id = self._value_ids[key] = len(self._values)
+            self._values.append(value)
+        return value_id
+
+    def append(self, lap_num, position, laptime, driver, timestamp, flag, tyre):
+        self.lap_nums.append(lap_num)
+        self.positions.append(position)
+        self.laptimes.append(laptime)
+        self.timestamps.append(timestamp)
+        self.flags.append(flag)
+        self.drivers.append(self._intern(driver))
+        self.tyres.append(self._intern(tyre))
+        return Lap(self, len(self.laptimes) - 1)
+
+    def adopt(self, lap):
+        '''
+        Moves a Lap from another store into this one.
+        '''
+        moved = self.append(lap.lap_num, lap.position, lap.laptime, lap.driver, lap.timestamp, lap.flag, lap.tyre)
+        lap._store = self
+        lap._index = moved._index
+
+    def __len__(self):
+        return len(self.laptimes)
+
+    def __iter__(self):
+        return (Lap(self, idx) for idx in range(len(self.laptimes)))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [Lap(self, i) for i in range(*idx.indices(len(self.laptimes)))]
+        if idx < 0:
+            idx += len(self.laptimes)
+        if not 0 <= idx < len(self.laptimes):
+            raise IndexError('lap index out of range')
+        return Lap(self, idx)
+
+
 class Lap(object):
-    def __init__(self, lap_num, position, laptime, driver, timestamp, flag, tyre):
-        self.lap_num = lap_num
-        self.laptime = laptime
-        self.position = position
-        self.driver = driver
-        self.timestamp = timestamp
-        self.flag = flag
-        self.tyre = tyre
+    '''
+    A view of one lap in a LapStore.
+    '''
+    __slots__ = ['_store', '_index']
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    def __reduce__(self):
+        return (Lap, (self._store, self._index))
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Pickled before laps were stored by column; the car this lap
+            # belongs to will adopt it into its own store.
+            store = LapStore()
+            store.append(state['lap_num'], state['position'], state['laptime'], state['driver'], state['timestamp'], state['flag'], state['tyre'])
+            state = {'_store': store, '_index': 0}
+        _restore_slots(self, state)
+
+    @property
+    def lap_num(self):
+        return self._store.lap_nums[self._index]
+
+    @property
+    def position(self):
+        return self._store.positions[self._index]
+
+    @property
+    def laptime(self):
+        return self._store.laptimes[self._index]
+
+    @property
+    def driver(self):
+        return self._store._values[self._store.drivers[self._index]]
+
+    @property
+    def timestamp(self):
+        return self._store.timestamps[self._index]
+
+    @property
+    def flag(self):
+        return FlagStatus(self._store.flags[self._index])
+
+    @property
+    def tyre(self):
+        return self._store._values[self._store.tyres[self._index]]
 
     def for_json(self):
         return [
             # self.lap_num,
-            self.laptime,
+            self._store.laptimes[self._index],
             # self.position,
             # self.driver,
             # self.timestamp,
-            self.flag,
+            self._store.flags[self._index],
             # self.tyre
         ]
 
     def __repr__(self, *args, **kwargs):
-        return "<Lap {}: {} pos {} {} {} {}>".format(*self.for_json())
+        return "<Lap {}: {} pos {} {} {} {}>".format(
+            self.lap_num,
+            self.laptime,
+            self.position,
+            self.driver,
+            self.flag,
+            self.tyre
+        )
 
 
 class Stint(object):
+    __slots__ = [
+        'start_lap', 'start_time', 'driver', 'end_lap', 'end_time', 'in_progress', 'tyre',
+        '_store', '_first_lap', '_lap_count', '_best_lap_time', '_yellow_laps', '_laptime_sum', '_legacy_laps'
+    ]
+
     def __init__(self, start_lap, start_time, driver, flag=FlagStatus.NONE, tyre=None):
         self.start_lap = start_lap
         self.start_time = start_time
@@ -55,8 +221,59 @@ class Stint(object):
         self.end_lap = None
         self.end_time = None
         self.in_progress = True
-        self.laps = []
         self.tyre = tyre
+        self._legacy_laps = None
+        self._reset_laps()
+
+    def _reset_laps(self):
+        # A stint's laps are consecutive laps in its car's LapStore
+        self._store = None
+        self._first_lap = 0
+        self._lap_count = 0
+        self._best_lap_time = None
+        self._yellow_laps = 0
+        # Total of all laps except the first (out lap)
+        self._laptime_sum = 0
+
+    def __setstate__(self, state):
+        if isinstance(state, dict) and 'laps' in state:
+            # Pickled before laps were stored by column; our car will
+            # adopt the laps once it has moved them into its LapStore.
+            state = dict(state)
+            self._legacy_laps = state.pop('laps')
+            self._reset_laps()
+            for key in ['_best_lap_time', '_yellow_laps', '_laptime_sum']:
+                state.pop(key, None)
+        else:
+            self._legacy_laps = None
+        _restore_slots(self, state)
+
+    def _adopt_legacy_laps(self):
+        laps = self._legacy_laps
+        self._legacy_laps = None
+        self._reset_laps()
+        for lap in laps:
+            self.add_lap(lap)
+
+    def add_lap(self, lap):
+        if self._lap_count == 0:
+            self._store = lap._store
+            self._first_lap = lap._index
+        else:
+            self._laptime_sum += lap.laptime
+        self._lap_count += 1
+        if self._best_lap_time is None or lap.laptime < self._best_lap_time:
+            self._best_lap_time = lap.laptime
+        if lap.flag >= FlagStatus.YELLOW:
+            self._yellow_laps += 1
+
+    @property
+    def laps(self):
+        if self._legacy_laps is not None:
+            return self._legacy_laps
+        if self._store is None:
+            return []
+        return self._store[self._first_lap:self._first_lap + self._lap_count]
 
     def finish(self, end_lap, end_time):
         self.end_lap = end_lap
@@ -65,24 +282,25 @@ class Stint(object):
 
     @property
     def yellow_laps(self):
-        return len([lap for lap in self.laps if lap.flag >= FlagStatus.YELLOW])
+        return self._yellow_laps
 
     @property
     def best_lap_time(self):
-        return min([lap.laptime for lap in self.laps]) if len(self.laps) > 0 else None
+        return self._best_lap_time
 
     @property
     def average_lap_time(self):
-        if len(self.laps) == 1:
+        if self._lap_count == 1:
             return None
         if self.in_progress:
             # Exclude first lap (out lap)
-            return sum([lap.laptime for lap in self.laps[1:]]) / (len(self.laps) - 1)
+            return self._laptime_sum / (self._lap_count - 1)
         else:
             # Exclude first (out) and last (in) laps
-            if len(self.laps) == 2:
+            if self._lap_count == 2:
                 return None
-            return sum([lap.laptime for lap in self.laps[1:-1]]) / (len(self.laps) - 2)
+            last_lap_time = self._store.laptimes[self._first_lap + self._lap_count - 1] if self._lap_count else 0
+            return (self._laptime_sum - last_lap_time) / (self._lap_count - 2)
 
     def __repr__(self, *args, **kwargs):
         return "<Stint: {} laps {}-{} time {}-{} yellows {} in progress? {} >".format(
@@ -97,9 +315,14 @@ class Stint(object):
 
 
 class Car(object):
+    __slots__ = [
+        'race_num', 'laps', 'stints', 'inPit', 'current_lap', '_current_lap_flags', 'initial_driver',
+        'fuel_times', 'last_pass', 'drivers', 'messages', 'race_class', 'team', 'vehicle'
+    ]
+
     def __init__(self, race_num):
         self.race_num = race_num
-        self.laps = []
+        self.laps = LapStore()
         self.stints = []
         self.inPit = True
         self.current_lap = 1
@@ -124,28 +347,30 @@ class Car(object):
         if laptime > 0:
             # Some services e.g. F1 don't give a laptime for the first lap.
             # We still want to consider flags for the stint though.
-            self.laps.append(
-                Lap(
-                    self.current_lap,
-                    position,
-                    laptime,
-                    driver,
-                    timestamp,
-                    max_flag,
-                    tyre
-                )
-            )
+            lap = self.laps.append(self.current_lap, position, laptime, driver, timestamp, max_flag, tyre)
 
             if self.inPit and self.stints:
                 # Sometimes the finish line is crossed in the pit lane - the lap should be added to the previous stint
                 prev_stint = self.stints[-1]
-                prev_stint.laps.append(self.laps[-1])
+                prev_stint.add_lap(lap)
                 prev_stint.end_lap = self.current_lap
             elif self.current_stint:
-                self.current_stint.laps.append(self.laps[-1])
+                self.current_stint.add_lap(lap)
         self._current_lap_flags = [current_flag]
         self.last_pass = timestamp
 
+    def __setstate__(self, state):
+        _restore_slots(self, state)
+        if not isinstance(self.laps, LapStore):
+            # Pickled before laps were stored by column
+            laps = self.laps
+            self.laps = LapStore()
+            for lap in laps:
+                self.laps.adopt(lap)
+            for stint in self.stints:
+                if stint._legacy_laps is not None:
+                    stint._adopt_legacy_laps()
+
     def see_flag(self, flag):
         self._current_lap_flags.append(flag)
 
@@ -195,6 +420,8 @@ class Car(object):
 
 
 class Session(object):
+    __slots__ = ['_flag_periods', 'lap_flags', 'this_period']
+
     def __init__(self):
         self._flag_periods = []
         self.lap_flags = {}
@@ -207,6 +434,9 @@ class Session(object):
         if not self.this_period or self.this_period[0] != newFlag:
             self.this_period = [newFlag, leaderLap, timestamp]
 
+    def __setstate__(self, state):
+        _restore_slots(self, state)
+
     @property
     def flag_periods(self):
         if self.this_period:
@@ -232,9 +462,16 @@ class DataCentre(object):
         self.current_state = {"cars": [], "session": {"flagState": "none"}, "messages": []}
         self.column_spec = []
         self.leader_lap = 0
+        # The leader lap last published with the session data
+        self.reported_leader_lap = 0
         self.lap_chart = LaptimeChart()
         self.messages = []
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Pickled before the reported leader lap was kept here
+        self.__dict__.setdefault('reported_leader_lap', self.leader_lap)
+
     def flag_change(self, new_flag, timestamp):
         self.session.flag_change(new_flag, self.leader_lap, timestamp)
         for car in list(self._cars.values()):
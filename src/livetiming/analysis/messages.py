@@ -1,4 +1,4 @@
-def receive_state_update(dc, old_state, new_state, colspec, timestamp, new_messages):
+def receive_state_update(dc, old_state, new_state, colspec, timestamp, new_messages, pairing=None):
     # Only consider messages with no car identified
     relevant_messages = [m for m in new_messages if _message_is_relevant(m)]
     dc.messages = relevant_messages + dc.messages
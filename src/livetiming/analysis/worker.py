@@ -0,0 +1,192 @@
+from collections import deque
+from twisted.internet import reactor
+from twisted.logger import Logger
+
+import threading
+import time
+
+
+DEFAULT_MAX_BACKLOG = 10
+
+
+class OverloadPolicy:
+    MERGE = 'merge'
+    FAIL = 'fail'
+
+
+class AnalysisBacklogFull(Exception):
+    pass
+
+
+class _QueuedUpdate(object):
+    def __init__(self, state, colspec, timestamp, new_messages):
+        self.state = state
+        self.colspec = colspec
+        self.timestamp = timestamp
+        self.new_messages = new_messages
+        self.submitted = time.time()
+
+    def merge(self, newer):
+        # The newer state supersedes ours, but we must not lose any messages
+        # (which are ordered newest-first) nor the time we were queued at.
+        self.state = newer.state
+        self.colspec = newer.colspec
+        self.timestamp = newer.timestamp
+        self.new_messages = newer.new_messages + self.new_messages
+
+
+class _QueuedCall(object):
+    def __init__(self, func):
+        self.func = func
+
+
+class AnalysisWorker(object):
+    '''
+    Feeds state updates to an Analyser one at a time, strictly in the
+    order they were submitted, using the reactor's thread pool so that
+    analysis never blocks the reactor.
+
+    At most `max_backlog` updates may be waiting at any time. When the
+    backlog is full, the `merge` overload policy folds the new update
+    into the most recently queued one (keeping the newer state and the
+    messages from both), whereas `fail` raises AnalysisBacklogFull.
+
+    Other work on the analyser's data (such as resetting it) can be
+    queued with call(), so that it too happens in order and off the
+    reactor.
+    '''
+    log = Logger()
+
+    def __init__(self, analyser, max_backlog=DEFAULT_MAX_BACKLOG, overload_policy=OverloadPolicy.MERGE, metrics=None):
+        if overload_policy not in [OverloadPolicy.MERGE, OverloadPolicy.FAIL]:
+            raise ValueError('Unknown overload policy {}'.format(overload_policy))
+
+        self.analyser = analyser
+        self.max_backlog = max(1, max_backlog)
+        self.overload_policy = overload_policy
+        self.metrics = metrics
+
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._draining = False
+        self._stopped = False
+
+        self.processed = 0
+        self.merged = 0
+        self.rejected = 0
+        self.last_lag = None
+        self.max_lag = 0
+
+        analyser.worker = self
+
+    def submit(self, state, colspec, timestamp=None, new_messages=[]):
+        update = _QueuedUpdate(state, colspec, timestamp or time.time(), new_messages)
+
+        with self._lock:
+            if self._stopped:
+                return False
+
+            if len(self._queue) >= self.max_backlog and isinstance(self._queue[-1], _QueuedUpdate):
+                if self.overload_policy == OverloadPolicy.FAIL:
+                    self.rejected += 1
+                    raise AnalysisBacklogFull(
+                        'Analysis backlog full ({} updates waiting)'.format(len(self._queue))
+                    )
+                self._queue[-1].merge(update)
+                self.merged += 1
+            else:
+                self._queue.append(update)
+
+            self._start_draining()
+        return True
+
+    def call(self, func):
+        '''
+        Queues `func` to be called from the worker thread once all updates
+        submitted so far have been analysed. Returns False (and does not
+        call `func`) if the worker has been stopped.
+        '''
+        with self._lock:
+            if self._stopped:
+                return False
+            self._queue.append(_QueuedCall(func))
+            self._start_draining()
+        return True
+
+    def _start_draining(self):
+        # Call with self._lock held
+        if not self._draining:
+            self._draining = True
+            reactor.callInThread(self._drain)
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                if self._stopped or not self._queue:
+                    self._draining = False
+                    return
+                update = self._queue.popleft()
+
+            if isinstance(update, _QueuedCall):
+                try:
+                    update.func()
+                except Exception:
+                    self.log.failure('Exception in queued analysis call: {log_failure}')
+                reactor.callFromThread(self.analyser._publish_pending)
+                continue
+
+            start = time.time()
+            try:
+                self.analyser.receiveStateUpdate(
+                    update.state,
+                    update.colspec,
+                    update.timestamp,
+                    new_messages=update.new_messages
+                )
+            except Exception:
+                self.log.failure('Exception while analysing state update: {log_failure}')
+            if self.metrics:
+                self.metrics.observe('analysis', time.time() - start)
+
+            lag = time.time() - update.submitted
+            with self._lock:
+                self.processed += 1
+                self.last_lag = lag
+                self.max_lag = max(self.max_lag, lag)
+
+            reactor.callFromThread(self.analyser._publish_pending)
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            discarded = len(self._queue)
+            self._queue.clear()
+        if discarded:
+            self.log.warn('Discarded {count} unprocessed analysis updates', count=discarded)
+
+    @property
+    def backlog(self):
+        return len([u for u in list(self._queue) if isinstance(u, _QueuedUpdate)])
+
+    @property
+    def current_lag(self):
+        '''
+        Age, in seconds, of the oldest update still waiting to be analysed.
+        '''
+        for update in list(self._queue):
+            if isinstance(update, _QueuedUpdate):
+                return time.time() - update.submitted
+        return 0
+
+    def stats(self):
+        return {
+            'backlog': self.backlog,
+            'maxBacklog': self.max_backlog,
+            'overloadPolicy': self.overload_policy,
+            'processed': self.processed,
+            'merged': self.merged,
+            'rejected': self.rejected,
+            'currentLag': self.current_lag,
+            'lastLag': self.last_lag,
+            'maxLag': self.max_lag
+        }
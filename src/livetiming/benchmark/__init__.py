@@ -0,0 +1,224 @@
+'''
+End-to-end benchmark of the service pipeline: runs the synthetic
+service in standalone mode with a local WebSocket client, and reports
+sustained update rate, publish latency, CPU usage and memory.
+'''
+from autobahn.twisted.websocket import WebSocketClientFactory, WebSocketClientProtocol, connectWS
+from livetiming.network import RPC
+from livetiming.service import parse_args
+from livetiming.service.standalone import StandaloneSession
+from twisted.internet import reactor
+
+from .synthetic import Service
+
+import argparse
+import os
+import resource
+import shutil
+import simplejson
+import sys
+import tempfile
+import time
+
+
+def parse_benchmark_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the service pipeline using a synthetic timing feed.',
+        epilog='Other arguments (e.g. --cars, --rate) are passed to the synthetic service; see --help-service.'
+    )
+
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to measure for')
+    parser.add_argument('--warmup', type=float, default=5, help='Seconds to run before measuring')
+    parser.add_argument('--disable-analysis', action='store_true', help='Benchmark without analysis')
+    parser.add_argument('--record', action='store_true', help='Also write a recording (to a temporary directory)')
+    parser.add_argument('--json', action='store_true', help='Output results as JSON')
+    parser.add_argument('--help-service', action='store_true', help='Show options for the synthetic service')
+
+    return parser.parse_known_args(args)
+
+
+def _percentile(ordered, pct):
+    if not ordered:
+        return None
+    idx = min(len(ordered) - 1, max(0, int(round(len(ordered) * pct / 100.0)) - 1))
+    return ordered[idx]
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _current_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _max_rss():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class Benchmark(object):
+    '''
+    Acts as the service's host: when the service starts, a standalone
+    server is started for it and a client connected, which records the
+    latency of each state update received (from the time its message
+    was created).
+    '''
+    def __init__(self, service, duration, warmup):
+        self.service = service
+        self.duration = duration
+        self.warmup = warmup
+        self.result = None
+
+        self._measuring = False
+        self._latencies = []
+        self._received = 0
+        self._bytes_received = 0
+
+        service.host = self
+
+    def attach(self, service):
+        self.session = StandaloneSession(service)
+        port = self.session.listen(0)
+
+        benchmark = self
+        state_channel = RPC.STATE_PUBLISH.format(service.uuid)
+
+        class BenchmarkClientProtocol(WebSocketClientProtocol):
+            def onMessage(self, payload, isBinary):
+                benchmark._on_message(payload, state_channel)
+
+        factory = WebSocketClientFactory('ws://127.0.0.1:{}'.format(port))
+        factory.protocol = BenchmarkClientProtocol
+        connectWS(factory)
+
+    def _on_message(self, payload, state_channel):
+        if not self._measuring:
+            return
+        channel, message = simplejson.loads(payload)
+        self._bytes_received += len(payload)
+        if channel == state_channel:
+            self._received += 1
+            self._latencies.append(time.time() * 1000 - message['date'])
+
+    def _start_measuring(self):
+        self._measuring = True
+        self._start_time = time.time()
+        self._start_cpu = _cpu_seconds()
+        self._start_updates = self.service.metrics.counters['updates']
+        reactor.callLater(self.duration, self._finish)
+
+    def _finish(self):
+        elapsed = time.time() - self._start_time
+        cpu = _cpu_seconds() - self._start_cpu
+        self._measuring = False
+
+        latencies = sorted(self._latencies)
+        timings = self.service.metrics.snapshot()['timings']
+
+        self.result = {
+            'cars': self.service.options.cars,
+            'targetRate': self.service.options.rate,
+            'duration': elapsed,
+            'updatesGenerated': self.service.metrics.counters['updates'] - self._start_updates,
+            'updatesReceived': self._received,
+            'updatesPerSecond': self._received / elapsed,
+            'bytesPerSecond': self._bytes_received / elapsed,
+            'latencyP50': _percentile(latencies, 50),
+            'latencyP99': _percentile(latencies, 99),
+            'pipelineP50': timings.get('update_and_publish', {}).get('p50'),
+            'pipelineP99': timings.get('update_and_publish', {}).get('p99'),
+            'analysisP50': timings.get('analysis', {}).get('p50'),
+            'analysisP99': timings.get('analysis', {}).get('p99'),
+            'cpuPercent': 100 * cpu / elapsed,
+            'rss': _current_rss(),
+            'maxRSS': _max_rss()
+        }
+        self.service.stop()
+        reactor.stop()
+
+    def run(self):
+        self.service.start()  # Calls back to attach()
+        reactor.callLater(self.warmup, self._start_measuring)
+        reactor.run()
+        return self.result
+
+
+def _format_ms(value):
+    return '-' if value is None else '{:.1f}ms'.format(value)
+
+
+def _format_secs(value):
+    return '-' if value is None else '{:.1f}ms'.format(value * 1000)
+
+
+def _format_bytes(value):
+    return '-' if value is None else '{:.1f}MiB'.format(value / (1024.0 * 1024))
+
+
+def print_result(result):
+    print('Synthetic field of {} cars at {:g} updates/s, measured for {:.1f}s'.format(
+        result['cars'], result['targetRate'], result['duration']
+    ))
+    print('  Updates:    {:.1f}/s sustained ({} generated, {} received)'.format(
+        result['updatesPerSecond'], result['updatesGenerated'], result['updatesReceived']
+    ))
+    print('  Latency:    p50 {}, p99 {} (message creation to client)'.format(
+        _format_ms(result['latencyP50']), _format_ms(result['latencyP99'])
+    ))
+    print('  Pipeline:   p50 {}, p99 {} (update and publish)'.format(
+        _format_secs(result['pipelineP50']), _format_secs(result['pipelineP99'])
+    ))
+    print('  Analysis:   p50 {}, p99 {}'.format(
+        _format_secs(result['analysisP50']), _format_secs(result['analysisP99'])
+    ))
+    print('  Bandwidth:  {:.1f}KiB/s'.format(result['bytesPerSecond'] / 1024))
+    print('  CPU:        {:.0f}%'.format(result['cpuPercent']))
+    print('  Memory:     {} RSS, {} peak'.format(_format_bytes(result['rss']), _format_bytes(result['maxRSS'])))
+
+
+def main(argv=None):
+    args, service_argv = parse_benchmark_args(argv)
+
+    if args.help_service:
+        from .synthetic import parse_extra_args
+        parse_extra_args(['--help'])
+
+    recording_dir = tempfile.mkdtemp(prefix='livetiming-benchmark-') if args.record else None
+    analysis_dir = tempfile.mkdtemp(prefix='livetiming-benchmark-analysis-')
+    os.environ['LIVETIMING_ANALYSIS_DIR'] = analysis_dir
+
+    try:
+        service_args = ['synthetic', '--standalone', '--no-write-state', '--metrics']
+        if args.disable_analysis:
+            service_args.append('--disable-analysis')
+        if recording_dir:
+            service_args += ['--recording-file', os.path.join(recording_dir, 'benchmark.zip')]
+
+        parsed_args, extra_args = parse_args(service_args + service_argv)
+        service = Service(parsed_args, extra_args)
+
+        result = Benchmark(service, args.duration, args.warmup).run()
+    finally:
+        shutil.rmtree(analysis_dir, ignore_errors=True)
+        if recording_dir:
+            shutil.rmtree(recording_dir, ignore_errors=True)
+
+    if result is None:
+        # The reactor stopped (e.g. interrupted, or the service failed) before we finished measuring
+        print('Benchmark stopped before any results were recorded', file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        print(simplejson.dumps(result))
+    else:
+        print_result(result)
+
+
+if __name__ == '__main__':
+    main()
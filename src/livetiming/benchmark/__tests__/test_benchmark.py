@@ -0,0 +1,38 @@
+from livetiming import benchmark
+
+import livetiming
+import os
+import pytest
+import simplejson
+import subprocess
+import sys
+
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(livetiming.__file__)))
+
+RUN_BENCHMARK = '''
+from livetiming.benchmark import main
+main(['--duration', '1', '--warmup', '0.5', '--json', '--cars', '4', '--rate', '20', '--seed', '1'])
+'''
+
+
+def test_benchmark_runs_synthetic_service(tmp_path):
+    env = dict(os.environ, PYTHONPATH=SRC_DIR, HOME=str(tmp_path))
+    env.pop('LIVETIMING_ROUTER', None)
+    output = subprocess.check_output([sys.executable, '-c', RUN_BENCHMARK], env=env, cwd=str(tmp_path), timeout=60)
+    result = simplejson.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    assert result['cars'] == 4
+    assert result['updatesGenerated'] > 0
+    assert result['updatesReceived'] > 0
+    assert result['latencyP50'] is not None
+
+
+def test_no_result_if_stopped_early(monkeypatch, capsys):
+    monkeypatch.setattr(benchmark.Benchmark, 'run', lambda self: None)
+    monkeypatch.setenv('LIVETIMING_ANALYSIS_DIR', '')  # Restored afterwards; main() changes it
+
+    with pytest.raises(SystemExit) as e:
+        benchmark.main(['--duration', '1', '--disable-analysis', '--cars', '2'])
+    assert e.value.code == 1
+    assert 'stopped before' in capsys.readouterr().err
@@ -0,0 +1,29 @@
+from livetiming.benchmark.synthetic import Service
+from livetiming.service import parse_args
+
+
+def create_service(extra_args=[]):
+    args, extra = parse_args(['synthetic', '--disable-analysis', '--no-write-state'] + extra_args)
+    return Service(args, extra)
+
+
+def test_rows_match_column_spec():
+    service = create_service(['--cars', '12', '--sectors', '4', '--seed', '1'])
+    colspec = service.getColumnSpec()
+
+    for _ in range(200):
+        state = service.getRaceState()
+
+    assert len(state['cars']) == 12
+    for car in state['cars']:
+        assert len(car) == len(colspec)
+    assert state['session']['timeElapsed'] == 200
+    assert any(car[4] > 0 for car in state['cars'])
+
+
+def test_seed_is_reproducible():
+    first = create_service(['--seed', '42'])
+    second = create_service(['--seed', '42'])
+
+    for _ in range(100):
+        assert first.getRaceState() == second.getRaceState()
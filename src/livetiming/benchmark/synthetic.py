@@ -0,0 +1,224 @@
+from livetiming.racing import FlagStatus, Stat
+from livetiming.service import BaseService
+
+import argparse
+import random
+
+
+CAUTION_FLAGS = [FlagStatus.YELLOW, FlagStatus.FCY, FlagStatus.SC]
+SECTOR_STATS = [Stat.S1, Stat.S2, Stat.S3, Stat.S4, Stat.S5]
+
+
+def parse_extra_args(extra_args):
+    parser = argparse.ArgumentParser(description='Synthetic timing feed for benchmarking.')
+
+    parser.add_argument('--cars', type=int, default=40, help='Number of cars')
+    parser.add_argument('--classes', type=int, default=3, help='Number of classes')
+    parser.add_argument('--sectors', type=int, default=3, choices=range(1, 6), help='Number of sectors per lap')
+    parser.add_argument('--rate', type=float, default=10, help='State updates per second')
+    parser.add_argument('--step', type=float, default=1, help='Seconds of race time simulated per update')
+    parser.add_argument('--lap-time', type=float, default=90, help='Typical lap time, in seconds')
+    parser.add_argument('--pit-probability', type=float, default=0.03, help='Chance of a car pitting at the end of each lap')
+    parser.add_argument('--driver-change-probability', type=float, default=0.5, help='Chance of a driver change at each pit stop')
+    parser.add_argument('--pit-time', type=float, default=40, help='Time spent in the pits, in seconds')
+    parser.add_argument('--flag-period', type=float, default=600, help='Average race time between caution periods, in seconds (0 for none)')
+    parser.add_argument('--duration', type=float, default=6 * 3600, help='Race length, in seconds')
+    parser.add_argument('--seed', type=int, help='Random seed, for reproducible runs')
+
+    return parser.parse_args(extra_args)
+
+
+class _SyntheticCar(object):
+    def __init__(self, idx, options, rand):
+        self.num = str(idx + 1)
+        self.clazz = 'C{}'.format(idx % max(1, options.classes) + 1)
+        self.drivers = ['Driver {}{}'.format(self.num, letter) for letter in 'ABC']
+        self.driver_idx = 0
+        self.pace = options.lap_time * (1 + 0.1 * (idx % max(1, options.classes)) + rand.uniform(0, 0.03))
+
+        self.state = 'RUN'
+        self.laps = 0
+        self.sector = 0
+        self.sector_elapsed = rand.uniform(0, self.pace / options.sectors)
+        self.sector_target = self._sector_time(options, rand, FlagStatus.GREEN)
+        self.current_sectors = [None] * options.sectors
+        self.best_sectors = [None] * options.sectors
+        self.last_lap = None
+        self.lap_elapsed = self.sector_elapsed
+        self.best_lap = None
+        self.pits = 0
+        self.pit_remaining = 0
+
+    def _sector_time(self, options, rand, flag):
+        slowdown = 1.4 if flag in CAUTION_FLAGS else 1
+        return self.pace / options.sectors * rand.uniform(0.98, 1.04) * slowdown
+
+    @property
+    def distance(self):
+        return self.laps + (self.sector + min(1, self.sector_elapsed / self.sector_target)) / len(self.current_sectors)
+
+    def advance(self, step, options, rand, flag, bests):
+        if self.pit_remaining > 0:
+            self.pit_remaining -= step
+            if self.pit_remaining <= 0:
+                self.state = 'OUT'
+                if rand.random() < options.driver_change_probability:
+                    self.driver_idx = (self.driver_idx + 1) % len(self.drivers)
+            return
+
+        self.sector_elapsed += step
+        self.lap_elapsed += step
+
+        while self.sector_elapsed >= self.sector_target:
+            sector_time = round(self.sector_target, 3)
+            self.current_sectors[self.sector] = sector_time
+            if self.best_sectors[self.sector] is None or sector_time < self.best_sectors[self.sector]:
+                self.best_sectors[self.sector] = sector_time
+            if bests['sectors'][self.sector] is None or sector_time < bests['sectors'][self.sector]:
+                bests['sectors'][self.sector] = sector_time
+
+            self.sector_elapsed -= self.sector_target
+            self.sector_target = self._sector_time(options, rand, flag)
+            self.sector += 1
+
+            if self.sector == len(self.current_sectors):
+                self._complete_lap(options, rand, bests)
+                if self.state == 'PIT':
+                    return
+
+    def _complete_lap(self, options, rand, bests):
+        lap_time = round(sum(self.current_sectors), 3)
+        self.laps += 1
+        self.sector = 0
+        self.lap_elapsed = self.sector_elapsed
+        self.last_lap = lap_time
+        self.current_sectors = [None] * len(self.current_sectors)
+
+        if self.best_lap is None or lap_time < self.best_lap:
+            self.best_lap = lap_time
+        if bests['lap'] is None or lap_time < bests['lap']:
+            bests['lap'] = lap_time
+
+        if self.state == 'OUT':
+            self.state = 'RUN'
+        elif rand.random() < options.pit_probability:
+            self.state = 'PIT'
+            self.pits += 1
+            self.pit_remaining = options.pit_time * rand.uniform(0.9, 1.3)
+            self.sector_elapsed = 0
+
+    def as_row(self, gap, interval, bests):
+        def timed(value, best, overall_best):
+            if value is None:
+                return ['', '']
+            if value == overall_best:
+                return [value, 'sb']
+            if value == best:
+                return [value, 'pb']
+            return [value, '']
+
+        sectors = [
+            timed(s, self.best_sectors[idx], bests['sectors'][idx])
+            for idx, s in enumerate(self.current_sectors)
+        ]
+        return [
+            self.num,
+            self.state,
+            self.clazz,
+            self.drivers[self.driver_idx],
+            self.laps,
+            gap,
+            interval
+        ] + sectors + [
+            timed(self.last_lap, self.best_lap, bests['lap']),
+            timed(self.best_lap, self.best_lap, bests['lap']),
+            self.pits
+        ]
+
+
+class Service(BaseService):
+    '''
+    Generates a synthetic race - a field of cars completing sectors and
+    laps, pitting, changing drivers and running under caution flags -
+    at a configurable rate, for benchmarking the service pipeline.
+    '''
+    def __init__(self, args, extra_args={}):
+        self.options = parse_extra_args(extra_args)
+        super().__init__(args, extra_args)
+
+        self._random = random.Random(self.options.seed)
+        self._cars = [_SyntheticCar(idx, self.options, self._random) for idx in range(self.options.cars)]
+        self._bests = {'lap': None, 'sectors': [None] * self.options.sectors}
+        self._elapsed = 0
+        self._flag = FlagStatus.GREEN
+        self._flag_remaining = 0
+
+    def getName(self):
+        return 'Synthetic'
+
+    def getDefaultDescription(self):
+        return 'Synthetic benchmark feed ({} cars)'.format(self.options.cars)
+
+    def getVersion(self):
+        return 'benchmark'
+
+    def getPollInterval(self):
+        return 1.0 / self.options.rate
+
+    def getColumnSpec(self):
+        return [
+            Stat.NUM,
+            Stat.STATE,
+            Stat.CLASS,
+            Stat.DRIVER,
+            Stat.LAPS,
+            Stat.GAP,
+            Stat.INT
+        ] + SECTOR_STATS[0:self.options.sectors] + [
+            Stat.LAST_LAP,
+            Stat.BEST_LAP,
+            Stat.PITS
+        ]
+
+    def _advance_flag(self, step):
+        if self._flag_remaining > 0:
+            self._flag_remaining -= step
+            if self._flag_remaining <= 0:
+                self._flag = FlagStatus.GREEN
+        elif self.options.flag_period and self._random.random() < step / self.options.flag_period:
+            self._flag = self._random.choice(CAUTION_FLAGS)
+            self._flag_remaining = self._random.uniform(60, 300)
+
+    def _gap(self, distance, leader_distance, lap_time):
+        laps_down = int(leader_distance - distance)
+        if laps_down >= 1:
+            return '{} lap{}'.format(laps_down, '' if laps_down == 1 else 's')
+        return round((leader_distance - distance) * lap_time, 3)
+
+    def getRaceState(self):
+        step = self.options.step
+        self._elapsed += step
+        self._advance_flag(step)
+
+        for car in self._cars:
+            car.advance(step, self.options, self._random, self._flag, self._bests)
+
+        ordered = sorted(self._cars, key=lambda c: -c.distance)
+        leader_distance = ordered[0].distance if ordered else 0
+        cars = []
+        prev_distance = leader_distance
+        for car in ordered:
+            distance = car.distance
+            gap = self._gap(distance, leader_distance, self.options.lap_time) if car is not ordered[0] else ''
+            interval = self._gap(distance, prev_distance, self.options.lap_time) if car is not ordered[0] else ''
+            cars.append(car.as_row(gap, interval, self._bests))
+            prev_distance = distance
+
+        return {
+            'cars': cars,
+            'session': {
+                'flagState': self._flag.name.lower(),
+                'timeElapsed': self._elapsed,
+                'timeRemain': max(0, self.options.duration - self._elapsed)
+            }
+        }
@@ -1,5 +1,5 @@
 from datetime import date, datetime
-from livetiming.racing import Stat
+from livetiming.racing import ColumnSpec, Stat
 
 import copy
 
@@ -36,20 +36,17 @@ class FlagEvent(Event):
 class CarEvent(Event):
     def __init__(self, timestamp, colspec, race_num):
         super().__init__(timestamp)
-        self._colspec = colspec
+        self._colspec = ColumnSpec.of(colspec)
         self._race_num = race_num
 
     def _get_car(self, state):
         return copy.copy(state['cars'][self._race_num])
 
     def _get_field(self, car, field):
-        if field in self._colspec:
-            return car[self._colspec.index(field)]
-        return None
+        return self._colspec.get(car, field)
 
     def _set_field(self, car, field, value):
-        if field in self._colspec:
-            car[self._colspec.index(field)] = value
+        self._colspec.set(car, field, value)
 
     def _updated_state(self, state, car):
         new_state = copy.deepcopy(state)
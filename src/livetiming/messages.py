@@ -2,7 +2,7 @@ import re
 import time
 
 from .racing import FlagStatus
-from livetiming.racing import Stat
+from livetiming.racing import ColumnSpec, Stat
 from twisted.logger import Logger
 
 
@@ -25,40 +25,70 @@ class TimingMessage(object):
         return []
 
 
+class CarPairs(object):
+    '''
+    Pairs each car in a new state with its row in the previous state, by
+    race number, car and class. The service builds this once per update
+    and passes it to each per-car message generator, so that the cars are
+    paired once rather than once per generator.
+    '''
+    log = Logger()
+
+    def __init__(self, oldState, newState, columnSpec):
+        self.columnSpec = ColumnSpec.of(columnSpec) if columnSpec else None
+        self.pairs = []
+        if not self.columnSpec:
+            return
+
+        oldCarsByIdentity = {}
+        for oldCar in oldState["cars"]:
+            oldCarsByIdentity.setdefault(self._identify(oldCar), []).append(oldCar)
+
+        for newCar in newState["cars"]:
+            oldCars = oldCarsByIdentity.get(self._identify(newCar), [])
+            if len(oldCars) == 1:
+                self.pairs.append((oldCars[0], newCar))
+            elif len(oldCars) > 0:
+                self.log.warn('Found {count} cars with race number {num} that are indistinguishable!', count=len(oldCars), num=newCar[0])
+
+    def _identify(self, car):
+        return (
+            self.columnSpec.get(car, Stat.NUM),
+            self.columnSpec.get(car, Stat.CAR),
+            self.columnSpec.get(car, Stat.CLASS)
+        )
+
+    def __iter__(self):
+        return iter(self.pairs)
+
+
 class PerCarMessage(TimingMessage):
     def __init__(self, columnSpec=None):
         self.columnSpec = columnSpec
 
+    @property
+    def columnSpec(self):
+        return self._columnSpec
+
+    @columnSpec.setter
+    def columnSpec(self, columnSpec):
+        self._columnSpec = columnSpec
+        self._compiledSpec = ColumnSpec.of(columnSpec) if columnSpec else None
+
     def getValue(self, car, stat, default=None):
-        if self.columnSpec and stat in self.columnSpec:
-            idx = self.columnSpec.index(stat)
-            if idx < len(car):
-                return car[idx]
+        if self._compiledSpec:
+            return self._compiledSpec.get(car, stat, default)
         return default
 
-    def process(self, oldState, newState):
+    def process(self, oldState, newState, pairing=None):
         messages = []
-        if Stat.NUM in self.columnSpec:
-            for newCar in newState["cars"]:
-                wanted_num = self.getValue(newCar, Stat.NUM)
-                wanted_car = self.getValue(newCar, Stat.CAR)
-                wanted_clazz = self.getValue(newCar, Stat.CLASS)
-                oldCars = [
-                    c for c in oldState["cars"] if self.getValue(c, Stat.NUM) == wanted_num
-                    and self.getValue(c, Stat.CAR) == wanted_car
-                    and self.getValue(c, Stat.CLASS) == wanted_clazz
-                ]
-                oldCar = None
-
-                if len(oldCars) == 1:
-                    oldCar = oldCars[0]
-                elif len(oldCars) > 0:
-                    self.log.warn('Found {count} cars with race number {num} that are indistinguishable!', count=len(oldCars), num=newCar[0])
-
-                if oldCar:
-                    msg = self._consider(oldCar, newCar)
-                    if msg:
-                        messages += [[int(time.time())] + msg + [newCar[0]]]
+        if self._compiledSpec and Stat.NUM in self._compiledSpec:
+            if pairing is None or pairing.columnSpec is not self._compiledSpec:
+                pairing = CarPairs(oldState, newState, self._compiledSpec)
+            for oldCar, newCar in pairing:
+                msg = self._consider(oldCar, newCar)
+                if msg:
+                    messages += [[int(time.time())] + msg + [newCar[0]]]
         return messages
 
 
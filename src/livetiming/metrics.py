@@ -0,0 +1,174 @@
+from bisect import bisect_left
+from collections import defaultdict, deque
+
+import math
+import time
+
+
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RATIO_BUCKETS = (0.05, 0.1, 0.15, 0.2, 0.25, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+
+
+class Histogram(object):
+    '''
+    Fixed-bucket histogram. Each bucket counts observations less than
+    or equal to its upper bound; a final, unbounded bucket catches
+    everything else.
+    '''
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        '''
+        Returns an upper bound for the given percentile (0-100) of
+        observed values, i.e. the bound of the bucket it falls into.
+        '''
+        if self.count == 0:
+            return None
+        target = self.count * pct / 100.0
+        seen = 0
+        for idx, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target and bucket_count > 0:
+                if idx < len(self.buckets):
+                    return min(self.buckets[idx], self.max)
+                return self.max
+        return self.max
+
+    def for_json(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': [
+                [bound, count] for bound, count in zip(list(self.buckets) + [None], self.counts)
+            ]
+        }
+
+
+class LatencyTracker(object):
+    '''
+    Keeps the most recent `window` observations for each key, so that
+    percentiles reflect current conditions rather than all history.
+    Percentiles are None until a key has at least `min_samples`.
+    '''
+    def __init__(self, window=100, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+
+    def observe(self, key, value):
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(value)
+
+    def percentile(self, key, pct):
+        samples = self._samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        idx = int(math.ceil(len(ordered) * pct / 100.0)) - 1
+        return ordered[min(len(ordered) - 1, max(0, idx))]
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics(object):
+    '''
+    In-memory counters and timing histograms for a service.
+
+    When disabled, timers are a shared no-op context manager and
+    counters are not touched, so instrumentation can be left in hot
+    paths at negligible cost. Sources registered with add_source are
+    only consulted when a snapshot is taken.
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = time.time()
+        self.counters = defaultdict(int)
+        self.histograms = {}
+        self._sources = {}
+
+    def _histogram(self, name, buckets):
+        hist = self.histograms.get(name)
+        if hist is None:
+            # Another thread may be creating the same histogram
+            hist = self.histograms.setdefault(name, Histogram(buckets))
+        return hist
+
+    def time(self, stage):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self._histogram(stage, TIME_BUCKETS))
+
+    def observe(self, name, value, buckets=TIME_BUCKETS):
+        if self.enabled:
+            self._histogram(name, buckets).observe(value)
+
+    def increment(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] += amount
+
+    def add_source(self, name, func):
+        '''
+        Registers a callable whose return value will be included in
+        snapshots under the given name.
+        '''
+        self._sources[name] = func
+
+    def remove_source(self, name):
+        self._sources.pop(name, None)
+
+    def snapshot(self):
+        # Other threads (e.g. analysis) may add counters and histograms
+        # while this runs, so iterate over copies.
+        snapshot = {
+            'enabled': self.enabled,
+            'uptime': time.time() - self.started,
+            'counters': dict(list(self.counters.items())),
+            'timings': {name: hist.for_json() for name, hist in list(self.histograms.items())}
+        }
+        for name, func in list(self._sources.items()):
+            snapshot[name] = func()
+        return snapshot
@@ -1,6 +1,4 @@
-from autobahn.wamp import auth
 from enum import Enum
-from sentry_sdk import configure_scope
 
 import os
 import time
@@ -19,6 +17,7 @@ class Channel:
 
 class RPC:
     ANALYSIS_PUBLISH = "livetiming.analysis/{}/{}"
+    ANALYSIS_BATCH_PUBLISH = "livetiming.analysisBatch/{}"
     DIRECTORY_LISTING = "livetiming.directory.listServices"
     RECORDING_LISTING = "livetiming.directory.listRecordings"
     SCHEDULE_LISTING = "livetiming.schedule.list"
@@ -27,6 +26,7 @@ class RPC:
     REQUEST_ANALYSIS_MANIFEST = "livetiming.service.requestAnalysisManifest.{}"
     REQUEST_ANALYSIS_DATA = "livetiming.service.requestAnalysisData.{}"
     REQUEST_ANALYSIS_CAR_LIST = "livetiming.service.requestAnalysisCarList.{}"
+    REQUEST_METRICS = "livetiming.service.requestMetrics.{}"
     STATE_PUBLISH = "livetiming.service.{}"
     GET_DIRECTORY_LISTING = 'livetiming.directory.listServices'
     GET_RECORDINGS_PAGE = 'livetiming.recordings.page'
@@ -79,6 +79,7 @@ def authenticatedService(clazz):
     Decorator for ApplicationSessions that require authentication using LIVETIMING_SHARED_SECRET.
     '''
     def onConnect(self):
+        from sentry_sdk import configure_scope
         wamp_auth_id = os.environ.get('LIVETIMING_AUTH_ID', 'services')
 
         with configure_scope() as scope:
@@ -92,6 +93,7 @@ def authenticatedService(clazz):
         self.join(self.config.realm, ["wampcra", "anonymous"], wamp_auth_id)
 
     def onChallenge(self, challenge):
+        from autobahn.wamp import auth
         user_secret = os.environ.get('LIVETIMING_SHARED_SECRET', None)
         if challenge.method == "wampcra":
             self.log.debug("WAMP-CRA challenge received: {challenge}", challenge=challenge)
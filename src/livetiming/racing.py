@@ -72,10 +72,7 @@ class Stat(Enum):
     def from_title(title):
         if title == "Lap":
             return Stat.LAPS  # Hack hack hack :(
-        for s in Stat:
-            if s.title == title:
-                return s
-        return None
+        return _STATS_BY_TITLE.get(title)
 
     @staticmethod
     def parse_colspec(colSpec):
@@ -96,3 +93,62 @@ class Stat(Enum):
             'time',
             "Best sector {} time".format(key)
         )
+
+
+_STATS_BY_TITLE = {}
+for _stat in Stat:
+    _STATS_BY_TITLE.setdefault(_stat.title, _stat)
+
+
+class ColumnSpec(object):
+    '''
+    A column spec compiled into a map from each stat to its index in a
+    car's row, for constant-time field access. Use ColumnSpec.of() to get
+    the (shared) compiled form of a list of stats.
+    '''
+    __slots__ = ('stats', 'mapping')
+
+    _cache = {}
+
+    def __init__(self, stats):
+        self.stats = tuple(stats)
+        self.mapping = {}
+        for idx, stat in enumerate(self.stats):
+            self.mapping.setdefault(stat, idx)
+
+    @classmethod
+    def of(cls, colspec):
+        if isinstance(colspec, ColumnSpec):
+            return colspec
+        key = tuple(colspec)
+        try:
+            spec = cls._cache.get(key)
+        except TypeError:  # Unhashable custom columns; don't cache
+            return cls(key)
+        if spec is None:
+            spec = cls._cache[key] = cls(key)
+        return spec
+
+    def __contains__(self, stat):
+        return stat in self.mapping
+
+    def __iter__(self):
+        return iter(self.stats)
+
+    def __len__(self):
+        return len(self.stats)
+
+    def index(self, stat):
+        return self.mapping[stat]
+
+    def get(self, car, stat, default=None):
+        if car:
+            idx = self.mapping.get(stat)
+            if idx is not None and idx < len(car):
+                return car[idx]
+        return default
+
+    def set(self, car, stat, value):
+        idx = self.mapping.get(stat)
+        if idx is not None:
+            car[idx] = value
@@ -1,12 +1,8 @@
-from autobahn.twisted.component import run
-from autobahn.twisted.wamp import ApplicationSession
-from autobahn.wamp.types import PublishOptions
 from livetiming import configure_sentry_twisted, load_env, sentry, make_component
 from livetiming.analysis import Analyser
 from livetiming.network import RPC, Realm, authenticatedService, Message,\
     MessageClass, Channel
 from livetiming.racing import Stat
-from twisted.internet import reactor
 from twisted.internet.defer import DeferredLock, inlineCallbacks
 from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
@@ -22,7 +18,6 @@ import shutil
 import sys
 import tempfile
 import time
-import txaio
 import zipfile
 
 
@@ -317,48 +312,64 @@ class ReplayManager(object):
                 simplejson.dump(analysis, af)
 
 
-@authenticatedService
-class RecordingsDirectory(ApplicationSession):
-    PAGE_SIZE = 50
+def create_recordings_directory():
+    from autobahn.twisted.wamp import ApplicationSession
+    from twisted.internet import reactor
+
+    @authenticatedService
+    class RecordingsDirectory(ApplicationSession):
+        PAGE_SIZE = 50
+
+        @inlineCallbacks
+        def onJoin(self, details):
+            self._manager = ReplayManager()
+            yield self.register(self.get_page, RPC.GET_RECORDINGS_PAGE)
+            yield self.register(self.get_names, RPC.GET_RECORDINGS_NAMES)
+            yield self.register(self.get_manifest, RPC.GET_RECORDINGS_MANIFEST)
+            yield self.register(self.update_manifest, RPC.UPDATE_RECORDING_MANIFEST)
+            self.log.info("Recordings directory service ready")
+
+        def onDisconnect(self):
+            self.log.info("Disconnected")
+            if reactor.running:
+                reactor.stop()
+
+        def get_page(self, page_number=1, filter_name=None, show_hidden=False):
+            start_idx = (page_number - 1) * self.PAGE_SIZE
+            possible_recordings = [r for r in [r for r in self._manager.recordings if show_hidden or not r.get('hidden')] if r['name'] == filter_name or filter_name is None]
+            return {
+                'recordings': possible_recordings[start_idx:start_idx + self.PAGE_SIZE],
+                'pages': math.ceil(len(possible_recordings) / float(self.PAGE_SIZE)),
+                'total': len(possible_recordings)
+            }
+
+        def get_names(self, show_hidden=False):
+            return list(
+                set(
+                    [r['name'] for r in [r for r in self._manager.recordings if show_hidden or not r.get('hidden')]]
+                )
+            )
 
-    @inlineCallbacks
-    def onJoin(self, details):
-        self._manager = ReplayManager()
-        yield self.register(self.get_page, RPC.GET_RECORDINGS_PAGE)
-        yield self.register(self.get_names, RPC.GET_RECORDINGS_NAMES)
-        yield self.register(self.get_manifest, RPC.GET_RECORDINGS_MANIFEST)
-        yield self.register(self.update_manifest, RPC.UPDATE_RECORDING_MANIFEST)
-        self.log.info("Recordings directory service ready")
+        def get_manifest(self, recording_uuid):
+            return self._manager.recordings_by_uuid.get(recording_uuid)
 
-    def onDisconnect(self):
-        self.log.info("Disconnected")
-        if reactor.running:
-            reactor.stop()
+        def update_manifest(self, manifest, authcode=None):
+            if authcode != os.environ.get('LIVETIMING_ADMIN_AUTHCODE') or not authcode:
+                raise Exception('Incorrect authcode supplied')
 
-    def get_page(self, page_number=1, filter_name=None, show_hidden=False):
-        start_idx = (page_number - 1) * self.PAGE_SIZE
-        possible_recordings = [r for r in [r for r in self._manager.recordings if show_hidden or not r.get('hidden')] if r['name'] == filter_name or filter_name is None]
-        return {
-            'recordings': possible_recordings[start_idx:start_idx + self.PAGE_SIZE],
-            'pages': math.ceil(len(possible_recordings) / float(self.PAGE_SIZE)),
-            'total': len(possible_recordings)
-        }
-
-    def get_names(self, show_hidden=False):
-        return list(
-            set(
-                [r['name'] for r in [r for r in self._manager.recordings if show_hidden or not r.get('hidden')]]
-            )
-        )
+            self._manager.update_manifest(manifest)
 
-    def get_manifest(self, recording_uuid):
-        return self._manager.recordings_by_uuid.get(recording_uuid)
+    return RecordingsDirectory
 
-    def update_manifest(self, manifest, authcode=None):
-        if authcode != os.environ.get('LIVETIMING_ADMIN_AUTHCODE') or not authcode:
-            raise Exception('Incorrect authcode supplied')
 
-        self._manager.update_manifest(manifest)
+def __getattr__(name):
+    # RecordingsDirectory is built on first access so that importing this
+    # module doesn't import autobahn.twisted.
+    if name == 'RecordingsDirectory':
+        value = create_recordings_directory()
+        globals()[name] = value
+        return value
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
 
 
 def update_recordings_index(index_filename):
@@ -500,7 +511,8 @@ def main():
     configure_sentry_twisted()
     Logger().info("Starting recording directory service...")
 
-    component = make_component(RecordingsDirectory)
+    from autobahn.twisted.component import run
+    component = make_component(create_recordings_directory())
     run(component)
 
 
@@ -1,21 +1,36 @@
 from livetiming import configure_sentry_twisted, load_env, sentry, VERSION
-from pluginbase import PluginBase
-from setuptools import find_namespace_packages
 from twisted.logger import Logger
 
-from .fetchers import Fetcher, JSONFetcher, MultiLineFetcher
-from .factories import Watchdog, ReconnectingWebSocketClientFactory
-from .service import AbstractService, BaseService, DuePublisher
+from .registry import get_registry
 
 import argparse
 import codecs
+import importlib
 import os
 import sys
-import txaio
 
 
-configure_sentry_twisted()
-sentry()
+# Plugins import these from livetiming.service; they're loaded on first
+# access so that tools which only need parse_args or the plugin registry
+# don't pay for importing autobahn, treq and friends.
+_LAZY_EXPORTS = {
+    'AbstractService': '.service',
+    'BaseService': '.service',
+    'DuePublisher': '.service',
+    'Fetcher': '.fetchers',
+    'JSONFetcher': '.fetchers',
+    'MultiLineFetcher': '.fetchers',
+    'ReconnectingWebSocketClientFactory': '.factories',
+    'Watchdog': '.factories',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_EXPORTS:
+        value = getattr(importlib.import_module(_LAZY_EXPORTS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
 
 
 def parse_args(args=None):
@@ -27,7 +42,12 @@ def parse_args(args=None):
     parser.add_argument('-d', '--description', nargs='?', help='Service description')
     parser.add_argument('-v', '--verbose', action='store_true', help='Log to stdout rather than a file')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--metrics', action='store_true', help='Collect timing metrics for the update pipeline')
     parser.add_argument('--disable-analysis', action='store_true')
+    parser.add_argument('--analysis-backlog', type=int, default=10, help='Maximum number of state updates waiting to be analysed')
+    parser.add_argument('--analysis-overload', choices=['merge', 'fail'], default='merge', help='What to do with a state update when the analysis backlog is full')
+    parser.add_argument('--analysis-batch', action='store_true', help='Also publish all analysis data due each tick as one compressed message')
+    parser.add_argument('--analysis-compression-threshold', type=int, default=4096, help='Compress analysis data larger than this many bytes (-1 to never compress)')
     parser.add_argument('-H', '--hidden', action='store_true', help='Hide this service from the UI except by UUID access')
     parser.add_argument('-N', '--do-not-record', action='store_true', help='Tell the DVR not to keep the recording of this service')
     parser.add_argument('-m', '--masquerade', nargs='?', help='Masquerade as this service class')
@@ -40,10 +60,11 @@ def parse_args(args=None):
 
 
 def plugin_source_paths():
-    return [p for p in sys.path if find_namespace_packages(p, include=['livetiming.service.plugins'])]
+    return get_registry()['paths']
 
 
 def get_plugin_source():
+    from pluginbase import PluginBase
     plugin_base = PluginBase(package='livetiming.service.plugins')
     paths = list(map(lambda p: "{}/livetiming/service/plugins".format(p), plugin_source_paths()))
     plugin_source = plugin_base.make_plugin_source(
@@ -52,8 +73,21 @@ def get_plugin_source():
     return plugin_source
 
 
+def load_plugin(plugin_source, name):
+    '''
+    Loads the named plugin module: from an installed distribution's
+    entry point if one provides it, otherwise from `plugin_source`.
+    '''
+    entry_point = get_registry()['entryPoints'].get(name)
+    if entry_point:
+        return importlib.import_module(entry_point)
+    return plugin_source.load_plugin(name)
+
+
 def main(argv=None):
     load_env()
+    configure_sentry_twisted()
+    sentry()
 
     args, extra_args = parse_args(argv)
 
@@ -67,7 +101,7 @@ def main(argv=None):
     def do_start():
         with plugin_source:
             try:
-                module = plugin_source.load_plugin(args.service_class)
+                module = load_plugin(plugin_source, args.service_class)
                 service = module.Service(args, extra_args)
 
                 logger.info(
@@ -101,6 +135,7 @@ def main(argv=None):
         with codecs.open(filepath, mode='a', encoding='utf-8') as logFile:
             level = "debug" if args.debug else "info"
             if not args.verbose and not args.standalone:  # log to file, not stdout
+                import txaio
                 txaio.start_logging(out=logFile, level=level)
 
             do_start()
@@ -0,0 +1,75 @@
+from livetiming.service import DuePublisher, service as service_module
+from twisted.internet.task import Clock
+
+from .test_service import DummyService
+
+import pytest
+
+
+class FakeReactor(Clock):
+    def callFromThread(self, func, *args, **kwargs):
+        func(*args, **kwargs)
+
+
+class FakeHost(object):
+    def attach(self, service):
+        pass
+
+
+class DuePublishingService(DuePublisher, DummyService):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.publish_times = []
+        self.host = FakeHost()
+
+    def _updateAndPublishRaceState(self):
+        self.publish_times.append(service_module.reactor.seconds())
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeReactor()
+    clock.advance(1000)
+    monkeypatch.setattr(service_module, 'reactor', clock)
+    monkeypatch.setattr(service_module, 'isInIOThread', lambda: True)
+    return clock
+
+
+def test_single_change_is_published_immediately(clock):
+    service = DuePublishingService()
+    service.start()
+    clock.advance(10)
+
+    service.set_due_publish()
+    clock.advance(0)
+    assert service.publish_times == [1010]
+    service.stop()
+
+
+def test_bursts_are_coalesced(clock):
+    service = DuePublishingService()
+    service.start()
+
+    for _ in range(5):
+        service.set_due_publish()
+        clock.advance(0.05)
+    clock.advance(1)
+
+    assert len(service.publish_times) == 2
+    assert service.publish_times[1] - service.publish_times[0] >= DuePublisher.min_publish_interval
+    service.stop()
+
+
+def test_heartbeat_publishes_without_changes(clock):
+    service = DuePublishingService()
+    service.start()
+
+    clock.advance(DuePublisher.max_publish_interval)
+    assert service.publish_times == [1000 + DuePublisher.max_publish_interval]
+
+    service.set_due_publish()
+    clock.advance(DuePublisher.max_publish_interval - 1)
+    assert len(service.publish_times) == 2
+
+    service.stop()
+    assert clock.getDelayedCalls() == []
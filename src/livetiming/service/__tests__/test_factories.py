@@ -0,0 +1,64 @@
+from livetiming.service import factories
+from twisted.internet.task import Clock
+
+import pytest
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(factories, 'reactor', clock)
+    monkeypatch.setattr(factories, '_scheduler', None)
+    return clock
+
+
+def test_watchdog_fires_only_without_notification(clock):
+    fired = []
+    watchdog = factories.Watchdog(10, fired.append, 'woof')
+    watchdog.start()
+
+    for _ in range(5):
+        clock.advance(4)
+        watchdog.notify()
+    assert fired == []
+
+    clock.advance(10)
+    assert fired == ['woof']
+
+    clock.advance(5)
+    assert fired == ['woof', 'woof']
+
+    watchdog.notify()
+    clock.advance(9)
+    assert len(fired) == 2
+
+
+def test_many_watchdogs_share_one_timer(clock):
+    fired = []
+    watchdogs = [factories.Watchdog(10 + i, fired.append, i) for i in range(100)]
+    for watchdog in watchdogs:
+        watchdog.start()
+
+    assert len(clock.getDelayedCalls()) == 1
+
+    for _ in range(10):
+        clock.advance(5)
+        for watchdog in watchdogs[1:]:
+            watchdog.notify()
+
+    assert set(fired) == {0}
+    assert len(clock.getDelayedCalls()) == 1
+
+
+def test_stopped_watchdog_does_not_fire(clock):
+    fired = []
+    watchdog = factories.Watchdog(10, fired.append, 'woof')
+    watchdog.start()
+    clock.advance(5)
+    watchdog.stop()
+    clock.advance(20)
+    assert fired == []
+
+    watchdog.start()
+    clock.advance(11)
+    assert fired == ['woof']
@@ -0,0 +1,354 @@
+from livetiming.service import fetchers
+from livetiming.service.fetchers import Fetcher, JSONFetcher
+from livetiming.service.http import CountingConnectionPool, get_agent, get_pool, pool_stats
+from twisted.internet.defer import Deferred, TimeoutError
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+
+import gzip
+import pytest
+
+
+class FakeResponse(object):
+    def __init__(self, code, body=b'', headers={}):
+        self.code = code
+        self.phrase = b'OK'
+        self.length = len(body)
+        self.headers = Headers({k: [v] for k, v in headers.items()})
+        self._body = body
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self._body)
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+class FakeAgent(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, headers=None, bodyProducer=None):
+        self.requests.append((url, headers))
+        return succeed(self.responses.pop(0))
+
+
+def fetch(fetcher, url=b'http://example.com/feed?t=1'):
+    results = []
+    fetcher._get(url).addCallback(results.append)
+    return results[0]
+
+
+def test_conditional_requests_and_unchanged_bodies_are_skipped():
+    fetcher = Fetcher(b'http://example.com/feed', None, 1)
+    fetcher._agent = FakeAgent([
+        FakeResponse(200, b'data', {b'ETag': b'"v1"'}),
+        FakeResponse(304),
+        FakeResponse(200, b'data'),
+        FakeResponse(200, b'new data')
+    ])
+
+    assert fetch(fetcher) == b'data'
+    assert fetch(fetcher) is None
+    _, headers = fetcher._agent.requests[1]
+    assert headers.getRawHeaders(b'If-None-Match') == [b'"v1"']
+
+    assert fetch(fetcher) is None
+    assert fetch(fetcher) == b'new data'
+
+    stats = fetcher.stats()['http://example.com/feed']
+    assert stats['requests'] == 4
+    assert stats['notModified'] == 1
+    assert stats['unchanged'] == 1
+    assert stats['callbacksSkipped'] == 2
+    assert stats['bytesTransferred'] == len(b'data' * 2 + b'new data')
+
+
+def test_gzip_body_is_decoded():
+    compressed = gzip.compress(b'{"hello": "world"}')
+    fetcher = Fetcher(b'http://example.com/feed', None, 1)
+    fetcher._agent = FakeAgent([FakeResponse(200, compressed, {b'Content-Encoding': b'gzip'})])
+
+    assert fetch(fetcher) == b'{"hello": "world"}'
+    _, headers = fetcher._agent.requests[0]
+    assert headers.getRawHeaders(b'Accept-Encoding') == [b'gzip, deflate']
+    assert fetcher.stats()['http://example.com/feed']['bytesTransferred'] == len(compressed)
+
+
+def test_unchanged_bodies_are_passed_on_if_requested():
+    fetcher = Fetcher(b'http://example.com/feed', None, 1, skip_unchanged=False)
+    fetcher._agent = FakeAgent([FakeResponse(200, b'data'), FakeResponse(200, b'data')])
+
+    assert fetch(fetcher) == b'data'
+    assert fetch(fetcher) == b'data'
+    _, headers = fetcher._agent.requests[1]
+    assert not headers.hasHeader(b'If-None-Match')
+
+
+def test_fetchers_share_a_persistent_pool():
+    a = Fetcher(b'http://example.com/a', None, 1)
+    b = Fetcher(b'http://example.com/b', None, 1)
+    assert a._agent is b._agent
+    assert a._agent._pool is get_pool() is get_agent()._pool
+    assert get_pool().persistent
+
+    stats = pool_stats()
+    assert stats['reusedConnections'] == stats['requests'] - stats['newConnections']
+
+
+class FakeConnection(object):
+    state = 'QUIESCENT'
+
+    def connectionLost(self, reason):
+        self.state = 'CONNECTION_LOST'
+
+
+class FakeEndpoint(object):
+    '''
+    Each connection attempt returns a Deferred that we fire by hand.
+    '''
+    def __init__(self):
+        self.pending = []
+
+    def connect(self, factory):
+        d = Deferred()
+        self.pending.append(d)
+        return d
+
+
+def test_pool_limits_concurrent_requests_per_host():
+    clock = Clock()
+    pool = CountingConnectionPool(clock)
+    pool.maxConcurrentPerHost = 2
+    pool.retryAutomatically = False
+    endpoint = FakeEndpoint()
+    key = ('http', b'example.com', 80)
+
+    connections = []
+    for _ in range(4):
+        pool.getConnection(key, endpoint).addCallback(connections.append)
+    other_host = []
+    pool.getConnection(('http', b'example.org', 80), endpoint).addCallback(other_host.append)
+
+    assert len(endpoint.pending) == 3  # Two for example.com, one for example.org
+    first, second = FakeConnection(), FakeConnection()
+    endpoint.pending[0].callback(first)
+    endpoint.pending[1].callback(second)
+    assert connections == [first, second]
+    assert pool.stats()['queuedRequests'] == 2
+
+    # The first request finishes; the next waiting one reuses its connection
+    pool._putConnection(key, first)
+    clock.advance(0)
+    assert connections == [first, second, first]
+
+    # The second connection is lost; the last request gets a new one
+    second.connectionLost(None)
+    clock.advance(0)
+    assert len(endpoint.pending) == 4
+    third = FakeConnection()
+    endpoint.pending[3].callback(third)
+    assert connections == [first, second, first, third]
+    assert pool.stats()['activeRequests'] == 2
+
+
+def test_adaptive_interval_follows_change_rate(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(fetchers, 'reactor', clock)
+
+    fetcher = Fetcher(b'http://example.com/feed', lambda body: None, 4, min_interval=1, max_interval=9, jitter=0)
+    fetcher._agent = FakeAgent(
+        [FakeResponse(200, b'a'), FakeResponse(200, b'b'), FakeResponse(200, b'c')]
+        + [FakeResponse(200, b'c')] * 4
+    )
+    fetcher.start()
+
+    intervals = [fetcher.effective_interval]
+    for _ in range(6):
+        clock.advance(fetcher.effective_interval)
+        intervals.append(fetcher.effective_interval)
+
+    assert intervals == [2, 1, 1, 1.5, 2.25, 3.375, 5.0625]
+    assert fetcher.stats()['http://example.com/feed']['effectiveInterval'] == 5.0625
+    fetcher.stop()
+
+
+def test_error_responses_relax_adaptive_interval(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(fetchers, 'reactor', clock)
+
+    fetcher = Fetcher(b'http://example.com/feed', lambda body: None, 10, min_interval=1, max_interval=60, jitter=0)
+    fetcher._agent = FakeAgent([FakeResponse(503, b'Unavailable')] * 5)
+    fetcher.start()
+
+    intervals = [fetcher.effective_interval]
+    for _ in range(4):
+        clock.advance(fetcher.effective_interval)
+        intervals.append(fetcher.effective_interval)
+
+    assert intervals == [15, 22.5, 33.75, 50.625, 60]
+    fetcher.stop()
+
+
+def test_adaptive_interval_bounds():
+    def callback(body):
+        pass
+
+    with pytest.raises(ValueError):
+        Fetcher(b'http://example.com/feed', callback, 4, min_interval=5, max_interval=2)
+
+    fetcher = Fetcher(b'http://example.com/feed', callback, 4, max_interval=2)
+    assert (fetcher.min_interval, fetcher.max_interval, fetcher.effective_interval) == (2, 2, 2)
+
+    fetcher = Fetcher(b'http://example.com/feed', callback, 4, min_interval=6)
+    assert (fetcher.min_interval, fetcher.max_interval, fetcher.effective_interval) == (6, 6, 6)
+
+    fetcher = Fetcher(b'http://example.com/feed', callback, 4, min_interval=1)
+    assert (fetcher.min_interval, fetcher.max_interval) == (1, 4)
+
+
+def test_jitter_varies_delay(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(fetchers, 'reactor', clock)
+
+    fetcher = Fetcher(b'http://example.com/feed', lambda body: None, 10, min_interval=10, jitter=0.2)
+    fetcher._agent = FakeAgent([FakeResponse(200, b'a')])
+    fetcher.start()
+
+    delay = clock.getDelayedCalls()[0].getTime()
+    assert 8 <= delay <= 12
+    fetcher.stop()
+
+
+class SlowAgent(object):
+    '''
+    Each request returns a Deferred that we fire by hand.
+    '''
+    def __init__(self):
+        self.pending = []
+        self.cancelled = 0
+
+    def request(self, method, url, headers=None, bodyProducer=None):
+        def cancel(d):
+            self.cancelled += 1
+        d = Deferred(cancel)
+        self.pending.append(d)
+        return d
+
+
+def test_request_times_out(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(fetchers, 'reactor', clock)
+
+    fetcher = Fetcher(b'http://example.com/feed', None, 1, timeout=5)
+    fetcher._agent = SlowAgent()
+    failures = []
+    fetcher._get(b'http://example.com/feed').addErrback(failures.append)
+
+    clock.advance(5)
+    assert failures[0].check(TimeoutError)
+    assert fetcher.stats()['http://example.com/feed']['timeouts'] == 1
+
+
+class StreamingResponse(FakeResponse):
+    '''
+    A response whose body we deliver by hand, a chunk at a time.
+    '''
+    def __init__(self):
+        super().__init__(200)
+        self.protocol = None
+        self.stopped = False
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(self)
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+def test_timeout_resets_while_body_arrives(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(fetchers, 'reactor', clock)
+
+    response = StreamingResponse()
+    fetcher = Fetcher(b'http://example.com/feed', None, 1, timeout=5)
+    fetcher._agent = FakeAgent([response])
+    results = []
+    fetcher._get(b'http://example.com/feed').addCallback(results.append)
+
+    for _ in range(10):
+        clock.advance(4)
+        response.protocol.dataReceived(b'x')
+    response.protocol.connectionLost(Failure(ResponseDone()))
+    assert results == [b'x' * 10]
+
+    response = StreamingResponse()
+    fetcher._agent = FakeAgent([response])
+    failures = []
+    fetcher._get(b'http://example.com/feed').addErrback(failures.append)
+    response.protocol.dataReceived(b'x')
+    clock.advance(5)
+    assert failures[0].check(TimeoutError)
+    assert response.stopped
+    assert fetcher.stats()['http://example.com/feed']['timeouts'] == 1
+
+
+def test_slow_request_is_hedged(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(fetchers, 'reactor', clock)
+
+    fetcher = Fetcher(b'http://example.com/feed', None, 1, hedge=True, skip_unchanged=False)
+    for _ in range(20):
+        fetcher._latency.observe('http://example.com/feed', 0.5)
+    fetcher._agent = SlowAgent()
+    results = []
+    fetcher._get(b'http://example.com/feed').addCallback(results.append)
+
+    clock.advance(0.4)
+    assert len(fetcher._agent.pending) == 1
+    clock.advance(0.1)
+    assert len(fetcher._agent.pending) == 2
+
+    fetcher._agent.pending[1].callback(FakeResponse(200, b'hedged'))
+    assert results == [b'hedged']
+    assert fetcher._agent.cancelled == 1
+
+    stats = fetcher.stats()['http://example.com/feed']
+    assert stats['hedged'] == 1
+    assert stats['hedgeWins'] == 1
+
+
+def test_large_json_is_parsed_in_thread(monkeypatch):
+    threaded = []
+
+    def fake_defer_to_thread(func, *args):
+        threaded.append(args)
+        return succeed(func(*args))
+    monkeypatch.setattr(fetchers, 'deferToThread', fake_defer_to_thread)
+
+    received = []
+    fetcher = JSONFetcher(b'http://example.com/feed', received.append, 1, parse_in_thread_above=10)
+
+    fetcher.callback(b'{"a": 1}')
+    assert threaded == []
+    fetcher.callback(b'{"a": 1, "b": 2}')
+    assert len(threaded) == 1
+    assert received == [{'a': 1}, {'a': 1, 'b': 2}]
+
+
+def test_next_poll_waits_for_deferred_callback(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(fetchers, 'reactor', clock)
+
+    pending = Deferred()
+    fetcher = Fetcher(b'http://example.com/feed', lambda body: pending, 1)
+    fetcher._agent = FakeAgent([FakeResponse(200, b'data')])
+    fetcher.start()
+    assert clock.getDelayedCalls() == []
+
+    pending.callback(None)
+    assert len(clock.getDelayedCalls()) == 1
+    fetcher.stop()
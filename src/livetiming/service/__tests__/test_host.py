@@ -0,0 +1,90 @@
+from livetiming.service.host import ServiceHost
+
+from .test_service import DummyService
+
+import simplejson
+
+
+class FakePluginSource(object):
+    def __init__(self, analysis=False):
+        self.analysis = analysis
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def load_plugin(self, name):
+        analysis = self.analysis
+
+        class module:
+            class Service(DummyService):
+                def __init__(self, args, extra_args):
+                    super().__init__(['--uuid', args.uuid] if args.uuid else [], analysis=analysis)
+        return module
+
+
+def write_config(path, services):
+    with open(path, 'w') as config_file:
+        simplejson.dump({'services': services}, config_file)
+
+
+def make_host(tmp_path, services, analysis=False):
+    config = str(tmp_path / 'host.json')
+    write_config(config, services)
+    host = ServiceHost(config)
+    host._plugin_source = FakePluginSource(analysis)
+    return host, config
+
+
+def test_reload_adds_removes_and_restarts_services(tmp_path):
+    host, config = make_host(
+        tmp_path,
+        {
+            'a': ['dummy', '--uuid', 'a'],
+            'b': ['dummy', '--uuid', 'b']
+        }
+    )
+    host.reload_config()
+    original_b = host.services['b']
+    assert sorted(host.services.keys()) == ['a', 'b']
+    assert all(s.host is host for s in host.services.values())
+
+    write_config(config, {'b': ['dummy', '--uuid', 'b2'], 'c': ['dummy', '--uuid', 'c']})
+    host.reload_config()
+
+    assert sorted(host.services.keys()) == ['b', 'c']
+    assert host.services['b'] is not original_b
+    assert host.services['b'].uuid == 'b2'
+    assert original_b._tasks == []
+
+    host.stop()
+    assert host.services == {}
+
+
+def test_services_keep_their_own_session_analysis(tmp_path, monkeypatch):
+    monkeypatch.setenv('LIVETIMING_ANALYSIS_DIR', str(tmp_path))
+    host, _ = make_host(tmp_path, {'a': ['dummy', '--uuid', 'a'], 'b': ['dummy', '--uuid', 'b']}, analysis=True)
+    host.reload_config()
+
+    published = {}
+    for name, service in host.services.items():
+        published[name] = []
+        monkeypatch.setattr(service.analyser, '_publish_data', lambda key, data, name=name: published[name].append(key))
+
+    def update(name, leader_lap):
+        service = host.services[name]
+        service.analyser.data_centre.leader_lap = leader_lap
+        del published[name][:]
+        service.analyser.receiveStateUpdate({'cars': [], 'session': {'flagState': 'green'}}, service.getColumnSpec())
+        return 'session' in published[name]
+
+    assert update('a', 0)
+    assert update('b', 0)
+    assert update('a', 5)
+    assert update('b', 3)
+    assert not update('a', 5)
+    assert not update('b', 3)
+
+    host.stop()
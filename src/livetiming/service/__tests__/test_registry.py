@@ -0,0 +1,63 @@
+from livetiming.service import registry
+
+import os
+import sys
+
+
+def make_plugin(root, name):
+    plugin_dir = root / 'livetiming' / 'service' / 'plugins'
+    plugin_dir.mkdir(parents=True, exist_ok=True)
+    (plugin_dir / '{}.py'.format(name)).write_text('__spec = {"description": "%s"}\n' % name)
+    # Ensure the change is visible even on filesystems with coarse mtimes
+    future = os.stat(plugin_dir).st_mtime + 10
+    os.utime(plugin_dir, (future, future))
+
+
+def test_registry_cached_until_plugins_change(tmp_path, monkeypatch):
+    plugins_root = tmp_path / 'site'
+    make_plugin(plugins_root, 'first')
+
+    monkeypatch.setattr(sys, 'path', [str(plugins_root), str(tmp_path / 'missing')])
+    monkeypatch.setenv('LIVETIMING_PLUGIN_CACHE', str(tmp_path / 'cache' / 'plugins.json'))
+    monkeypatch.setattr(registry, '_registry', None)
+
+    reg = registry.get_registry()
+    assert reg['paths'] == [str(plugins_root)]
+    assert reg['plugins'] == ['first']
+    assert os.path.exists(str(tmp_path / 'cache' / 'plugins.json'))
+
+    builds = []
+    original_build = registry.build_registry
+
+    def counting_build():
+        builds.append(True)
+        return original_build()
+    monkeypatch.setattr(registry, 'build_registry', counting_build)
+
+    # A new process would read the cache file rather than rebuilding
+    monkeypatch.setattr(registry, '_registry', None)
+    assert registry.get_registry()['plugins'] == ['first']
+    assert builds == []
+
+    make_plugin(plugins_root, 'second')
+    assert registry.get_registry()['plugins'] == ['first', 'second']
+    assert len(builds) == 1
+
+    registry.get_registry(rebuild=True)
+    assert len(builds) == 2
+
+
+def test_entry_points_from_dict_api(monkeypatch):
+    class EntryPoint(object):
+        def __init__(self, name, value):
+            self.name = name
+            self.value = value
+
+    class DictMetadata(object):
+        # As importlib.metadata on Python 3.8/3.9, or importlib_metadata < 3.6
+        @staticmethod
+        def entry_points():
+            return {registry.ENTRY_POINT_GROUP: [EntryPoint('external', 'external_plugin.service:Service')]}
+
+    monkeypatch.setattr(registry, 'metadata', DictMetadata)
+    assert registry._entry_points() == {'external': 'external_plugin.service'}
@@ -0,0 +1,204 @@
+from livetiming.network import Channel, MessageClass, RPC
+from livetiming.racing import Stat
+from livetiming.service import BaseService, parse_args
+
+import simplejson
+import zipfile
+
+
+class DummyService(BaseService):
+    def __init__(self, argv=[], analysis=False):
+        args, extra_args = parse_args(['dummy', '--no-write-state'] + ([] if analysis else ['--disable-analysis']) + argv)
+        super().__init__(args, extra_args)
+        self.next_state = None
+
+    def getName(self):
+        return 'Dummy'
+
+    def getDefaultDescription(self):
+        return 'Dummy service'
+
+    def getColumnSpec(self):
+        return [Stat.NUM, Stat.STATE, Stat.DRIVER]
+
+    def getVersion(self):
+        return 'test'
+
+    def getRaceState(self):
+        return self.next_state
+
+
+def make_state(*cars):
+    return {
+        'cars': [list(c) for c in cars],
+        'session': {'flagState': 'green'}
+    }
+
+
+def test_new_state_is_shared_not_copied():
+    service = DummyService()
+    service.next_state = make_state(['1', 'RUN', 'Alice'])
+    service._updateRaceState()
+
+    assert service.state['cars'] is service.next_state['cars']
+    assert service.state['session'] is service.next_state['session']
+
+
+def test_reused_car_rows_are_copied():
+    service = DummyService()
+    row = ['1', 'RUN', 'Alice']
+    service.next_state = make_state()
+    service.next_state['cars'] = [row]
+    service._updateRaceState()
+
+    # A new list of the same, mutated, rows
+    row[1] = 'PIT'
+    service.next_state = {'cars': [row], 'session': {'flagState': 'green'}}
+    service._updateRaceState()
+    assert service.state['cars'][0] is not row
+
+    row[1] = 'OUT'
+    service.next_state = {'cars': [row], 'session': {'flagState': 'green'}}
+    service._updateRaceState()
+    assert service.state['messages'][0][2] == '#1 (Alice) has left the pits'
+
+
+def test_reused_state_objects_are_copied():
+    service = DummyService()
+    state = make_state(['1', 'RUN', 'Alice'])
+    service.next_state = state
+    service._updateRaceState()
+
+    service._updateRaceState()
+    assert service.state['cars'] is not state['cars']
+
+    for status, message in [('PIT', 'entered the pits'), ('OUT', 'left the pits')]:
+        state['cars'][0][1] = status
+        service._updateRaceState()
+        assert service.state['messages'][0][2] == '#1 (Alice) has {}'.format(message)
+
+
+def test_debug_guard_detects_mutation():
+    service = DummyService(['--debug'])
+    service.next_state = make_state(['1', 'RUN', 'Alice'])
+    service._updateRaceState()
+    assert service._snapshot_guard.check()
+
+    service.next_state['cars'][0][2] = 'Bob'
+    assert not service._snapshot_guard.check()
+
+
+def test_initial_sync_reuses_published_messages():
+    service = DummyService()
+    service.next_state = make_state(['1', 'RUN', 'Alice'])
+    published = []
+    service.set_publish(lambda channel, message, **kwargs: published.append((channel, message)))
+    service._updateAndPublishRaceState()
+
+    sync = service.initial_sync_messages()
+    assert [channel for channel, _ in sync] == [
+        Channel.CONTROL,
+        RPC.STATE_PUBLISH.format(service.uuid)
+    ]
+    assert sync[1][1] is published[-1][1]
+    assert service.initial_sync_messages()[0][1] is sync[0][1]
+
+
+def test_analysis_snapshot_is_raw_data(tmp_path, monkeypatch):
+    monkeypatch.setenv('LIVETIMING_ANALYSIS_DIR', str(tmp_path))
+    service = DummyService(analysis=True)
+    service.analyser.receiveStateUpdate(make_state(['1', 'RUN', 'Alice']), service.getColumnSpec(), 1000)
+    service.analyser.refresh_snapshot()
+
+    token, data = service.analysis_snapshot('driver')
+    assert data == {'1': ['Alice']}
+    assert service.analysis_snapshot('driver')[0] is token
+    assert service.analysis_snapshot('nonexistent') is None
+
+
+def test_compressed_analysis_is_served_as_json(tmp_path, monkeypatch):
+    from livetiming.analysis import DEFAULT_COMPRESSION_THRESHOLD
+    from livetiming.service.standalone import AnalysisResource
+    from twisted.web.test.requesthelper import DummyRequest
+
+    monkeypatch.setenv('LIVETIMING_ANALYSIS_DIR', str(tmp_path))
+    service = DummyService(analysis=True)
+    cars = [[str(n), 'RUN', 'Driver with a long name {}'.format(n)] for n in range(300)]
+    service.analyser.receiveStateUpdate(make_state(*cars), service.getColumnSpec(), 1000)
+    service.analyser.refresh_snapshot()
+
+    sync = dict(service.analyser.initial_sync_messages())
+    assert sync[RPC.ANALYSIS_PUBLISH.format(service.uuid, 'driver')]['msgClass'] == MessageClass.ANALYSIS_DATA_COMPRESSED.value
+
+    request = DummyRequest([b''])
+    resource = AnalysisResource(service).getChild(b'driver', request)
+    body = resource.render_GET(request)
+    assert len(body) > DEFAULT_COMPRESSION_THRESHOLD
+    assert simplejson.loads(body) == {car[0]: [car[2]] for car in cars}
+
+
+def test_unchanged_manifest_is_not_republished():
+    service = DummyService(['--metrics'])
+    published = []
+    recorded = []
+    service.set_publish(lambda channel, message, **kwargs: published.append(message))
+    service.recorder = type('FakeRecorder', (object,), {'writeManifest': lambda self, m: recorded.append(m)})()
+
+    service._publish_manifest_actual()
+    service._publish_manifest_actual()
+    assert len(published) == 1
+    assert len(recorded) == 1
+    assert service.metrics.counters['manifest_publishes_suppressed'] == 1
+
+    service.publishManifest(force=True)
+    service._last_deferred.addErrback(lambda _: None)
+    service._last_deferred.cancel()
+    service._publish_manifest_actual()
+    assert len(published) == 2
+    assert published[1] is published[0]
+    assert len(recorded) == 1
+
+    service.args.description = 'Changed'
+    service._publish_manifest_actual()
+    assert len(published) == 3
+    assert published[2]['payload']['description'] == 'Changed'
+    assert len(recorded) == 2
+
+
+def test_errors_are_tagged_with_their_service(monkeypatch):
+    from livetiming.service import service as service_module
+    captured = []
+    monkeypatch.setattr(service_module.sentry_sdk, 'capture_exception', lambda e, **kwargs: captured.append(kwargs['tags']))
+
+    class BrokenGenerator(object):
+        def process(self, old_state, new_state):
+            raise Exception('Broken')
+
+    services = [DummyService(), DummyService()]
+    for service in services:
+        service.getExtraMessageGenerators = lambda: [BrokenGenerator()]
+        service._createMessages(service.state, make_state())
+
+    assert [tags['uuid'] for tags in captured] == [s.uuid for s in services]
+    assert captured[0]['service_name'] == DummyService.__module__.split('.')[-1]
+
+
+def test_recorded_manifest_is_not_republished(tmp_path):
+    recording = str(tmp_path / 'recording.zip')
+    service = DummyService(['--metrics', '--recording-file', recording])
+    published = []
+    service.set_publish(lambda channel, message, **kwargs: published.append(message))
+
+    for _ in range(3):
+        service._publish_manifest_actual()
+
+    assert len(published) == 1
+    assert service.metrics.counters['manifest_publishes_suppressed'] == 2
+    assert 'startTime' not in published[0]['payload']
+    assert 'startTime' not in service._current_manifest_message()['payload']
+
+    with zipfile.ZipFile(recording) as z:
+        assert z.namelist() == ['manifest.json']
+        recorded = simplejson.loads(z.read('manifest.json'))
+    assert recorded['uuid'] == service.uuid
+    assert recorded['version'] == 1
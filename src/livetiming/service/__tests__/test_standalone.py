@@ -0,0 +1,167 @@
+from autobahn.twisted.websocket import WebSocketClientFactory, WebSocketClientProtocol, WebSocketServerProtocol
+from autobahn.wamp.types import PublishOptions
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateResponseAccept
+from livetiming.metrics import Metrics
+from livetiming.service.standalone import BroadcastServerFactory, ClientQueue, SnapshotResource
+from twisted.test import iosim
+from twisted.web.test.requesthelper import DummyRequest
+
+import gzip
+import simplejson
+
+
+class FakeClient(object):
+    def __init__(self, peer):
+        self.peer = peer
+        self.sent = []
+        self.dropped = False
+        self.queue = ClientQueue(self)
+
+    def sendPreparedMessage(self, prepared):
+        self.sent.append(prepared.payload)
+
+    def dropConnection(self, abort=False):
+        self.dropped = True
+
+
+def make_factory(*clients):
+    factory = BroadcastServerFactory(Metrics(enabled=True))
+    for client in clients:
+        factory.register(client)
+    return factory
+
+
+def test_paused_client_gets_only_newest_state():
+    fast, slow = FakeClient('fast'), FakeClient('slow')
+    factory = make_factory(fast, slow)
+    retained = PublishOptions(retain=True)
+
+    slow.queue.pauseProducing()
+    for n in range(3):
+        factory.publish('state', {'n': n}, options=retained)
+    factory.publish('event', {'lap': 1})
+
+    assert len(fast.sent) == 4
+    assert slow.sent == []
+    assert len(slow.queue) == 2
+    assert slow.queue.replaced == 2
+
+    slow.queue.resumeProducing()
+    assert slow.sent == [
+        factory.encode('state', {'n': 2}),
+        factory.encode('event', {'lap': 1})
+    ]
+    assert slow.queue.queued_bytes == 0
+
+    snapshot = factory.metrics.snapshot()
+    assert snapshot['timings']['fanout']['count'] == 4
+
+
+def test_client_over_limit_is_disconnected():
+    slow = FakeClient('slow')
+    factory = make_factory(slow)
+    factory.max_queued_bytes = 100
+
+    slow.queue.pauseProducing()
+    factory.publish('event', {'data': 'x' * 50})
+    assert not slow.dropped
+    factory.publish('event', {'data': 'x' * 50})
+
+    assert slow.dropped
+    assert factory.clients == []
+    assert factory.client_stats()['slowDisconnects'] == 1
+
+
+def connect_client(factory, request_no_context_takeover=False):
+    '''
+    Connects a real autobahn client, offering permessage-deflate, to a
+    protocol from `factory`, in memory. Returns the server protocol, the
+    pump and the list of messages the client receives.
+    '''
+    received = []
+
+    class ServerProtocol(WebSocketServerProtocol):
+        def onOpen(self):
+            self.queue = ClientQueue(self)
+            self.factory.register(self)
+
+    class ClientProtocol(WebSocketClientProtocol):
+        def onMessage(self, payload, isBinary):
+            received.append(payload)
+
+    factory.protocol = ServerProtocol
+    client_factory = WebSocketClientFactory('ws://localhost:9000')
+    client_factory.protocol = ClientProtocol
+    client_factory.setProtocolOptions(
+        perMessageCompressionOffers=[
+            PerMessageDeflateOffer(accept_no_context_takeover=True, request_no_context_takeover=request_no_context_takeover)
+        ],
+        perMessageCompressionAccept=PerMessageDeflateResponseAccept
+    )
+
+    server = factory.buildProtocol(None)
+    client = client_factory.buildProtocol(None)
+    pump = iosim.connect(server, iosim.makeFakeServer(server), client, iosim.makeFakeClient(client))
+    return server, pump, received
+
+
+def test_compressed_payload_is_shared_between_real_clients():
+    factory = BroadcastServerFactory(Metrics(enabled=True))
+    a, pump_a, received_a = connect_client(factory)
+    b, pump_b, received_b = connect_client(factory, request_no_context_takeover=True)
+    assert factory.clients == [a, b]
+
+    message = {'cars': ['x' * 1000]}
+    factory.publish('state', message)
+    pump_a.flush()
+    pump_b.flush()
+
+    assert received_a == received_b == [factory.encode('state', message)]
+    assert factory.metrics.counters['ws_bytes_compressed'] < factory.metrics.counters['ws_bytes_uncompressed'] / 10
+    assert factory.metrics.histograms['ws_compress'].count == 1  # Compressed once for both
+
+
+def test_context_takeover_clients_are_compressed_individually():
+    factory = BroadcastServerFactory(Metrics(enabled=True), binary=True, context_takeover=True)
+    _, pump, received = connect_client(factory)
+
+    for n in range(2):
+        factory.publish('state', {'cars': ['x' * 1000], 'n': n})
+        pump.flush()
+
+    assert received == [factory.encode('state', {'cars': ['x' * 1000], 'n': n}) for n in range(2)]
+    assert 'ws_compress' not in factory.metrics.histograms
+
+
+def render(resource, headers={}):
+    request = DummyRequest([b''])
+    for name, value in headers.items():
+        request.requestHeaders.setRawHeaders(name, [value])
+    body = resource.render_GET(request)
+    return request, body
+
+
+def test_snapshot_resource_supports_etags_and_gzip():
+    snapshot = {'token': object(), 'data': {'cars': [['1']]}}
+    resource = SnapshotResource(lambda: (snapshot['token'], snapshot['data']))
+
+    request, body = render(resource)
+    etag = request.responseHeaders.getRawHeaders(b'ETag')[0]
+    assert simplejson.loads(body) == {'cars': [['1']]}
+
+    request, body = render(resource, {b'If-None-Match': etag})
+    assert request.responseCode == 304
+
+    request, body = render(resource, {b'Accept-Encoding': b'gzip, deflate'})
+    assert request.responseHeaders.getRawHeaders(b'Content-Encoding') == [b'gzip']
+    assert simplejson.loads(gzip.decompress(body)) == {'cars': [['1']]}
+
+    snapshot.update(token=object(), data={'cars': [['2']]})
+    request, body = render(resource, {b'If-None-Match': etag})
+    assert request.responseCode != 304
+    assert simplejson.loads(body) == {'cars': [['2']]}
+
+
+def test_missing_snapshot_is_not_found():
+    request, _ = render(SnapshotResource(lambda: None))
+    assert request.responseCode == 404
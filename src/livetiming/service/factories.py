@@ -1,37 +1,121 @@
 from autobahn.twisted.websocket import WebSocketClientFactory
 from livetiming import USER_AGENT
+from twisted.internet import reactor
 from twisted.internet.protocol import ReconnectingClientFactory
-from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
 
-import time
+import heapq
+import itertools
+
+
+class WatchdogScheduler(object):
+    '''
+    Tracks the deadlines of any number of Watchdogs using a heap and a
+    single reactor timer, which is only set for the earliest deadline.
+
+    Watchdogs record when they were last notified but don't touch the
+    heap; when an entry comes due it is either fired (if there has been
+    no notification for its timeout) or pushed back to its watchdog's
+    current deadline.
+    '''
+    log = Logger()
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._call = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, watchdog, deadline):
+        heapq.heappush(self._heap, (deadline, next(self._counter), watchdog, watchdog._generation))
+        self._reset_timer()
+
+    def _reset_timer(self):
+        if not self._heap:
+            if self._call and self._call.active():
+                self._call.cancel()
+            self._call = None
+            return
+
+        delay = max(0, self._heap[0][0] - reactor.seconds())
+        if self._call and self._call.active():
+            if abs(self._call.getTime() - self._heap[0][0]) > 0.001:
+                self._call.reset(delay)
+        else:
+            self._call = reactor.callLater(delay, self._wake)
+
+    def _wake(self):
+        self._call = None
+        now = reactor.seconds()
+
+        while self._heap and self._heap[0][0] <= now:
+            _, _, watchdog, generation = heapq.heappop(self._heap)
+            if generation != watchdog._generation:
+                continue  # Stopped or restarted since this entry was pushed
+
+            deadline = watchdog._last_measure + watchdog._timeout
+            if deadline > now:
+                heapq.heappush(self._heap, (deadline, next(self._counter), watchdog, generation))
+                continue
+
+            try:
+                watchdog._trigger(now)
+            except Exception:
+                self.log.failure("Watchdog action failed: {log_failure}")
+
+            if generation == watchdog._generation:
+                # Keep firing, as often as the old polling check did, until notified
+                heapq.heappush(self._heap, (now + watchdog._timeout / 2, next(self._counter), watchdog, generation))
+
+        self._reset_timer()
+
+
+_scheduler = None
+
+
+def get_watchdog_scheduler():
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = WatchdogScheduler()
+    return _scheduler
 
 
 class Watchdog(object):
+    '''
+    Calls `action_method` if `notify()` isn't called for `timeout`
+    seconds after `start()`, and repeatedly thereafter (every `timeout/2`
+    seconds) until it is. All watchdogs share one WatchdogScheduler.
+    '''
     def __init__(self, timeout, action_method, *action_args, **action_kwargs):
         self.log = Logger()
         self._timeout = timeout
         self._action_method = action_method
         self._action_args = action_args
         self._action_kwargs = action_kwargs
-        self._call = LoopingCall(self._perform_check)
+        self._generation = 0
+        self._running = False
+        self._last_measure = None
 
     def start(self):
-        self._last_measure = time.time()
-        self._call.start(self._timeout / 2, False)
+        self._generation += 1
+        self._running = True
+        self._last_measure = reactor.seconds()
+        get_watchdog_scheduler().schedule(self, self._last_measure + self._timeout)
 
     def stop(self):
-        if self._call.running:
-            self._call.stop()
+        if self._running:
+            self._running = False
+            self._generation += 1  # Invalidates our scheduler entry
 
     def notify(self):
-        self._last_measure = time.time()
+        self._last_measure = reactor.seconds()
 
-    def _perform_check(self):
-        delta = time.time() - self._last_measure
-        if delta > self._timeout:
-            self.log.warn('WATCHDOG: {delta} since last notify received, triggering watchdog action', delta=delta)
-            self._action_method(*self._action_args, **self._action_kwargs)
+    def _trigger(self, now):
+        delta = now - self._last_measure
+        self.log.warn('WATCHDOG: {delta} since last notify received, triggering watchdog action', delta=delta)
+        self._action_method(*self._action_args, **self._action_kwargs)
 
 
 class ReconnectingWebSocketClientFactory(WebSocketClientFactory, ReconnectingClientFactory):
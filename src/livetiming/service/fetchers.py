@@ -1,31 +1,186 @@
+from collections import defaultdict
+from livetiming.metrics import LatencyTracker
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import CancelledError, Deferred, inlineCallbacks, returnValue, TimeoutError
+from twisted.internet.protocol import Protocol
+from twisted.internet.threads import deferToThread
 from twisted.logger import Logger
-from twisted.web.client import Agent, readBody, _HTTP11ClientFactory
+from twisted.web.client import PartialDownloadError, ResponseDone, _HTTP11ClientFactory
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
 
+from .http import get_agent
+
+import hashlib
+import random
 import simplejson
+import zlib
 
 
 _HTTP11ClientFactory.noisy = False
 
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_TIMEOUT = 30
+DEFAULT_THREADED_PARSE_THRESHOLD = 256 * 1024
+
+
+def _decode_body(body, encoding):
+    if encoding == b'gzip':
+        return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if encoding == b'deflate':
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # Some servers send a raw deflate stream without the zlib header
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+class _BodyReader(Protocol):
+    '''
+    Collects a response body, as readBody does, but fails with
+    TimeoutError if `timeout` seconds pass without receiving any of it.
+    '''
+    def __init__(self, response, timeout):
+        self.response = response
+        self.timeout = timeout
+        self.finished = Deferred(self._cancel)
+        self._chunks = []
+        self._timer = reactor.callLater(timeout, self._timed_out) if timeout else None
+
+    def _stop(self):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        if self.transport:
+            self.transport.stopProducing()
+
+    def _cancel(self, _):
+        self._stop()
+
+    def _timed_out(self):
+        if not self.finished.called:
+            self.finished.errback(TimeoutError('No data received for {} seconds'.format(self.timeout)))
+        self._stop()
+
+    def dataReceived(self, data):
+        self._chunks.append(data)
+        if self._timer and self._timer.active():
+            self._timer.reset(self.timeout)
+
+    def connectionLost(self, reason):
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        if self.finished.called:
+            return
+        body = b''.join(self._chunks)
+        if reason.check(ResponseDone):
+            self.finished.callback(body)
+        elif reason.check(PotentialDataLoss):
+            self.finished.errback(PartialDownloadError(self.response.code, self.response.phrase, body))
+        else:
+            self.finished.errback(reason)
+
+
+def _read_body(response, timeout):
+    reader = _BodyReader(response, timeout)
+    response.deliverBody(reader)
+    return reader.finished
+
+
+def _stats_key(url):
+    if isinstance(url, bytes):
+        url = url.decode('utf-8', 'replace')
+    return url.split('?', 1)[0]
+
 
 class Fetcher(object):
+    '''
+    Repeatedly fetches a URL, passing the body of each response to
+    `callback`.
+
+    Requests are conditional (using the ETag and Last-Modified headers
+    of the previous response) and accept gzip or deflate encoding. If
+    `skip_unchanged` is set (the default), the callback is not called
+    when the server responds 304 Not Modified, nor when the body is
+    identical to the previous one.
+
+    If `min_interval` and/or `max_interval` are given, the polling
+    interval adapts to how often the response changes: it is halved
+    (down to `min_interval`) after a response that differs from the
+    previous one, and increased by half (up to `max_interval`) after
+    one that doesn't or that isn't a 200 OK. Each delay is then varied randomly by up to
+    `jitter` (default 10% when adaptive) so that services polling the
+    same upstream don't synchronise. The current interval is available
+    as `effective_interval`.
+
+    Each request must connect within `connect_timeout` seconds, and is
+    treated as a failure if `timeout` seconds pass without receiving any
+    of the response. This is an idle timeout rather than a deadline, so
+    a large download that's still making progress isn't cut off.
+    With `hedge` set, if a request takes longer than the 95th percentile
+    of recent request times for its URL, a second identical request is
+    sent; whichever responds first is used and the other cancelled.
+    '''
     log = Logger()
 
-    def __init__(self, url, callback, interval):
+    def __init__(self, url, callback, interval, skip_unchanged=True, min_interval=None, max_interval=None, jitter=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, timeout=DEFAULT_TIMEOUT, hedge=False):
         self.url = url
         self.callback = callback
         self.interval = interval
+        self.skip_unchanged = skip_unchanged
+
+        if min_interval is not None and max_interval is not None and min_interval > max_interval:
+            raise ValueError('min_interval ({}) is greater than max_interval ({})'.format(min_interval, max_interval))
+
+        self.adaptive = min_interval is not None or max_interval is not None
+        # A bound not given defaults to the interval, within the other bound
+        if min_interval is None:
+            min_interval = interval if max_interval is None else min(interval, max_interval)
+        if max_interval is None:
+            max_interval = max(interval, min_interval)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        if jitter is None:
+            jitter = 0.1 if self.adaptive else 0
+        self.jitter = jitter
+        self.effective_interval = min(max(interval, self.min_interval), self.max_interval)
 
-        self._agent = Agent(reactor)
+        self.timeout = timeout
+        self.hedge = hedge
+
+        self._agent = get_agent(connect_timeout)
+        self._latency = LatencyTracker()
+        self._validators = None
+        self._last_digest = None
+        self._last_url = url
+        self._last_changed = True
+        self._stats = defaultdict(lambda: defaultdict(int))
 
         self.backoff = 0
         self.running = False
 
     def _schedule(self, delay):
         if self.running:
+            if self.jitter:
+                delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
             reactor.callLater(delay, self._run)
 
+    def _adapt_interval(self, changed):
+        if not self.adaptive:
+            return
+        if changed:
+            new_interval = max(self.min_interval, self.effective_interval / 2)
+        else:
+            new_interval = min(self.max_interval, self.effective_interval * 1.5)
+        if new_interval != self.effective_interval:
+            self.log.debug(
+                "Polling interval for {url} now {interval:.2f}s",
+                url=_stats_key(self._last_url),
+                interval=new_interval
+            )
+            self.effective_interval = new_interval
+
     @inlineCallbacks
     def _run(self):
         if self.running:
@@ -39,23 +194,166 @@ class Fetcher(object):
 
                 self.backoff = 0
                 if self.running:
-                    self.callback(body)
-                    self._schedule(self.interval)
+                    if body is not None:
+                        # Wait for the callback if it returns a Deferred
+                        yield self.callback(body)
+                    self._adapt_interval(self._last_changed)
+                    self._schedule(self.effective_interval)
             except Exception as fail:
                 if self.running:
                     self.backoff = max(1, self.backoff * 2)
                     self.log.warn("Fetcher failed for {url}: {fail}. Trying again in {backoff} seconds", url=url, fail=fail, backoff=self.backoff)
                     self._schedule(self.backoff)
 
+    def _request_headers(self, url):
+        headers = Headers({b'Accept-Encoding': [b'gzip, deflate']})
+        if self.skip_unchanged and self._validators and self._validators[0] == url:
+            _, etag, last_modified = self._validators
+            if etag:
+                headers.setRawHeaders(b'If-None-Match', [etag])
+            if last_modified:
+                headers.setRawHeaders(b'If-Modified-Since', [last_modified])
+        return headers
+
     @inlineCallbacks
     def _get(self, url):
-        response = yield self._agent.request(
-            b'GET',
-            url
-        )
-        body = yield readBody(response)
+        '''
+        Returns the (decoded) body of the response to a GET of `url`, or
+        None if it's unchanged since the last request and
+        `skip_unchanged` is set.
+        '''
+        stats = self._stats[_stats_key(url)]
+        stats['requests'] += 1
+        self._last_url = url
+        # Only a 200 can count as a change; anything else, including an
+        # error response, relaxes the polling interval.
+        self._last_changed = False
+
+        headers = self._request_headers(url)
+        if self.hedge:
+            response, raw_body = yield self._hedged_request(url, headers, stats)
+        else:
+            response, raw_body = yield self._timed_request(url, headers, stats)
+        stats['bytesTransferred'] += len(raw_body)
+
+        if response.code == 304:
+            self._last_changed = False
+            stats['notModified'] += 1
+            stats['callbacksSkipped'] += 1
+            returnValue(None)
+
+        encoding = response.headers.getRawHeaders(b'Content-Encoding', [b''])[-1].strip().lower()
+        body = _decode_body(raw_body, encoding)
+        stats['bytesDecoded'] += len(body)
+
+        if response.code == 200:
+            if self.skip_unchanged:
+                self._validators = (
+                    url,
+                    response.headers.getRawHeaders(b'ETag', [None])[-1],
+                    response.headers.getRawHeaders(b'Last-Modified', [None])[-1]
+                )
+            if self.skip_unchanged or self.adaptive:
+                digest = hashlib.sha1(body).digest()
+                self._last_changed = digest != self._last_digest
+                self._last_digest = digest
+
+                if not self._last_changed:
+                    stats['unchanged'] += 1
+                    if self.skip_unchanged:
+                        stats['callbacksSkipped'] += 1
+                        returnValue(None)
+
         returnValue(body)
 
+    @inlineCallbacks
+    def _request(self, url, headers):
+        d = self._agent.request(b'GET', url, headers)
+        if self.timeout:
+            d.addTimeout(self.timeout, reactor)
+        response = yield d
+        raw_body = yield _read_body(response, self.timeout)
+        returnValue((response, raw_body))
+
+    def _timed_request(self, url, headers, stats):
+        key = _stats_key(url)
+        start = reactor.seconds()
+
+        def record_latency(result):
+            self._latency.observe(key, reactor.seconds() - start)
+            return result
+
+        def count_timeout(failure):
+            if failure.check(TimeoutError):
+                stats['timeouts'] += 1
+            return failure
+
+        d = self._request(url, headers)
+        d.addCallbacks(record_latency, count_timeout)
+        return d
+
+    def _hedged_request(self, url, headers, stats):
+        threshold = self._latency.percentile(_stats_key(url), 95)
+        if threshold is None:
+            return self._timed_request(url, headers, stats)
+
+        attempts = []
+        hedge_call = None
+
+        def cancel_all(_):
+            if hedge_call.active():
+                hedge_call.cancel()
+            for attempt in attempts:
+                attempt.cancel()
+
+        result = Deferred(cancel_all)
+
+        def on_success(value, attempt):
+            if not result.called:
+                if hedge_call.active():
+                    hedge_call.cancel()
+                if attempt is not attempts[0]:
+                    stats['hedgeWins'] += 1
+                result.callback(value)
+                for other in attempts:
+                    if other is not attempt:
+                        other.cancel()
+
+        def on_failure(failure, attempt):
+            if result.called or failure.check(CancelledError):
+                return
+            if not any(not other.called for other in attempts if other is not attempt):
+                if hedge_call.active():
+                    hedge_call.cancel()
+                result.errback(failure)
+
+        def launch():
+            attempt = self._timed_request(url, headers, stats)
+            attempts.append(attempt)
+            attempt.addCallbacks(on_success, on_failure, callbackArgs=(attempt,), errbackArgs=(attempt,))
+
+        def send_hedge():
+            stats['hedged'] += 1
+            launch()
+
+        hedge_call = reactor.callLater(threshold, send_hedge)
+        launch()
+        return result
+
+    def stats(self):
+        '''
+        Returns counters of requests made, bytes transferred (before
+        decoding) and callbacks skipped, keyed by URL (excluding any
+        query string), along with recent request latencies and the
+        current polling interval.
+        '''
+        stats = {key: dict(counters) for key, counters in self._stats.items()}
+        for key, counters in stats.items():
+            counters['effectiveInterval'] = self.effective_interval
+            counters['p50Latency'] = self._latency.percentile(key, 50)
+            counters['p95Latency'] = self._latency.percentile(key, 95)
+        return stats
+
     def start(self):
         self.running = True
         self._run()
@@ -64,15 +362,30 @@ class Fetcher(object):
         self.running = False
 
 
-def JSONFetcher(url, callback, interval):
+def JSONFetcher(url, callback, interval, parse_in_thread_above=DEFAULT_THREADED_PARSE_THRESHOLD, **kwargs):
+    '''
+    A Fetcher that passes parsed JSON to its callback. Bodies larger
+    than `parse_in_thread_above` bytes are parsed in the reactor's
+    thread pool rather than blocking the reactor; set it to None to
+    always parse on the reactor thread.
+    '''
+    def log_parse_error(failure, data):
+        failure.trap(simplejson.JSONDecodeError)
+        Logger().failure("Error parsing JSON from source {url}: {log_failure}. Full source was {source}", failure=failure, url=url, source=data)
+
     def parse_then_callback(data):
+        if parse_in_thread_above is not None and len(data) > parse_in_thread_above:
+            d = deferToThread(simplejson.loads, data)
+            d.addCallbacks(callback, log_parse_error, errbackArgs=(data,))
+            return d
+
         try:
             parsed_data = simplejson.loads(data)
-            callback(parsed_data)
+            return callback(parsed_data)
         except simplejson.JSONDecodeError:
             Logger().failure("Error parsing JSON from source {url}: {log_failure}. Full source was {source}", url=url, source=data)
-    return Fetcher(url, parse_then_callback, interval)
+    return Fetcher(url, parse_then_callback, interval, **kwargs)
 
 
-def MultiLineFetcher(url, callback, interval):
-    return Fetcher(url, lambda l: callback(l.splitlines()), interval)
+def MultiLineFetcher(url, callback, interval, **kwargs):
+    return Fetcher(url, lambda l: callback(l.splitlines()), interval, **kwargs)
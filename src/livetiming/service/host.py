@@ -0,0 +1,249 @@
+from autobahn.twisted.component import run
+from autobahn.twisted.wamp import ApplicationSession
+from livetiming import configure_sentry_twisted, load_env, make_component, sentry, VERSION
+from livetiming.network import authenticatedService
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.logger import Logger
+
+from . import get_plugin_source, load_plugin, parse_args
+from .session import join_service, leave_service
+from .standalone import StandaloneSession
+
+import argparse
+import codecs
+import os
+import signal
+import simplejson
+import txaio
+
+
+def parse_host_args(args=None):
+    parser = argparse.ArgumentParser(description='Run several Live Timing services in a single process.')
+
+    parser.add_argument('config_file', help='JSON file listing the services to run')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log to stdout rather than a file')
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--standalone', action='store_true', help='Run services in standalone configuration')
+    parser.add_argument('--thread-pool-size', type=int, help='Size of the thread pool shared by all services')
+
+    return parser.parse_args(args)
+
+
+def read_config(filename):
+    '''
+    Reads a service host configuration file. This is a JSON object
+    whose `services` map a key - used to identify each service across
+    reloads - to the command-line arguments that would be passed to
+    livetiming-service to run it, e.g.:
+
+      {
+        "services": {
+          "nls": ["nurburgring", "-d", "NLS 1", "--uuid", "nls1"],
+          "f1": ["f1", "--disable-analysis"]
+        }
+      }
+    '''
+    with open(filename, 'r') as config_file:
+        config = simplejson.load(config_file)
+    return config.get('services', {})
+
+
+def create_host_session(host):
+    class ServiceHostSession(ApplicationSession):
+
+        @inlineCallbacks
+        def onJoin(self, details):
+            host.log.info("Session ready for service host ({count} services)", count=len(host.services))
+            host.session = self
+            for service in list(host.services.values()):
+                yield host.attach(service)
+
+        def onLeave(self, details):
+            super(ServiceHostSession, self).onLeave(details)
+            host.log.info("Left WAMP session: {details}", details=details)
+
+        def onDisconnect(self):
+            host.log.info("Disconnected from live timing service")
+            host.session = None
+            for service in host.services.values():
+                service.set_publish(None)
+
+    return authenticatedService(ServiceHostSession)
+
+
+class ServiceHost(object):
+    '''
+    Runs several service plugins within one process. Each service keeps
+    its own UUID, state, recorder and analyser, but all share the
+    reactor (and its thread pool), the HTTP connection pool and a
+    single WAMP session - or, in standalone mode, each listens on its
+    own port.
+
+    Services are read from a configuration file (see read_config). On
+    SIGHUP the file is re-read, and services added, removed or
+    restarted to match it.
+    '''
+    log = Logger()
+
+    def __init__(self, config_file, standalone=False, debug=False):
+        self.config_file = config_file
+        self.standalone = standalone
+        self.debug = debug
+        self.session = None
+        self.services = {}
+
+        self._argv = {}
+        self._registrations = {}
+        self._standalone_sessions = {}
+        self._plugin_source = get_plugin_source()
+
+    def add_service(self, key, argv):
+        if key in self.services:
+            raise ValueError('A service with key {} is already running'.format(key))
+
+        args, extra_args = parse_args(argv)
+        args.standalone = args.standalone or self.standalone
+
+        with self._plugin_source:
+            module = load_plugin(self._plugin_source, args.service_class)
+            service = module.Service(args, extra_args)
+            service.host = self
+
+            self.services[key] = service
+            self._argv[key] = list(argv)
+
+            self.log.info(
+                "Starting {clazz} as {key} (uuid {uuid}, plugin version {plugin})",
+                clazz=args.service_class,
+                key=key,
+                uuid=service.uuid,
+                plugin=service.getVersion()
+            )
+            service.start()  # Calls back to attach()
+        return service
+
+    @inlineCallbacks
+    def remove_service(self, key):
+        service = self.services.pop(key)
+        self._argv.pop(key, None)
+
+        if service in self._standalone_sessions:
+            yield self._standalone_sessions.pop(service).stop()
+        elif service in self._registrations:
+            registrations = self._registrations.pop(service)
+            if self.session:
+                yield leave_service(self.session, service, registrations)
+
+        service.stop()
+        self.log.info("Removed service {key} (uuid {uuid})", key=key, uuid=service.uuid)
+
+    @inlineCallbacks
+    def attach(self, service):
+        '''
+        Connects a started service to the outside world: either its own
+        standalone server, or the shared WAMP session if there is one.
+        '''
+        if self.standalone:
+            if service not in self._standalone_sessions:
+                standalone = StandaloneSession(service)
+                port = standalone.listen(0)
+                self._standalone_sessions[service] = standalone
+                self.log.info(
+                    'Standalone server for uuid:{uuid} listening on port:{port}',
+                    uuid=service.uuid,
+                    port=port
+                )
+        elif self.session:
+            self._registrations[service] = yield join_service(self.session, service)
+
+    def _add_logging_failure(self, key, argv):
+        try:
+            self.add_service(key, argv)
+        except Exception:
+            self.log.failure("Unable to start service {key}: {log_failure}", key=key)
+            self.services.pop(key, None)
+            self._argv.pop(key, None)
+
+    @inlineCallbacks
+    def reload_config(self):
+        self.log.info("Reloading service host configuration from {file}", file=self.config_file)
+        try:
+            config = read_config(self.config_file)
+        except Exception:
+            self.log.failure("Unable to read configuration: {log_failure}")
+            return
+
+        for key in list(self.services.keys()):
+            if key not in config or config[key] != self._argv.get(key):
+                yield self.remove_service(key)
+
+        for key, argv in config.items():
+            if key not in self.services:
+                self._add_logging_failure(key, argv)
+
+    @inlineCallbacks
+    def stop(self):
+        for key in list(self.services.keys()):
+            yield self.remove_service(key)
+
+    def run(self):
+        '''
+        Starts all configured services, then runs the reactor until
+        interrupted.
+        '''
+        for key, argv in read_config(self.config_file).items():
+            self._add_logging_failure(key, argv)
+
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda *_: reactor.callFromThread(self.reload_config))
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+        if self.standalone:
+            reactor.run()
+        else:
+            component = make_component(create_host_session(self))
+            run(component, log_level='debug' if self.debug else 'info')
+
+        self.log.info("Service host terminated.")
+
+
+def main(argv=None):
+    load_env()
+    configure_sentry_twisted()
+    sentry()
+    args = parse_host_args(argv)
+
+    if 'LIVETIMING_ROUTER' not in os.environ:
+        args.standalone = True
+
+    if args.thread_pool_size:
+        reactor.suggestThreadPoolSize(args.thread_pool_size)
+
+    host = ServiceHost(args.config_file, standalone=args.standalone, debug=args.debug)
+    level = "debug" if args.debug else "info"
+
+    if args.verbose or args.standalone:
+        txaio.start_logging(level=level)
+        host.log.info("Timing71 version {core} service host", core=VERSION)
+        host.run()
+    else:
+        log_dir = os.environ.get("LIVETIMING_LOG_DIR", os.getcwd())
+
+        if not os.path.exists(log_dir):
+            os.mkdir(log_dir)
+
+        filepath = os.path.join(
+            log_dir,
+            "{}.log".format(os.path.splitext(os.path.basename(args.config_file))[0])
+        )
+
+        with codecs.open(filepath, mode='a', encoding='utf-8') as logFile:
+            txaio.start_logging(out=logFile, level=level)
+            host.log.info("Timing71 version {core} service host", core=VERSION)
+            host.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+from treq.client import HTTPClient
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredSemaphore
+from twisted.internet.interfaces import IHostnameResolver, IHostResolution, IResolutionReceiver
+from twisted.web.client import Agent, HTTPConnectionPool
+from zope.interface import implementer
+
+import os
+
+
+DEFAULT_MAX_PERSISTENT_PER_HOST = 4
+DEFAULT_MAX_CONCURRENT_PER_HOST = 8
+DEFAULT_CACHED_CONNECTION_TIMEOUT = 240
+DEFAULT_DNS_CACHE_TTL = 300
+
+_pool = None
+_resolver = None
+_agents = {}
+_http_client = None
+
+
+@implementer(IHostResolution)
+class _CachedResolution(object):
+    def __init__(self, name):
+        self.name = name
+
+    def cancel(self):
+        pass
+
+
+@implementer(IResolutionReceiver)
+class _CachingReceiver(object):
+    def __init__(self, resolver, key, receiver):
+        self._resolver = resolver
+        self._key = key
+        self._receiver = receiver
+        self._addresses = []
+
+    def resolutionBegan(self, resolution):
+        self._receiver.resolutionBegan(resolution)
+
+    def addressResolved(self, address):
+        self._addresses.append(address)
+        self._receiver.addressResolved(address)
+
+    def resolutionComplete(self):
+        if self._addresses:
+            self._resolver._store(self._key, self._addresses)
+        self._receiver.resolutionComplete()
+
+
+@implementer(IHostnameResolver)
+class CachingHostnameResolver(object):
+    '''
+    Wraps another hostname resolver, remembering successful results for
+    `ttl` seconds so that repeated requests to the same host don't each
+    need a DNS lookup.
+    '''
+    def __init__(self, resolver, ttl=DEFAULT_DNS_CACHE_TTL, clock=reactor):
+        self._resolver = resolver
+        self._ttl = ttl
+        self._clock = clock
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, key, addresses):
+        self._cache[key] = (self._clock.seconds() + self._ttl, addresses)
+
+    def resolveHostName(self, resolutionReceiver, hostName, portNumber=0, addressTypes=None, transportSemantics='TCP'):
+        key = (
+            hostName,
+            portNumber,
+            tuple(addressTypes) if addressTypes is not None else None,
+            transportSemantics
+        )
+        cached = self._cache.get(key)
+
+        if cached and cached[0] > self._clock.seconds():
+            self.hits += 1
+            resolution = _CachedResolution(hostName)
+            resolutionReceiver.resolutionBegan(resolution)
+            for address in cached[1]:
+                resolutionReceiver.addressResolved(address)
+            resolutionReceiver.resolutionComplete()
+            return resolution
+
+        self.misses += 1
+        self._cache.pop(key, None)
+        return self._resolver.resolveHostName(
+            _CachingReceiver(self, key, resolutionReceiver),
+            hostName,
+            portNumber,
+            addressTypes,
+            transportSemantics
+        )
+
+
+class CountingConnectionPool(HTTPConnectionPool):
+    '''
+    A persistent connection pool that keeps count of how many requests
+    were served by a new connection rather than a cached one.
+
+    If `maxConcurrentPerHost` is set, at most that many requests to each
+    host are in progress at once; others wait for one of them to finish
+    before getting a connection. A request finishes when its connection
+    is returned to the pool or closed, so its response body must be read
+    (or the connection lost) for the next to proceed.
+    '''
+    maxConcurrentPerHost = 0
+
+    def __init__(self, reactor, persistent=True):
+        super(CountingConnectionPool, self).__init__(reactor, persistent)
+        self.requests = 0
+        self.new_connections = 0
+        self.queued = 0
+        self._slots = {}
+        # Connections in use by a request holding one of the slots for key
+        self._busy = {}
+
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        if not self.maxConcurrentPerHost:
+            return super(CountingConnectionPool, self).getConnection(key, endpoint)
+
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = self._slots[key] = DeferredSemaphore(self.maxConcurrentPerHost)
+        if not slots.tokens:
+            self.queued += 1
+        d = slots.acquire()
+        d.addCallback(self._getConnectionWithSlot, key, endpoint)
+        return d
+
+    def _getConnectionWithSlot(self, slots, key, endpoint):
+        def checkedOut(connection):
+            # A cached connection may be wrapped so it can be retried
+            self._busy[getattr(connection, '_clientProtocol', connection)] = key
+            return connection
+
+        def failed(failure):
+            slots.release()
+            return failure
+
+        d = super(CountingConnectionPool, self).getConnection(key, endpoint)
+        d.addCallbacks(checkedOut, failed)
+        return d
+
+    def _releaseSlot(self, connection):
+        key = self._busy.pop(connection, None)
+        if key is not None:
+            # Not while the connection is still finishing its response
+            self._reactor.callLater(0, self._slots[key].release)
+
+    def _newConnection(self, key, endpoint):
+        self.new_connections += 1
+        d = super(CountingConnectionPool, self)._newConnection(key, endpoint)
+        if self.maxConcurrentPerHost:
+            d.addCallback(self._releaseSlotOnLoss)
+        return d
+
+    def _releaseSlotOnLoss(self, connection):
+        connectionLost = connection.connectionLost
+
+        def releasingConnectionLost(reason):
+            self._releaseSlot(connection)
+            return connectionLost(reason)
+        connection.connectionLost = releasingConnectionLost
+        return connection
+
+    def _putConnection(self, key, connection):
+        super(CountingConnectionPool, self)._putConnection(key, connection)
+        # Only now, so that a waiting request can reuse this connection
+        self._releaseSlot(connection)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'newConnections': self.new_connections,
+            'reusedConnections': self.requests - self.new_connections,
+            'idleConnections': sum(len(conns) for conns in self._connections.values()),
+            'activeRequests': len(self._busy),
+            'queuedRequests': self.queued,
+            'maxPersistentPerHost': self.maxPersistentPerHost,
+            'maxConcurrentPerHost': self.maxConcurrentPerHost,
+            'cachedConnectionTimeout': self.cachedConnectionTimeout
+        }
+
+
+def _install_resolver():
+    global _resolver
+    if _resolver is None:
+        ttl = int(os.environ.get('LIVETIMING_DNS_CACHE_TTL', DEFAULT_DNS_CACHE_TTL))
+        if ttl > 0:
+            _resolver = CachingHostnameResolver(reactor.nameResolver, ttl)
+            reactor.installNameResolver(_resolver)
+
+
+def get_pool():
+    '''
+    Returns the process-wide persistent HTTP connection pool, creating
+    it (and installing a caching DNS resolver on the reactor) if needed.
+
+    The number of idle connections kept per host, and how long they are
+    kept for, can be set with the LIVETIMING_HTTP_MAX_PER_HOST and
+    LIVETIMING_HTTP_IDLE_TIMEOUT environment variables; the number of
+    requests to each host in progress at once (0 for no limit) with
+    LIVETIMING_HTTP_MAX_CONCURRENT_PER_HOST.
+    '''
+    global _pool
+    if _pool is None:
+        _install_resolver()
+        _pool = CountingConnectionPool(reactor, persistent=True)
+        _pool.maxPersistentPerHost = int(
+            os.environ.get('LIVETIMING_HTTP_MAX_PER_HOST', DEFAULT_MAX_PERSISTENT_PER_HOST)
+        )
+        _pool.maxConcurrentPerHost = int(
+            os.environ.get('LIVETIMING_HTTP_MAX_CONCURRENT_PER_HOST', DEFAULT_MAX_CONCURRENT_PER_HOST)
+        )
+        _pool.cachedConnectionTimeout = int(
+            os.environ.get('LIVETIMING_HTTP_IDLE_TIMEOUT', DEFAULT_CACHED_CONNECTION_TIMEOUT)
+        )
+        reactor.addSystemEventTrigger('before', 'shutdown', _pool.closeCachedConnections)
+    return _pool
+
+
+def get_agent(connect_timeout=None):
+    '''
+    Returns an Agent using the process-wide connection pool, optionally
+    with a timeout (in seconds) for establishing new connections.
+    '''
+    agent = _agents.get(connect_timeout)
+    if agent is None:
+        agent = _agents[connect_timeout] = Agent(reactor, connectTimeout=connect_timeout, pool=get_pool())
+    return agent
+
+
+def get_http_client():
+    '''
+    Returns a treq HTTPClient sharing the process-wide connection pool.
+    '''
+    global _http_client
+    if _http_client is None:
+        _http_client = HTTPClient(get_agent())
+    return _http_client
+
+
+def pool_stats():
+    stats = get_pool().stats()
+    if _resolver:
+        stats['dnsCacheHits'] = _resolver.hits
+        stats['dnsCacheMisses'] = _resolver.misses
+    return stats
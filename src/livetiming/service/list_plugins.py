@@ -1,4 +1,5 @@
-from livetiming.service import get_plugin_source
+from livetiming.service import get_plugin_source, load_plugin
+from livetiming.service.registry import get_registry, save_registry
 
 import argparse
 import simplejson
@@ -17,36 +18,48 @@ def main():
         action='store_true',
         help='Give human-readable output (default is to output JSON)'
     )
+    parser.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='Rebuild the cached plugin registry'
+    )
 
     args = parser.parse_args()
 
-    with get_plugin_source() as source:
-        plugins = list(
-            filter(
-                lambda p: p[0] != '_',
-                source.list_plugins()
-            )
+    registry = get_registry(rebuild=args.rebuild)
+    plugins = sorted(
+        filter(
+            lambda p: p[0] != '_',
+            set(registry['plugins']) | set(registry['entryPoints'].keys())
         )
+    )
+
+    missing = [p for p in plugins if p not in registry['specs']]
+    if missing:
+        with get_plugin_source() as source:
+            for p in missing:
+                registry['specs'][p] = getattr(load_plugin(source, p), '__spec', {})
+        save_registry(registry)
+
+    plugin_stats = {
+        p: registry['specs'][p] for p in plugins
+    }
 
-        plugin_stats = {
-            p: getattr(source.load_plugin(p), '__spec', {}) for p in plugins
-        }
-
-        if args.human_readable:
-            if plugin_stats:
-                print('Available plugins:')
-                for name, plugin in plugin_stats.items():
-                    print('{}{}{}'.format(
-                        BOLD,
-                        name,
-                        END
-                    ))
-                    if 'description' in plugin:
-                        print('\t{}'.format(plugin['description']))
-            else:
-                print('No plugins available')
+    if args.human_readable:
+        if plugin_stats:
+            print('Available plugins:')
+            for name, plugin in plugin_stats.items():
+                print('{}{}{}'.format(
+                    BOLD,
+                    name,
+                    END
+                ))
+                if 'description' in plugin:
+                    print('\t{}'.format(plugin['description']))
         else:
-            print(simplejson.dumps(plugin_stats))
+            print('No plugins available')
+    else:
+        print(simplejson.dumps(plugin_stats))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,140 @@
+'''
+A persistent cache of where service plugins can be found, so that
+starting a service doesn't need to search every entry on sys.path.
+
+The cache is keyed on the modification times of each sys.path entry
+(which change when distributions are installed or removed) and of each
+plugin directory and its contents; if any of these change, it is
+rebuilt automatically. `livetiming-plugins --rebuild` rebuilds it
+explicitly.
+
+Besides modules in a livetiming/service/plugins namespace directory,
+installed distributions may provide plugins through entry points in
+the `livetiming.service.plugins` group, naming the plugin's module.
+'''
+from twisted.logger import Logger
+
+try:
+    from importlib import metadata
+except ImportError:  # Python < 3.8
+    import importlib_metadata as metadata
+
+import hashlib
+import os
+import pkgutil
+import simplejson
+import sys
+
+
+ENTRY_POINT_GROUP = 'livetiming.service.plugins'
+PLUGIN_SUBDIR = os.path.join('livetiming', 'service', 'plugins')
+
+_log = Logger()
+_registry = None
+
+
+def cache_file():
+    '''
+    Returns the path of the registry cache for this Python environment.
+    This can be overridden with the LIVETIMING_PLUGIN_CACHE environment
+    variable.
+    '''
+    if 'LIVETIMING_PLUGIN_CACHE' in os.environ:
+        return os.environ['LIVETIMING_PLUGIN_CACHE']
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    prefix_hash = hashlib.sha1(sys.prefix.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(cache_dir, 'livetiming', 'plugins-{}.json'.format(prefix_hash))
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _plugin_dir_mtime(plugin_dir):
+    mtime = _mtime(plugin_dir)
+    if mtime is not None:
+        for entry in os.listdir(plugin_dir):
+            mtime = max(mtime, _mtime(os.path.join(plugin_dir, entry)) or 0)
+    return mtime
+
+
+def _search_path(entry):
+    return os.path.abspath(entry or os.curdir)
+
+
+def fingerprint():
+    return [
+        [entry, _mtime(_search_path(entry)), _plugin_dir_mtime(os.path.join(_search_path(entry), PLUGIN_SUBDIR))]
+        for entry in sys.path
+    ]
+
+
+def _entry_points():
+    try:
+        entry_points = metadata.entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:
+        # Python 3.8/3.9, or importlib_metadata < 3.6: a dict of groups
+        entry_points = metadata.entry_points().get(ENTRY_POINT_GROUP, [])
+    return {ep.name: ep.value.split(':', 1)[0] for ep in entry_points}
+
+
+def build_registry():
+    paths = [
+        entry for entry in sys.path
+        if os.path.isdir(os.path.join(_search_path(entry), PLUGIN_SUBDIR))
+    ]
+    plugins = set()
+    for entry in paths:
+        plugins.update(
+            name for _, name, _ in pkgutil.iter_modules([os.path.join(_search_path(entry), PLUGIN_SUBDIR)])
+        )
+    return {
+        'fingerprint': fingerprint(),
+        'paths': paths,
+        'plugins': sorted(plugins),
+        'entryPoints': _entry_points(),
+        'specs': {}
+    }
+
+
+def _read_cache():
+    try:
+        with open(cache_file(), 'r') as cache:
+            return simplejson.load(cache)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_registry(registry):
+    filename = cache_file()
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'w') as cache:
+            simplejson.dump(registry, cache)
+        os.replace(tmp_filename, filename)
+    except (IOError, OSError):
+        _log.debug("Unable to write plugin registry cache to {file}", file=filename)
+
+
+def get_registry(rebuild=False):
+    '''
+    Returns the plugin registry, from the in-process copy or the cache
+    file if they are still valid, otherwise by rebuilding it.
+    '''
+    global _registry
+    current = fingerprint()
+
+    if not rebuild and _registry and _registry['fingerprint'] == current:
+        return _registry
+
+    registry = None if rebuild else _read_cache()
+    if not registry or registry.get('fingerprint') != current:
+        registry = build_registry()
+        save_registry(registry)
+
+    _registry = registry
+    return registry
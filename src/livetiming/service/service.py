@@ -3,19 +3,21 @@ from autobahn.twisted.component import run
 from autobahn.wamp.types import PublishOptions
 from livetiming import make_component, VERSION
 from livetiming.analysis import Analyser
+from livetiming.analysis.worker import AnalysisBacklogFull, AnalysisWorker
 from livetiming.messages import FlagChangeMessage, CarPitMessage,\
-    DriverChangeMessage, FastLapMessage
+    CarPairs, DriverChangeMessage, FastLapMessage, PerCarMessage
+from livetiming.metrics import Metrics, RATIO_BUCKETS
 from livetiming.network import Channel, Message, MessageClass, RPC
 from livetiming.racing import Stat
 from lzstring import LZString
-from treq.client import HTTPClient
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall, deferLater
 from twisted.internet.threads import deferToThread
 from twisted.logger import Logger
-from twisted.web import client
+from twisted.python.threadable import isInIOThread
 from uuid import uuid4
 
+from .http import get_http_client, pool_stats
 from .session import create_service_session
 from .standalone import StandaloneSession
 
@@ -24,7 +26,6 @@ import os
 import sentry_sdk
 import simplejson
 import sys
-import time
 
 try:
     from livetiming_orchestration.dvr import DirectoryTimingRecorder as TimingRecorder
@@ -117,6 +118,13 @@ class AbstractService(ABC):
         No filtering is performed; all values herein will be sent to
         clients. This means they need to be serializable e.g. plain
         Python types, not objects.
+
+        Ownership of the returned object passes to the service: it is
+        shared, without copying, between the service state, message
+        generators, the analyser and the recorder. Implementations must
+        therefore build new 'cars' and 'session' objects on each call,
+        and must not mutate a state once it has been returned. Run with
+        --debug to have violations of this contract reported.
         '''
         pass
 
@@ -162,13 +170,20 @@ class AbstractService(ABC):
 
 class ManifestPublisher(object):
     '''
-    Rate-limits calls to publishManifest to at most once per second.
+    Rate-limits calls to publishManifest to at most once per second, and
+    only publishes (and records) the manifest if it has changed since it
+    was last published - unless `force` is given, e.g. when the directory
+    has asked for it.
     '''
     def __init__(self):
         super().__init__()
         self._last_deferred = None
+        self._manifest_message = None
+        self._published_manifest = None
+        self._force_manifest_publish = False
 
-    def publishManifest(self):
+    def publishManifest(self, force=False):
+        self._force_manifest_publish = self._force_manifest_publish or force
         if not self._last_deferred or self._last_deferred.called:
             self._last_deferred = deferLater(
                 reactor,
@@ -178,48 +193,148 @@ class ManifestPublisher(object):
 
     def _publish_manifest_actual(self):
         manifest = self._createServiceRegistration()
-        self.publish(Channel.CONTROL, Message(MessageClass.SERVICE_REGISTRATION, manifest).serialise())
-        if self.recorder:
-            self.recorder.writeManifest(manifest)
+        force, self._force_manifest_publish = self._force_manifest_publish, False
+
+        if manifest == self._published_manifest and not force:
+            self.metrics.increment('manifest_publishes_suppressed')
+            return
+
+        self.publish(Channel.CONTROL, self._current_manifest_message(manifest))
+        if self.recorder and manifest != self._published_manifest:
+            # The recorder adds its own fields to the manifest it's given
+            self.recorder.writeManifest(copy.deepcopy(manifest))
+        self._published_manifest = manifest
+
+    def _current_manifest_message(self, manifest=None):
+        '''
+        Returns the serialised manifest message, reusing the last one
+        created unless the manifest has since changed.
+        '''
+        if self._manifest_message is None or (manifest is not None and manifest != self._manifest_message['payload']):
+            self._manifest_message = Message(
+                MessageClass.SERVICE_REGISTRATION,
+                manifest if manifest is not None else self._createServiceRegistration()
+            ).serialise()
+        return self._manifest_message
 
 
 class DuePublisher(object):
     '''
     Disables auto_poll and instead will call _updateAndPublishRaceState
-    at most once per second and at least once every
+    as soon as set_due_publish() is called - but no more often than
+    every min_publish_interval seconds, so that bursts of updates are
+    coalesced into a single publish - and at least once every
     max_publish_interval seconds.
     '''
     auto_poll = False
+    min_publish_interval = 0.2
     max_publish_interval = 60
 
     def __init__(self, *args, **kwargs):
         super(DuePublisher, self).__init__(*args, **kwargs)
         self._due_publish = False
-        self._last_publish_time = time.time()
+        self._last_publish_time = 0
+        self._publishing = False
+        self._pending_publish = None
+        self._heartbeat = None
 
     def set_due_publish(self):
         '''
         Set a flag indicating that new data is available to be published.
 
         No matter how frequently this method is called, data will be
-        published according to the constraints set by this class.
+        published according to the constraints set by this class. It is
+        safe to call from any thread.
         '''
         self._due_publish = True
+        if isInIOThread():
+            self._schedule_publish()
+        else:
+            reactor.callFromThread(self._schedule_publish)
+
+    def _schedule_publish(self):
+        if not self._publishing or not self._due_publish:
+            return
+        if self._pending_publish and self._pending_publish.active():
+            return
+        delay = self._last_publish_time + self.min_publish_interval - reactor.seconds()
+        self._pending_publish = reactor.callLater(max(0, delay), self._publish_due)
+
+    def _schedule_heartbeat(self):
+        if self._heartbeat and self._heartbeat.active():
+            self._heartbeat.cancel()
+        self._heartbeat = reactor.callLater(self.max_publish_interval, self._publish_due)
+
+    def _cancel_scheduled(self):
+        for call in [self._pending_publish, self._heartbeat]:
+            if call and call.active():
+                call.cancel()
+        self._pending_publish = None
+        self._heartbeat = None
+
+    def _publish_due(self):
+        if self._pending_publish and self._pending_publish.active():
+            self._pending_publish.cancel()
+        self._pending_publish = None
+        self._due_publish = False
 
-    def start(self):
-        def maybePublish():
-            now = time.time()
-            if self._due_publish or (now - self._last_publish_time) > self.max_publish_interval:
-                self.log.debug('Publishing race state update')
-                self._updateAndPublishRaceState()
-                self._due_publish = False
-                self._last_publish_time = time.time()
+        self.log.debug('Publishing race state update')
+        try:
+            self._updateAndPublishRaceState()
+        except Exception:
+            self.log.failure('Exception while publishing race state: {log_failure}')
+        finally:
+            self._last_publish_time = reactor.seconds()
+            if self._publishing:
+                self._schedule_heartbeat()
+                # Data may have arrived while we were publishing
+                self._schedule_publish()
 
-        self.log.info('Polling for publishable state updates.')
-        LoopingCall(maybePublish).start(1)
+    def start(self):
+        self.log.info('Publishing state updates as they become due.')
+        self._publishing = True
+        self._schedule_heartbeat()
+        self._schedule_publish()
 
         super(DuePublisher, self).start()
 
+    def stop(self):
+        self._publishing = False
+        self._cancel_scheduled()
+        super(DuePublisher, self).stop()
+
+
+class _SnapshotGuard(object):
+    '''
+    Debug-mode check that plugins do not mutate a state after handing
+    it over from getRaceState(). Keeps a private deep copy of the last
+    snapshot and compares it with the shared original on the next
+    update.
+    '''
+    def __init__(self, log):
+        self.log = log
+        self._snapshot = None
+        self._pristine = None
+
+    def track(self, state):
+        self._snapshot = state
+        self._pristine = {
+            'cars': copy.deepcopy(state['cars']),
+            'session': copy.deepcopy(state['session'])
+        }
+
+    def check(self):
+        if self._snapshot is None:
+            return True
+        for key in ['cars', 'session']:
+            if self._snapshot[key] != self._pristine[key]:
+                self.log.error(
+                    'Race state \'{key}\' was mutated after being returned from getRaceState()!',
+                    key=key
+                )
+                return False
+        return True
+
 
 class BaseService(AbstractService, ManifestPublisher):
     '''
@@ -231,9 +346,24 @@ class BaseService(AbstractService, ManifestPublisher):
     '''
     log = Logger()
 
+    host = None
+    '''
+    The ServiceHost running this service, if it is one of several
+    services running within a single process.
+    '''
+
+    compress_messages = True
+    '''
+    Whether state is LZString-compressed before publishing. Standalone
+    binary mode turns this off, leaving compression to the WebSocket
+    connection instead.
+    '''
+
     def __init__(self, args, extra_args={}):
         super().__init__()
         self.args = args
+        self._tasks = []
+        self._shutdown_trigger = None
 
         if self.args.initial_state is not None:
             self.uuid = os.path.splitext(os.path.basename(self.args.initial_state))[0]
@@ -242,6 +372,8 @@ class BaseService(AbstractService, ManifestPublisher):
         else:
             self.uuid = uuid4().hex
 
+        self.metrics = Metrics(enabled=self.args.metrics or bool(os.environ.get('LIVETIMING_METRICS')))
+
         self.state = self._getInitialState()
         if self.args.recording_file is not None:
             self.recorder = TimingRecorder(self.args.recording_file)
@@ -250,19 +382,44 @@ class BaseService(AbstractService, ManifestPublisher):
 
         if self.args.disable_analysis:
             self.analyser = None
+            self.analysis_worker = None
         else:
             self.analyser = Analyser(
                 self.uuid,
                 self.publish,
-                interval=1 if self.args.standalone else self.getPollInterval()
+                interval=1 if self.args.standalone else self.getPollInterval(),
+                batch=self.args.analysis_batch,
+                compression_threshold=self.args.analysis_compression_threshold,
+                metrics=self.metrics
+            )
+            self.analysis_worker = AnalysisWorker(
+                self.analyser,
+                max_backlog=self.args.analysis_backlog,
+                overload_policy=self.args.analysis_overload,
+                metrics=self.metrics
             )
+            self.metrics.add_source('analysis', self.analysis_worker.stats)
         self._publish = None
+        self._state_message = None
+        self._snapshot_guard = _SnapshotGuard(self.log) if self.args.debug else None
+        self._copy_snapshots = False
 
-        with sentry_sdk.configure_scope() as scope:
-            scope.set_tag('uuid', self.uuid)
-            scope.set_tag('service_name', self._getServiceClass())
+        self.http_client = get_http_client()
+        self.metrics.add_source('http', pool_stats)
+
+    @property
+    def sentry_tags(self):
+        '''
+        Tags identifying this service in errors reported to Sentry.
+        '''
+        return {
+            'uuid': self.uuid,
+            'service_name': self._getServiceClass()
+        }
 
-        self.http_client = HTTPClient(client.Agent(reactor))
+    def _capture_exception(self, e):
+        # Tagged per capture, as a ServiceHost runs several services
+        sentry_sdk.capture_exception(e, tags=self.sentry_tags)
 
     def set_publish(self, func):
         '''
@@ -288,21 +445,33 @@ class BaseService(AbstractService, ManifestPublisher):
 
         This method calls autobahn.twisted.component#run and so will
         block until the session terminates (usually as a result of an
-        interrupt or an error).
+        interrupt or an error) - unless the service is being run by a
+        ServiceHost, in which case the host's connection is used and
+        this method returns immediately.
         '''
 
         if self.auto_poll:
-            updater = LoopingCall(self._updateAndPublishRaceState)
-            updater.start(self.getPollInterval(), False)
+            self._start_task(LoopingCall(self._updateAndPublishRaceState), self.getPollInterval(), False)
             self.log.info("Race state updates started")
 
-        if self.analyser and not self.args.no_write_state:
-            def saveAsync():
-                self.log.debug("Saving data centre state")
-                return deferToThread(self.analyser.save_data_centre)
-            LoopingCall(saveAsync).start(60)
-            LoopingCall(self.analyser._publish_pending).start(1)
+        if self.analyser:
+            if not self.args.no_write_state:
+                def saveAsync():
+                    self.log.debug("Saving data centre state")
+                    return deferToThread(self.analyser.save_data_centre)
+                self._start_task(LoopingCall(saveAsync), 60)
+            self._start_task(LoopingCall(self.analyser._publish_pending), 1)
+            self._start_task(LoopingCall(self.analyser.refresh_snapshot), 1)
             self.analyser.publish_all()
+            self._shutdown_trigger = reactor.addSystemEventTrigger('before', 'shutdown', self.analysis_worker.stop)
+
+        if self.host:
+            self.host.attach(self)
+            return
+
+        # The only service in this process: tag everything reported with it
+        for tag, value in self.sentry_tags.items():
+            sentry_sdk.set_tag(tag, value)
 
         if 'LIVETIMING_ROUTER' not in os.environ:
             self.log.info('LIVETIMING_ROUTER not set, forcing standalone mode.')
@@ -321,12 +490,40 @@ class BaseService(AbstractService, ManifestPublisher):
             component = make_component(session_class)
             run(component, log_level='debug' if self.args.debug else 'info')
 
+        self._finalise_recording()
+        self.log.info("Service terminated.")
+
+    def stop(self):
+        '''
+        Stops the looping calls and analysis started by start(). This is
+        used when a hosted service is removed from its ServiceHost;
+        plugins that start their own fetchers or connections should
+        override this method to stop those too, and call super().stop().
+        '''
+        for task in self._tasks:
+            if task.running:
+                task.stop()
+        self._tasks = []
+
+        if self.analysis_worker:
+            self.analysis_worker.stop()
+        if self._shutdown_trigger:
+            reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            self._shutdown_trigger = None
+
+        self.set_publish(None)
+        self._finalise_recording()
+        self.log.info("Service {uuid} stopped.", uuid=self.uuid)
+
+    def _start_task(self, looping_call, interval, now=True):
+        self._tasks.append(looping_call)
+        looping_call.start(interval, now)
+
+    def _finalise_recording(self):
         if self.recorder and hasattr(self.recorder, 'finalise'):
             zip_name = self.recorder.finalise()
             self.log.info('Finalised recording {zipname}', zipname=zip_name)
 
-        self.log.info("Service terminated.")
-
     #################################################
     # These methods MAY be overridden by subclasses #
     #################################################
@@ -351,7 +548,7 @@ class BaseService(AbstractService, ManifestPublisher):
                     return simplejson.load(stateFile)
                 except Exception as e:
                     self.log.failure("Exception trying to load saved state: {log_failure}")
-                    sentry_sdk.capture_exception(e)
+                    self._capture_exception(e)
         return {
             "messages": [],
             "session": {
@@ -379,9 +576,10 @@ class BaseService(AbstractService, ManifestPublisher):
                     simplejson.dump(self.state, stateFile)
                 except Exception as e:
                     self.log.failure("Exception while saving state: {log_failure}")
-                    sentry_sdk.capture_exception(e)
+                    self._capture_exception(e)
             if self.recorder:
-                self.recorder.writeState(self.state)
+                with self.metrics.time('recorder_write'):
+                    self.recorder.writeState(self.state)
 
     def _createServiceRegistration(self):
         colspec = [s.value if isinstance(s, Stat) else s for s in self.getColumnSpec()]
@@ -429,41 +627,151 @@ class BaseService(AbstractService, ManifestPublisher):
 
     def _updateRaceState(self):
         try:
-            newState = self.getRaceState()
-            new_messages = self._createMessages(self.state, newState)
+            if self._snapshot_guard:
+                self._snapshot_guard.check()
+            with self.metrics.time('get_race_state'):
+                rawState = self.getRaceState()
+            with self.metrics.time('take_ownership'):
+                newState = self._takeOwnership(rawState)
+            if self._snapshot_guard:
+                self._snapshot_guard.track(newState)
+
+            with self.metrics.time('create_messages'):
+                new_messages = self._createMessages(self.state, newState)
             self.state["highlight"] = list(set([m[4] for m in new_messages if len(m) >= 5]))  # list -> set to uniquify, -> list again to serialise
             self.state["messages"] = (new_messages + self.state["messages"])[0:100]
-            self.state["cars"] = copy.deepcopy(newState["cars"])
-            self.state["session"] = copy.deepcopy(newState["session"])
-
-            if self.analyser:
-                reactor.callInThread(  # This could take some time, let's be sure to not block the reactor
-                    self.analyser.receiveStateUpdate,
-                    newState,
-                    self.getColumnSpec(),
-                    new_messages=new_messages
-                )
+            self.state["cars"] = newState["cars"]
+            self.state["session"] = newState["session"]
 
-            self._saveState()
+            if self.analysis_worker:
+                try:
+                    self.analysis_worker.submit(
+                        newState,
+                        self.getColumnSpec(),
+                        new_messages=new_messages
+                    )
+                except AnalysisBacklogFull as e:
+                    self.log.critical("Analysis is not keeping up with state updates: {e}", e=e)
+                    self._capture_exception(e)
+
+            with self.metrics.time('save_state'):
+                self._saveState()
         except Exception as e:
             self.log.failure("Exception while updating race state: {log_failure}")
-            sentry_sdk.capture_exception(e)
+            self._capture_exception(e)
 
-    def _publishRaceState(self):
-        self.publish(
-            RPC.STATE_PUBLISH.format(self.uuid),
-            Message(
-                MessageClass.SERVICE_DATA_COMPRESSED,
-                LZString().compressToUTF16(simplejson.dumps(self.state)),
+    def _takeOwnership(self, newState):
+        '''
+        Guards against the most common breaches of the getRaceState()
+        ownership contract - returning the same objects, or the same car
+        rows in a new list, as last time - which would otherwise leave
+        nothing to compare against when generating messages. Once
+        detected, states from this plugin are always copied, as they
+        used to be.
+        '''
+        if not self._copy_snapshots and self._reuses_previous_state(newState):
+            self.log.warn(
+                'getRaceState() returned the same objects as the previous update; '
+                'falling back to copying every state. Plugins should return a new state on each call.'
+            )
+            self._copy_snapshots = True
+
+        if self._copy_snapshots:
+            owned = copy.copy(newState)
+            owned["cars"] = copy.deepcopy(newState["cars"])
+            owned["session"] = copy.deepcopy(newState["session"])
+            return owned
+        return newState
+
+    def _reuses_previous_state(self, newState):
+        if newState["cars"] is self.state["cars"] or newState["session"] is self.state["session"]:
+            return True
+        # The previous rows are still alive, so their ids can't have been reused
+        previous_rows = {id(row) for row in self.state["cars"]}
+        return any(id(row) in previous_rows for row in newState["cars"])
+
+    def _create_state_message(self):
+        if not self.compress_messages:
+            return Message(
+                MessageClass.SERVICE_DATA,
+                dict(self.state),  # self.state is updated in place
                 retain=True
-            ).serialise(),
-            options=PublishOptions(retain=True)
-        )
+            ).serialise()
+
+        with self.metrics.time('serialise'):
+            serialised = simplejson.dumps(self.state)
+        with self.metrics.time('compress'):
+            compressed = LZString().compressToUTF16(serialised)
+
+        if self.metrics.enabled:
+            compressed_bytes = 2 * len(compressed)  # UTF-16
+            self.metrics.increment('bytes_serialised', len(serialised))
+            self.metrics.increment('bytes_published', compressed_bytes)
+            if serialised:
+                self.metrics.observe('compression_ratio', compressed_bytes / len(serialised), RATIO_BUCKETS)
+
+        return Message(
+            MessageClass.SERVICE_DATA_COMPRESSED,
+            compressed,
+            retain=True
+        ).serialise()
+
+    def _publishRaceState(self):
+        self._state_message = self._create_state_message()
+
+        with self.metrics.time('publish'):
+            self.publish(
+                RPC.STATE_PUBLISH.format(self.uuid),
+                self._state_message,
+                options=PublishOptions(retain=True)
+            )
+
+    def initial_sync_messages(self):
+        '''
+        Returns a list of (channel, message) pairs that bring a newly
+        connected client up to date: the manifest, the most recently
+        published state and all analysis data. These are cached rather
+        than regenerated for each client, and are meant to be sent only
+        to that client rather than broadcast.
+        '''
+        if self._state_message is None:
+            self._state_message = self._create_state_message()
+
+        messages = [
+            (Channel.CONTROL, self._current_manifest_message()),
+            (RPC.STATE_PUBLISH.format(self.uuid), self._state_message)
+        ]
+        if self.analyser:
+            messages += self.analyser.initial_sync_messages()
+        return messages
+
+    # The *_snapshot methods return a (token, data) pair for serving over
+    # HTTP; the token is replaced whenever the data changes.
+
+    def state_snapshot(self):
+        if self._state_message is None:
+            self._state_message = self._create_state_message()
+        return self._state_message, self.state
+
+    def manifest_snapshot(self):
+        message = self._current_manifest_message()
+        return message, message['payload']
+
+    def analysis_snapshot(self, key):
+        if not self.analyser:
+            return None
+        data = self.analyser.snapshot.data
+        if key not in data:
+            return None
+        # Each key's data is replaced, not changed, when it is rebuilt
+        return data[key], data[key]
 
     def _updateAndPublishRaceState(self):
         self.log.debug("Updating and publishing timing data for {}".format(self.uuid))
-        self._updateRaceState()
-        self._publishRaceState()
+        self.metrics.increment('updates')
+        with self.metrics.time('update_and_publish'):
+            self._updateRaceState()
+            self._publishRaceState()
 
     def _getMessageGenerators(self):
         return [
@@ -476,21 +784,28 @@ class BaseService(AbstractService, ManifestPublisher):
     def _createMessages(self, oldState, newState):
         # Messages are of the form [time, category, text, messageType]
         messages = []
+        pairing = CarPairs(oldState, newState, self.getColumnSpec())
         for mg in self._getMessageGenerators() + self.getExtraMessageGenerators():
             try:
-                messages += mg.process(oldState, newState)
+                if isinstance(mg, PerCarMessage):
+                    messages += mg.process(oldState, newState, pairing=pairing)
+                else:
+                    messages += mg.process(oldState, newState)
             except Exception as e:
                 self.log.failure("Exception while generating messages: {log_failure}")
-                sentry_sdk.capture_exception(e)
+                self._capture_exception(e)
 
         return messages
 
     def _requestCurrentState(self):
         return simplejson.loads(simplejson.dumps(self.state))
 
+    def _requestMetrics(self):
+        return self.metrics.snapshot()
+
     def _requestCurrentAnalysisState(self):
         if self.analyser:
-            return self.analyser.get_current_state()
+            return self.analyser.snapshot.data
         return None
 
     def onControlMessage(self, message):
@@ -498,4 +813,4 @@ class BaseService(AbstractService, ManifestPublisher):
         self.log.debug("Received message {msg}", msg=msg)
         if msg.msgClass == MessageClass.INITIALISE_DIRECTORY:
             self.log.info("Publishing manifest on request of directory service.")
-            self.publishManifest()
+            self.publishManifest(force=True)
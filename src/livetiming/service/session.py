@@ -1,30 +1,60 @@
 from autobahn.twisted.wamp import ApplicationSession
+from autobahn.wamp.request import Registration
 from autobahn.wamp.types import PublishOptions, RegisterOptions
 from livetiming.network import Channel, RPC, authenticatedService
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+
+def _is_alive():
+    return True
+
+
+@inlineCallbacks
+def join_service(session, service):
+    '''
+    Connects a service to a joined WAMP session: registers its RPC
+    endpoints, subscribes it to the control channel and publishes its
+    manifest and state. Returns the resulting registrations and
+    subscriptions, so that they can later be passed to leave_service.
+    '''
+    service.log.info("Session ready for service {uuid}", uuid=service.uuid)
+    service.set_publish(session.publish)
+
+    register_opts = RegisterOptions(force_reregister=True)
+
+    registrations = []
+    registrations.append((yield session.register(_is_alive, RPC.LIVENESS_CHECK.format(service.uuid), register_opts)))
+    registrations.append((yield session.register(service._requestCurrentState, RPC.REQUEST_STATE.format(service.uuid), register_opts)))
+    registrations.append((yield session.register(service._requestCurrentAnalysisState, RPC.REQUEST_ANALYSIS_DATA.format(service.uuid), register_opts)))
+    registrations.append((yield session.register(service._requestMetrics, RPC.REQUEST_METRICS.format(service.uuid), register_opts)))
+    registrations.append((yield session.subscribe(service.onControlMessage, Channel.CONTROL)))
+    service.log.info("Subscribed to control channel")
+    yield service.publishManifest(force=True)
+    service.log.info("Published init message")
+    service._updateAndPublishRaceState()
+
+    returnValue(registrations)
+
+
+@inlineCallbacks
+def leave_service(session, service, registrations):
+    service.set_publish(None)
+    if session.is_attached():
+        for registration in registrations:
+            if not registration.active:
+                continue
+            if isinstance(registration, Registration):
+                yield registration.unregister()
+            else:
+                yield registration.unsubscribe()
 
 
 def create_service_session(service):
     class ServiceSession(ApplicationSession):
 
-        def _isAlive(self):
-            return True
-
         @inlineCallbacks
         def onJoin(self, details):
-            service.log.info("Session ready for service {uuid}", uuid=service.uuid)
-            service.set_publish(self.publish)
-
-            register_opts = RegisterOptions(force_reregister=True)
-
-            yield self.register(self._isAlive, RPC.LIVENESS_CHECK.format(service.uuid), register_opts)
-            yield self.register(service._requestCurrentState, RPC.REQUEST_STATE.format(service.uuid), register_opts)
-            yield self.register(service._requestCurrentAnalysisState, RPC.REQUEST_ANALYSIS_DATA.format(service.uuid), register_opts)
-            yield self.subscribe(service.onControlMessage, Channel.CONTROL)
-            self.log.info("Subscribed to control channel")
-            yield service.publishManifest()
-            self.log.info("Published init message")
-            service._updateAndPublishRaceState()
+            yield join_service(self, service)
 
         def onLeave(self, details):
             super(ServiceSession, self).onLeave(details)
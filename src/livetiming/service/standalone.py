@@ -1,21 +1,165 @@
+from autobahn.twisted.resource import WebSocketResource
 from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
+from autobahn.websocket.protocol import WebSocketProtocol
+from autobahn.websocket.compress import PerMessageDeflate, PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from collections import deque
+from livetiming.metrics import Metrics
 from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from twisted.logger import Logger
+from twisted.web.resource import NoResource, Resource
+from twisted.web.server import Site
+from zope.interface import implementer
 
 try:
     import upnpy
 except ModuleNotFoundError:
     upnpy = None
 
+import gzip
+import hashlib
+import ipaddress
 import os
 import simplejson
 import socket
 import txaio
+import zlib
+
+
+DEFAULT_MAX_QUEUED_BYTES = 16 * 1024 * 1024
+
+
+def _shared_deflate(protocol):
+    '''
+    Returns the permessage-deflate extension negotiated by `protocol`, if
+    it was negotiated without server context takeover (so that messages
+    compressed once can be sent as-is to any such client), else None.
+    '''
+    for extension in getattr(protocol, 'websocket_extensions_in_use', None) or []:
+        if isinstance(extension, PerMessageDeflate) and extension.server_no_context_takeover:
+            return extension
+    return None
+
+
+class Broadcast(object):
+    '''
+    A message being sent to every client. Clients that negotiated
+    permessage-deflate without server context takeover are all sent the
+    same compressed payload, which is compressed only once (per window
+    size); other clients get the shared prepared message as usual.
+    '''
+    def __init__(self, factory, payload):
+        self.factory = factory
+        self.payload = payload
+        self.prepared = factory.prepareMessage(payload, isBinary=factory.binary)
+        self._compressed = {}
+
+    def _compressed_payload(self, window_bits, mem_level):
+        key = (window_bits, mem_level)
+        compressed = self._compressed.get(key)
+        if compressed is None:
+            with self.factory.metrics.time('ws_compress'):
+                compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -window_bits, mem_level)
+                # Strip the empty block's trailer, as permessage-deflate requires
+                compressed = (compressor.compress(self.payload) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+            self._compressed[key] = compressed
+            self.factory.metrics.increment('ws_bytes_uncompressed', len(self.payload))
+            self.factory.metrics.increment('ws_bytes_compressed', len(compressed))
+        return compressed
+
+    def send_to(self, protocol):
+        pmce = _shared_deflate(protocol)
+        if pmce is not None and protocol.state == WebSocketProtocol.STATE_OPEN:
+            # RSV1 marks the frame as compressed
+            protocol.sendFrame(
+                opcode=2 if self.factory.binary else 1,
+                payload=self._compressed_payload(pmce.server_max_window_bits, pmce.mem_level),
+                rsv=4
+            )
+        else:
+            protocol.sendPreparedMessage(self.prepared)
+
+
+@implementer(IPushProducer)
+class ClientQueue(object):
+    '''
+    Sends broadcasts to one client, holding them back while its transport
+    has paused us because its send buffer is full. While held back, a
+    retained message replaces any queued message on the same channel
+    (these are full snapshots, so only the newest matters).
+    '''
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.paused = False
+        self.queued_bytes = 0
+        self.replaced = 0
+        self._queue = deque()
+
+    def send(self, channel, broadcast, size, replaceable=False):
+        if not self.paused and not self._queue:
+            broadcast.send_to(self.protocol)
+            return
+
+        if replaceable:
+            for entry in self._queue:
+                if entry[3] and entry[0] == channel:
+                    self._queue.remove(entry)
+                    self.queued_bytes -= entry[2]
+                    self.replaced += 1
+                    break
+
+        self._queue.append((channel, broadcast, size, replaceable, reactor.seconds()))
+        self.queued_bytes += size
+
+    @property
+    def lag(self):
+        '''
+        Age, in seconds, of the oldest message waiting to be sent.
+        '''
+        if self._queue:
+            return reactor.seconds() - self._queue[0][4]
+        return 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        while self._queue and not self.paused:
+            _, broadcast, size, _, _ = self._queue.popleft()
+            self.queued_bytes -= size
+            broadcast.send_to(self.protocol)
+
+    def stopProducing(self):
+        self._queue.clear()
+        self.queued_bytes = 0
 
 
 class BroadcastServerFactory(WebSocketServerFactory):
-    def __init__(self):
+    '''
+    Publishes messages to all connected clients. A client that can't
+    keep up has messages queued for it (see ClientQueue), and is
+    disconnected once it has more than `max_queued_bytes` queued or its
+    oldest queued message is more than `max_client_lag` seconds old.
+    '''
+    log = Logger()
+
+    max_client_lag = 60
+
+    def __init__(self, metrics=None, binary=False, context_takeover=False):
         WebSocketServerFactory.__init__(self)
         self.clients = []
+        self.binary = binary
+        self.context_takeover = context_takeover
+        self.setProtocolOptions(perMessageCompressionAccept=self._accept_compression)
+        self.max_queued_bytes = int(
+            os.environ.get('LIVETIMING_STANDALONE_CLIENT_BUFFER', DEFAULT_MAX_QUEUED_BYTES)
+        )
+        self.metrics = metrics or Metrics()
+        self.slow_disconnects = 0
 
     def register(self, client):
         if client not in self.clients:
@@ -25,31 +169,186 @@ class BroadcastServerFactory(WebSocketServerFactory):
         if client in self.clients:
             self.clients.remove(client)
 
-    def publish(self, channel, message, *args, **kwargs):
-        payload = simplejson.dumps([
+    def _accept_compression(self, offers):
+        '''
+        Accepts permessage-deflate. Without context takeover, each
+        message is compressed independently, so one compressed frame can
+        be shared by all clients; with it, similar consecutive messages
+        compress better but each client must be compressed separately.
+        '''
+        for offer in offers:
+            if isinstance(offer, PerMessageDeflateOffer):
+                return PerMessageDeflateOfferAccept(
+                    offer,
+                    no_context_takeover=offer.request_no_context_takeover or not self.context_takeover
+                )
+        return None
+
+    @staticmethod
+    def encode(channel, message):
+        return simplejson.dumps([
             channel,
             message
         ]).encode('utf-8')
 
-        preparedMsg = self.prepareMessage(payload)
-        for c in self.clients:
-            c.sendPreparedMessage(preparedMsg)
+    def publish(self, channel, message, *args, **kwargs):
+        payload = self.encode(channel, message)
+        replaceable = bool(getattr(kwargs.get('options'), 'retain', False))
+
+        with self.metrics.time('fanout'):
+            broadcast = Broadcast(self, payload)
+            for c in list(self.clients):
+                c.queue.send(channel, broadcast, len(payload), replaceable)
+                if c.queue.queued_bytes > self.max_queued_bytes or c.queue.lag > self.max_client_lag:
+                    self._drop_slow_client(c)
+
+    def _drop_slow_client(self, client):
+        self.log.warn(
+            'Disconnecting slow client {peer} ({queued} bytes queued, lag {lag:.1f}s)',
+            peer=client.peer,
+            queued=client.queue.queued_bytes,
+            lag=client.queue.lag
+        )
+        self.slow_disconnects += 1
+        self.unregister(client)
+        client.queue.stopProducing()
+        client.dropConnection(abort=True)
+
+    def client_stats(self):
+        return {
+            'connected': len(self.clients),
+            'paused': len([c for c in self.clients if c.queue.paused]),
+            'slowDisconnects': self.slow_disconnects,
+            'clients': {
+                c.peer: {
+                    'paused': c.queue.paused,
+                    'lag': c.queue.lag,
+                    'queued': len(c.queue),
+                    'queuedBytes': c.queue.queued_bytes,
+                    'replaced': c.queue.replaced
+                }
+                for c in self.clients
+            }
+        }
+
+
+class JSONResource(Resource):
+    '''
+    Serves the return value of `func` as JSON. If `local_only` is set,
+    requests not originating from a loopback address are refused.
+    '''
+    isLeaf = True
+
+    def __init__(self, func, local_only=False):
+        super().__init__()
+        self._func = func
+        self._local_only = local_only
+
+    def render_GET(self, request):
+        if self._local_only and not _is_loopback(request.getClientAddress()):
+            request.setResponseCode(403)
+            return b''
+        request.setHeader(b'Content-Type', b'application/json')
+        request.setHeader(b'Cache-Control', b'no-cache')
+        return simplejson.dumps(self._func()).encode('utf-8')
+
+
+class SnapshotResource(Resource):
+    '''
+    Serves a JSON snapshot with ETag and gzip support. `func` returns a
+    (token, data) pair, or None if there's nothing to serve; the data is
+    only re-encoded when a different token is returned.
+    '''
+    isLeaf = True
+
+    def __init__(self, func):
+        super().__init__()
+        self._func = func
+        self._token = None
+        self._etag = None
+        self._body = None
+        self._gzipped = None
+
+    def _refresh(self):
+        snapshot = self._func()
+        if snapshot is None:
+            return False
+        token, data = snapshot
+        if self._body is None or token is not self._token:
+            self._token = token
+            self._body = simplejson.dumps(data).encode('utf-8')
+            self._etag = '"{}"'.format(hashlib.sha1(self._body).hexdigest()).encode('ascii')
+            self._gzipped = None
+        return True
+
+    def render_GET(self, request):
+        if not self._refresh():
+            request.setResponseCode(404)
+            return b''
+
+        request.setHeader(b'ETag', self._etag)
+        request.setHeader(b'Cache-Control', b'no-cache')
+        request.setHeader(b'Vary', b'Accept-Encoding')
+
+        if_none_match = request.getHeader(b'If-None-Match')
+        if if_none_match:
+            tags = [tag.strip().replace(b'W/', b'', 1) for tag in if_none_match.split(b',')]
+            if self._etag in tags or b'*' in tags:
+                request.setResponseCode(304)
+                return b''
+
+        request.setHeader(b'Content-Type', b'application/json')
+        if b'gzip' in (request.getHeader(b'Accept-Encoding') or b''):
+            if self._gzipped is None:
+                self._gzipped = gzip.compress(self._body)
+            request.setHeader(b'Content-Encoding', b'gzip')
+            return self._gzipped
+        return self._body
+
+
+class AnalysisResource(Resource):
+    def __init__(self, service):
+        super().__init__()
+        self._service = service
+        self._snapshots = {}
+
+    def getChild(self, name, request):
+        key = name.decode('utf-8', 'replace')
+        resource = self._snapshots.get(key)
+        if resource is None:
+            if self._service.analysis_snapshot(key) is None:
+                return NoResource()
+            resource = self._snapshots[key] = SnapshotResource(lambda: self._service.analysis_snapshot(key))
+        return resource
+
+
+def _is_loopback(address):
+    try:
+        return ipaddress.ip_address(address.host).is_loopback
+    except (AttributeError, ValueError):
+        return False
 
 
 def make_protocol(service):
     class StandaloneServiceProtocol(WebSocketServerProtocol):
 
         def onOpen(self):
+            # Twisted Web registered its HTTP channel as the transport's
+            # producer; the channel is finished with now that we've taken
+            # over, so register our queue instead.
+            if getattr(self.transport, 'producer', None) is not None:
+                self.transport.unregisterProducer()
+            self.queue = ClientQueue(self)
+            self.registerProducer(self.queue, True)
+
             self.factory.register(self)
             service.log.info(
                 'Client {peer} connected (total={total})',
                 peer=self.peer,
                 total=len(self.factory.clients)
             )
-            service.publishManifest()
-            service._publishRaceState()
-            if service.analyser:
-                service.analyser.publish_all()
+            for channel, message in service.initial_sync_messages():
+                self.sendMessage(self.factory.encode(channel, message), isBinary=self.factory.binary)
 
         def connectionLost(self, reason):
             WebSocketServerProtocol.connectionLost(self, reason)
@@ -70,15 +369,51 @@ class StandaloneSession(object):
         self.service = service
         self.use_upnp = use_upnp
 
-    def run(self):
-        factory = BroadcastServerFactory()
+    def listen(self, port=None):
+        '''
+        Starts serving this service on the given port (by default, the
+        value of LIVETIMING_STANDALONE_PORT, or any free port) without
+        running the reactor. Returns the port actually listened on.
+        '''
+        binary = bool(os.environ.get('LIVETIMING_STANDALONE_BINARY', False))
+        factory = BroadcastServerFactory(
+            self.service.metrics,
+            binary=binary,
+            context_takeover=bool(os.environ.get('LIVETIMING_STANDALONE_CONTEXT_TAKEOVER', False))
+        )
+        if binary:
+            # The connection is compressed, so the state need not be
+            self.service.compress_messages = False
+            if self.service.analyser:
+                self.service.analyser.compress_messages = False
         factory.protocol = self._protocol
+        self.factory = factory
         self.service.set_publish(factory.publish)
 
-        port = int(os.environ.get('LIVETIMING_STANDALONE_PORT', 0))
+        # The WebSocket lives at the root; plain HTTP endpoints alongside it.
+        root = Resource()
+        root.putChild(b'', WebSocketResource(factory))
+        root.putChild(b'metrics', JSONResource(self.service._requestMetrics, local_only=True))
+        root.putChild(b'state', SnapshotResource(self.service.state_snapshot))
+        root.putChild(b'manifest', SnapshotResource(self.service.manifest_snapshot))
+        root.putChild(b'analysis', AnalysisResource(self.service))
+        self.service.metrics.add_source('clients', factory.client_stats)
 
-        listening_port = reactor.listenTCP(port, factory)
-        actual_port = listening_port.getHost().port
+        if port is None:
+            port = int(os.environ.get('LIVETIMING_STANDALONE_PORT', 0))
+
+        self._listening_port = reactor.listenTCP(port, Site(root))
+        return self._listening_port.getHost().port
+
+    def stop(self):
+        self.service.set_publish(None)
+        self.service.metrics.remove_source('clients')
+        for client in list(self.factory.clients):
+            client.dropConnection(abort=False)
+        return self._listening_port.stopListening()
+
+    def run(self):
+        actual_port = self.listen()
 
         upnp_forwarded_port, upnp = None, None
 
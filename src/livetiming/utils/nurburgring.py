@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
+from livetiming.service.http import get_agent
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
-from twisted.web.client import Agent, readBody
+from twisted.web.client import readBody
 
 import base64
 import copy
@@ -12,12 +13,9 @@ import simplejson
 import time
 
 
-agent = Agent(reactor)
-
-
 @inlineCallbacks
 def getPage(url):
-    resp = yield agent.request(b'GET', url)
+    resp = yield get_agent().request(b'GET', url)
     body = yield readBody(resp)
 
     returnValue(body)
@@ -1,9 +1,12 @@
-import pkg_resources
+try:
+    from importlib import metadata
+except ImportError:  # Python < 3.8
+    import importlib_metadata as metadata
 
 
 VERSION = 'unknown'
 try:
-    VERSION = pkg_resources.get_distribution('livetiming-core').version
+    VERSION = metadata.version('livetiming-core')
 except Exception:
     pass
 